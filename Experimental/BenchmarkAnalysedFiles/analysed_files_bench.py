@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+##############################################################################
+# (c) Crown copyright Met Office. All rights reserved.
+# For further details please refer to the file COPYRIGHT
+# which you should have received as part of this distribution
+##############################################################################
+"""
+Measure the memory used by a large number of analysis results, and how fast they go into sets and dicts.
+
+We generate synthetic Fortran results, round tripped through json as if loaded from the analysis database,
+so each one has its own copy of every symbol name, like real loaded results.
+
+The old hash was made from every field, sorting every set, on every call. Results now hash their path and file hash,
+once. The old hash is reproduced here for comparison.
+
+We also compare loading the results from json, and from the binary format now used by the analysis database.
+
+"""
+import random
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import Dict, List, Set
+
+from fab.parse import results_from_bytes, results_to_bytes
+from fab.parse.fortran import AnalysedFortran
+from fab.util import PausedGC
+
+
+def legacy_hash(analysed_file) -> int:
+    # the hash we used to calculate, for comparison
+    things = set()
+    for field_name in analysed_file.field_names():
+        thing = getattr(analysed_file, field_name)
+        if isinstance(thing, Dict):
+            things.add(tuple(sorted(thing.items())))
+        elif isinstance(thing, (Set, frozenset)):
+            things.add(tuple(sorted(thing)))
+        else:
+            things.add(thing)
+    return hash(tuple(things))
+
+
+def generate(num_files: int, num_symbols: int) -> List[str]:
+    # each file defines a module and a few procedures, and uses a handful of popular modules
+    symbols = [f'symbol_{i}' for i in range(num_symbols)]
+    popular = symbols[:num_symbols // 100 or 1]
+    results = []
+    for i in range(num_files):
+        module = f'module_{i}'
+        deps = random.sample(popular, min(5, len(popular))) + random.sample(symbols, 20)
+        analysed_file = AnalysedFortran(
+            fpath=Path(f'/src/dir_{i % 100}/file_{i}.f90'), file_hash=random.getrandbits(32),
+            module_defs=[module], symbol_defs=[module] + [f'proc_{i}_{j}' for j in range(5)],
+            module_deps=deps[:5], symbol_deps=deps,
+        )
+        results.append(analysed_file.to_json())
+    return results
+
+
+def timed(label: str, func, repeat: int):
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    print(f'{label}: {(time.perf_counter() - start_time) / repeat:.4f}s')
+
+
+def main():
+    arg_parser = ArgumentParser(description=__doc__)
+    arg_parser.add_argument('--files', type=int, default=50000, help='How many results to generate.')
+    arg_parser.add_argument('--symbols', type=int, default=20000, help='How many distinct symbols they use.')
+    arg_parser.add_argument('--repeat', type=int, default=5, help='How many times to time each operation.')
+    args = arg_parser.parse_args()
+
+    as_json = generate(args.files, args.symbols)
+
+    tracemalloc.start()
+    results = [AnalysedFortran.from_json(s) for s in as_json]
+    loaded_memory = tracemalloc.get_traced_memory()[0]
+    for analysed_file in results:
+        analysed_file.freeze()
+    frozen_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f'{len(results)} results: {loaded_memory / 2**20:.1f}MB loaded, {frozen_memory / 2**20:.1f}MB frozen, '
+          f'{frozen_memory / len(results):.0f} bytes each')
+
+    timed('legacy hash, every result', lambda: [legacy_hash(af) for af in results], args.repeat)
+    timed('hash, every result', lambda: [hash(af) for af in results], args.repeat)
+    timed('set of results', lambda: set(results), args.repeat)
+
+    source_tree = {af.fpath: af for af in results}
+    timed('source tree lookups', lambda: [source_tree[af.fpath] for af in results], args.repeat)
+
+    # loading them, as from the analysis database
+    as_bytes = [af.to_bytes() for af in results]
+    print(f'json {sum(map(len, as_json)) / 2**20:.1f}MB, binary {sum(map(len, as_bytes)) / 2**20:.1f}MB')
+    timed('load json', lambda: [AnalysedFortran.from_json(s) for s in as_json], args.repeat)
+    timed('load binary', lambda: [AnalysedFortran.from_bytes(b) for b in as_bytes], args.repeat)
+    with PausedGC():
+        timed('load binary, trusted, gc paused',
+              lambda: [AnalysedFortran.from_bytes(b, validate=False) for b in as_bytes], args.repeat)
+    timed('load binary batch', lambda: results_from_bytes(results_to_bytes(results), validate=False), args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+##############################################################################
+# (c) Crown copyright Met Office. All rights reserved.
+# For further details please refer to the file COPYRIGHT
+# which you should have received as part of this distribution
+##############################################################################
+"""
+Time the include region lookups made by the C analyser, for every node in a large preprocessed C file.
+
+Give it a C file which has been through Fab's pragma injector and preprocessor,
+as found in the build output of a C project. If clang isn't installed, or no file is given,
+we generate the line numbers of a large file, with many include regions.
+
+The old lookup rescanned every region for every node. The current one bisects precomputed region boundaries.
+
+"""
+import random
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from fab.parse.c import CAnalyser, clang
+
+
+def linear_lookup(include_region: List[Tuple[int, str]], lineno: int) -> Optional[str]:
+    # the lookup we used to do, for comparison
+    include_stack = []
+    for region_line, region_type in include_region:
+        if region_line > lineno:
+            break
+        if region_type.endswith("start"):
+            include_stack.append(region_type.replace("_start", ""))
+        elif region_type.endswith("end"):
+            include_stack.pop()
+    return include_stack[-1] if include_stack else None
+
+
+def from_file(fpath: Path, analyser: CAnalyser) -> List[int]:
+    # the line of every node the analyser visits
+    translation_unit = clang.cindex.Index.create().parse(fpath, args=["-xc"])
+    analyser._locate_include_regions(translation_unit)
+    return [node.location.line for node in translation_unit.cursor.walk_preorder() if node.spelling]
+
+
+def generated(num_regions: int, num_nodes: int, analyser: CAnalyser) -> List[int]:
+    # alternate system and user includes, with some code between them
+    include_region = []
+    line = 0
+    for i in range(num_regions):
+        kind = random.choice(['sys_include', 'usr_include'])
+        line += random.randint(1, 20)
+        include_region.append((line, f'{kind}_start'))
+        line += random.randint(10, 200)
+        include_region.append((line, f'{kind}_end'))
+    analyser._include_region = include_region
+    return sorted(random.randint(1, line + 100) for _ in range(num_nodes))
+
+
+def main():
+    arg_parser = ArgumentParser(description=__doc__)
+    arg_parser.add_argument('source', nargs='?', type=Path, help='A preprocessed C file, with Fab pragmas.')
+    arg_parser.add_argument('--regions', type=int, default=500, help='How many include regions to generate.')
+    arg_parser.add_argument('--nodes', type=int, default=50000, help='How many nodes to generate.')
+    args = arg_parser.parse_args()
+
+    analyser = CAnalyser()
+    if args.source and clang:
+        lines = from_file(args.source, analyser)
+    else:
+        if args.source:
+            print('clang not installed, generating a file instead')
+        lines = generated(args.regions, args.nodes, analyser)
+    print(f'{len(lines)} nodes, {len(analyser._include_region) // 2} include regions')
+
+    start_time = time.perf_counter()
+    old = [linear_lookup(analyser._include_region, line) for line in lines]
+    linear_time = time.perf_counter() - start_time
+    print(f'linear lookup: {linear_time:.4f}s')
+
+    start_time = time.perf_counter()
+    new = [analyser._check_for_include(line) for line in lines]
+    bisect_time = time.perf_counter() - start_time
+    print(f'bisect lookup: {bisect_time:.4f}s, {linear_time / bisect_time:.0f}x faster')
+
+    assert new == old, 'lookups disagree'
+
+
+if __name__ == '__main__':
+    main()
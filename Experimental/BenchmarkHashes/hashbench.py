@@ -4,42 +4,93 @@
 # For further details please refer to the file COPYRIGHT
 # which you should have received as part of this distribution
 ##############################################################################
+"""
+Compare the hash algorithms Fab can use for checksums, on real source.
 
+Give it a source tree, such as a LFRic checkout, to see the speed of each algorithm on a whole build's files.
+It defaults to the file next to this script.
+
+The chance of two files having the same checksum grows with the number of files.
+We show it for 32 bit checksums, such as crc32, and for the 64 bit checksums we use by default.
+
+"""
 import hashlib
-from pathlib import Path
+import math
 import time
 import zlib
+from argparse import ArgumentParser
+from pathlib import Path
+from typing import List
+
+from fab.util import HASH_ALGORITHMS, file_walk
 
 _ITERATIONS = 10
 
+SOURCE_SUFFIXES = {'.f90', '.F90', '.x90', '.X90', '.c', '.h', '.inc'}
 
-def from_zlib(test_data):
-    for method in (zlib.crc32, zlib.adler32):
-        print(f"Algorithm: {method}", end='')
-        start_time = time.time()
+
+def collision_chance(num_files: int, bits: int) -> float:
+    # the birthday bound
+    return -math.expm1(num_files * (num_files - 1) / 2 * math.log1p(-1 / 2**bits))
+
+
+def bench_fab(data: List[bytes]):
+    total_mb = sum(map(len, data)) / 1e6
+    print(f'{len(data)} files, {total_mb:.1f} MB')
+    for name, method in HASH_ALGORITHMS.items():
+        start_time = time.perf_counter()
         for iteration in range(_ITERATIONS):
-            _ = method(test_data, 1)
-        end_time = time.time()
-        print(f" - {(end_time - start_time) / _ITERATIONS}")
+            for file_data in data:
+                method(file_data)
+        elapsed = (time.perf_counter() - start_time) / _ITERATIONS
+        print(f"Algorithm: {name.rjust(10)} - {elapsed:.4f}s, {total_mb / elapsed:.0f} MB/s")
 
+    print()
+    for bits in (32, 64):
+        print(f'chance of a collision between {len(data)} files with a {bits} bit checksum: '
+              f'{collision_chance(len(data), bits):.2g}')
 
-def from_hashlib(test_data):
-    for method in hashlib.algorithms_available:
-        print(f"Algorithm: {method.rjust(10)} - ", end='')
-        hasher = hashlib.new(method)
-        start_time = time.time()
+
+def bench_others(data: List[bytes]):
+    # other algorithms we might consider
+    for method in (zlib.crc32, zlib.adler32):
+        start_time = time.perf_counter()
         for iteration in range(_ITERATIONS):
-            _ = hasher.update(test_data)
-        end_time = time.time()
-        elapsed = (end_time - start_time) / _ITERATIONS
-        print(elapsed)
+            for file_data in data:
+                method(file_data)
+        print(f"Algorithm: {method.__name__.rjust(10)} - {(time.perf_counter() - start_time) / _ITERATIONS:.4f}s")
+
+    for name in sorted(hashlib.algorithms_available):
+        start_time = time.perf_counter()
+        try:
+            for iteration in range(_ITERATIONS):
+                for file_data in data:
+                    hashlib.new(name, file_data).digest()
+        except (TypeError, ValueError):
+            # e.g. shake algorithms need a length
+            continue
+        print(f"Algorithm: {name.rjust(10)} - {(time.perf_counter() - start_time) / _ITERATIONS:.4f}s")
 
 
 def main():
-    test_file = Path(__file__).parent / 'psykal_lite_mod.F90'
-    test_data = test_file.read_bytes()
-    from_zlib(test_data)
-    from_hashlib(test_data)
+    arg_parser = ArgumentParser(description=__doc__)
+    arg_parser.add_argument('source', nargs='?', type=Path, default=Path(__file__).parent / 'psykal_lite_mod.F90',
+                            help='A source file, or a folder of source.')
+    arg_parser.add_argument('--all', action='store_true', help='Also time the other algorithms in the stdlib.')
+    args = arg_parser.parse_args()
+
+    if args.source.is_dir():
+        fpaths = [fpath for fpath in file_walk(args.source) if fpath.suffix in SOURCE_SUFFIXES]
+    else:
+        fpaths = [args.source]
+    data = [fpath.read_bytes() for fpath in fpaths]
+    if not data:
+        arg_parser.error(f'no source found in {args.source}')
+
+    bench_fab(data)
+    if args.all:
+        print()
+        bench_others(data)
 
 
 if __name__ == '__main__':
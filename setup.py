@@ -22,7 +22,7 @@ with open(os.path.join(_here, 'source', 'fab', '__init__.py'),
 
 tests = ['pytest', 'pytest-cov', 'pytest-mock', 'flake8', 'mypy']
 docs = ['sphinx', 'sphinx-material', 'sphinx-autodoc-typehints', 'sphinx-copybutton']
-features = ['matplotlib', 'jinja2', 'psyclone']
+features = ['matplotlib', 'jinja2', 'psyclone', 'xxhash']
 
 setuptools.setup(
     name='sci-fab',
@@ -58,7 +58,8 @@ setuptools.setup(
     },
     entry_points={
         'console_scripts': [
-            'fab=fab.cli:cli_fab'
+            'fab=fab.cli:cli_fab',
+            'fab-worker=fab.remote:cli_worker',
         ]
     },
 )
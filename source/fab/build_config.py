@@ -13,17 +13,23 @@ import os
 import sys
 import warnings
 from argparse import Namespace
+from concurrent.futures import Executor
 from datetime import datetime
 from fnmatch import fnmatch
 from logging.handlers import RotatingFileHandler
-from multiprocessing import cpu_count
+from multiprocessing import cpu_count, Pool
+from multiprocessing.pool import Pool as PoolType
 from pathlib import Path
 from string import Template
 from typing import List, Optional, Dict, Any, Iterable
 
-from fab.constants import BUILD_OUTPUT, SOURCE_ROOT, PREBUILD, CURRENT_PREBUILDS
+from fab.constants import BUILD_OUTPUT, SOURCE_ROOT, PREBUILD, CURRENT_PREBUILDS, ANALYSIS_DB, \
+    HASH_CACHE
+from fab.journal import StepJournal
+from fab.parse.analysis_db import AnalysisDB
 from fab.metrics import send_metric, init_metrics, stop_metrics, metrics_summary
-from fab.util import TimerLogger, by_type, get_fab_workspace
+from fab.util import DEFAULT_HASH_ALGORITHM, HASH_ALGORITHMS, HashCache, TimerLogger, by_type, \
+    get_fab_workspace, set_hash_algorithm, set_hash_cache
 
 logger = logging.getLogger(__name__)
 
@@ -38,7 +44,11 @@ class BuildConfig(object):
     """
     def __init__(self, project_label: str, parsed_args: Optional[Namespace] = None,
                  multiprocessing: bool = True, n_procs: Optional[int] = None, reuse_artefacts: bool = False,
-                 fab_workspace: Optional[Path] = None,):
+                 fab_workspace: Optional[Path] = None, fail_fast: bool = False, keep_going: bool = False,
+                 memory_budget: Optional[int] = None, tool_threads: bool = False,
+                 remote_executor: Optional[Executor] = None, resume: bool = False, hash_cache: bool = False,
+                 verify_hashes: bool = False, hash_algorithm: Optional[str] = None,
+                 worker_max_tasks: Optional[int] = None, worker_max_rss: Optional[int] = None):
         """
         :param project_label:
             Name of the build project. The project workspace folder is created from this name, with spaces replaced
@@ -57,6 +67,48 @@ class BuildConfig(object):
         :param fab_workspace:
             Overrides the FAB_WORKSPACE environment variable.
             If not set, and FAB_WORKSPACE is not set, the fab workspace defaults to *~/fab-workspace*.
+        :param fail_fast:
+            Stop all outstanding work in a step as soon as anything fails.
+            By default, a step which finds an error finishes the work it has started, then reports all its errors.
+            Can also be set with the `--fail-fast` command line argument.
+        :param keep_going:
+            When something fails to compile, carry on compiling everything which doesn't depend on it,
+            then report all the errors together. Can't be used with fail_fast.
+            Can also be set with the `--keep-going` command line argument.
+        :param memory_budget:
+            The most memory, in bytes, that the work running in parallel should use.
+            Steps which know how much memory each file needed in previous runs, from the metrics,
+            only start work which fits in the budget. A single item will always run, even if it's over budget.
+        :param tool_threads:
+            Run the work which spends its time waiting for command line tools, such as compilers and preprocessors,
+            in threads of this process instead of the worker pool. The tools still run in parallel,
+            but we don't need a whole Python worker process waiting for each one.
+        :param remote_executor:
+            Optional executor, such as a :class:`~fab.remote.RemoteExecutor`, for work which can run on other machines
+            sharing the project workspace. Compilation uses it instead of the worker pool. We don't shut it down.
+        :param resume:
+            Keep a journal of the completed steps, so that if the build is interrupted, the next run skips them
+            and restores their artefacts. See :class:`~fab.journal.StepJournal`.
+            Can also be set with the `--resume` command line argument.
+        :param hash_cache:
+            Remember the checksums of the files we read, in the project workspace, so an unchanged file
+            doesn't need to be read again. A file is unchanged if it has the same size, modification time and inode.
+            See :class:`~fab.util.HashCache`.
+            Can also be set with the `--hash-cache` command line argument.
+        :param verify_hashes:
+            Use the hash cache, but read the files anyway, and warn if the cache was wrong.
+            Can also be set with the `--verify-hashes` command line argument.
+        :param hash_algorithm:
+            The algorithm for file checksums and prebuild names, one of :data:`~fab.util.HASH_ALGORITHMS`.
+            Defaults to blake2b. Can also be set with the `--hash-algorithm` command line argument.
+        :param worker_max_tasks:
+            Replace each worker process after it has processed this many items, releasing the memory it has
+            accumulated, such as parser caches and fragmentation. By default, workers last for the whole build.
+        :param worker_max_rss:
+            Replace the worker pool when a worker's resident memory, in bytes, has grown beyond this.
+            Each worker reports its memory with its results. When one is too large, we stop giving the pool
+            new items, and replace it once the running items have finished.
+            Each worker's peak memory is in the metrics, to help choose these limits.
 
         """
         self.parsed_args = vars(parsed_args) if parsed_args else {}
@@ -81,6 +133,9 @@ class BuildConfig(object):
         self.source_root: Path = self.project_workspace / SOURCE_ROOT
         self.prebuild_folder: Path = self.build_output / PREBUILD
 
+        # analysis results for every source file, see the analyse step
+        self.analysis_db = AnalysisDB(self.prebuild_folder / ANALYSIS_DB)
+
         # multiprocessing config
         self.multiprocessing = multiprocessing
         # turn off multiprocessing when debugging
@@ -98,6 +153,33 @@ class BuildConfig(object):
                 self.multiprocessing = False
                 self.n_procs = None
 
+        # A worker pool shared by every step, created when first needed. See the pool property.
+        self._pool: Optional[PoolType] = None
+        self.worker_max_tasks = worker_max_tasks
+        self.worker_max_rss = worker_max_rss
+        # the resident memory of each worker, as of its latest result, see recycle_workers
+        self._worker_rss: Dict[int, int] = {}
+
+        # error policy
+        self.fail_fast = fail_fast or bool(self.parsed_args.get('fail_fast'))
+        self.keep_going = keep_going or bool(self.parsed_args.get('keep_going'))
+        if self.fail_fast and self.keep_going:
+            raise ValueError("fail_fast and keep_going can't be used together")
+
+        self.memory_budget = memory_budget
+        self.tool_threads = tool_threads
+        self.remote_executor = remote_executor
+
+        # created when the build starts, see the step decorator
+        self.resume = resume or bool(self.parsed_args.get('resume'))
+        self.journal: Optional[StepJournal] = None
+
+        self.verify_hashes = verify_hashes or bool(self.parsed_args.get('verify_hashes'))
+        self.hash_cache = hash_cache or bool(self.parsed_args.get('hash_cache')) or self.verify_hashes
+        self.hash_algorithm = hash_algorithm or self.parsed_args.get('hash_algorithm') or DEFAULT_HASH_ALGORITHM
+        if self.hash_algorithm not in HASH_ALGORITHMS:
+            raise ValueError(f"unknown hash algorithm '{self.hash_algorithm}'")
+
         self.reuse_artefacts = reuse_artefacts
 
         # todo: should probably pull the artefact store out of the config
@@ -132,14 +214,95 @@ class BuildConfig(object):
                 logger.info("no housekeeping step was run, using a default hard cleanup")
                 cleanup_prebuilds(config=self, all_unused=True)
 
+            if self.journal:
+                self.journal.clear()
+
         # always
+        # Child processes hold a copy of the metrics connection, so they must finish before the metrics.
+        self.close_pool(terminate=bool(exc_type))
+        set_hash_cache(None)
+        set_hash_algorithm(DEFAULT_HASH_ALGORITHM)
         self._finalise_metrics(self._start_time, self._build_timer)
         self._finalise_logging()
 
+    def __getstate__(self):
+        # We're sent to child processes and remote workers, which can't use the pool or the remote executor.
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        state['remote_executor'] = None
+        state['journal'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # Remote workers don't inherit the algorithm from our process.
+        set_hash_algorithm(self.hash_algorithm)
+
     @property
     def build_output(self):
         return self.project_workspace / BUILD_OUTPUT
 
+    @property
+    def pool(self) -> PoolType:
+        """
+        The multiprocessing pool used by all steps, via :func:`~fab.steps.run_mp` and friends.
+
+        The pool is created when first used, so the worker processes are forked as late as possible.
+        Reusing one pool saves us creating new worker processes for every call to run_mp.
+        It's closed when the build config exits, or replaced by :meth:`recycle_workers`.
+
+        """
+        if self._pool is None:
+            self._pool = Pool(self.n_procs, maxtasksperchild=self.worker_max_tasks)
+        return self._pool
+
+    def recycle_workers(self):
+        """
+        Replace the worker pool if a worker's resident memory has grown beyond :attr:`worker_max_rss`.
+
+        A worker can only be replaced by the pool between items, when it's reached :attr:`worker_max_tasks`,
+        so we replace the whole pool. This is called by :func:`~fab.steps.run_mp` and friends when the pool
+        has no work running: before they use it, and by :func:`~fab.steps.run_mp_dynamic` when it has held back
+        new work for a worker which is too large, see :meth:`workers_too_large`.
+        Only the memory reported since the last call is considered, so a worker which has since been replaced
+        can't cause another replacement.
+
+        """
+        worker_rss, self._worker_rss = self._worker_rss, {}
+        if not self.worker_max_rss or not worker_rss:
+            return
+
+        pid, rss = max(worker_rss.items(), key=lambda pid_rss: pid_rss[1])
+        if rss > self.worker_max_rss:
+            logger.info(f'worker {pid} is using {rss / 2**20:.0f}MB, replacing the worker pool')
+            self.close_pool()
+
+    def workers_too_large(self) -> bool:
+        """
+        Has a worker reported resident memory beyond :attr:`worker_max_rss`, since :meth:`recycle_workers` last ran?
+
+        """
+        if not self.worker_max_rss:
+            return False
+        return max(self._worker_rss.values(), default=0) > self.worker_max_rss
+
+    def close_pool(self, terminate: bool = False):
+        """
+        Close the worker pool, waiting for the worker processes to finish.
+
+        :param terminate:
+            Stop the workers immediately, without waiting for outstanding work.
+
+        """
+        if self._pool is None:
+            return
+        if terminate:
+            self._pool.terminate()
+        else:
+            self._pool.close()
+        self._pool.join()
+        self._pool = None
+
     def init_artefact_store(self):
         # there's no point writing to this from a child process of Step.run_mp() because you'll be modifying a copy.
         self._artefact_store = {CURRENT_PREBUILDS: set()}
@@ -162,6 +325,14 @@ class BuildConfig(object):
 
         init_metrics(metrics_folder=self.metrics_folder)
 
+        if self.resume:
+            self.journal = StepJournal(self.project_workspace / 'journal')
+
+        # these must be set before the worker pool is created, so the workers use them too
+        set_hash_algorithm(self.hash_algorithm)
+        if self.hash_cache:
+            set_hash_cache(HashCache(self.project_workspace / HASH_CACHE, verify=self.verify_hashes))
+
         # note: initialising here gives a new set of artefacts each run
         self.init_artefact_store()
 
@@ -19,6 +19,12 @@ BUILD_OUTPUT = "build_output"
 # prebuild folder name
 PREBUILD = '_prebuild'
 
+# analysis results database, in the prebuild folder
+ANALYSIS_DB = 'analysis.db'
+
+# file checksums, in the project workspace
+HASH_CACHE = 'hash_cache.db'
+
 # names of artefact collections
 PROJECT_SOURCE_TREE = 'project source tree'
 PRAGMAD_C = 'pragmad_c'
@@ -10,11 +10,14 @@ Classes and helper functions related to the dependency tree, as created by the a
 
 # todo: we've since adopted the term "source tree", so we should probably rename this module to match.
 from abc import ABC
+from array import array
+from collections.abc import MutableMapping
+from itertools import compress
 import logging
 from pathlib import Path
-from typing import Set, Dict, Iterable, List, Union, Optional, Any
+from typing import AbstractSet, Any, Dict, FrozenSet, Iterable, Iterator, List, Optional, Set, Tuple, Union
 
-from fab.parse import AnalysedFile
+from fab.parse import AnalysedFile, NAMES, PATHS, _freeze_symbols
 
 logger = logging.getLogger(__name__)
 
@@ -30,6 +33,9 @@ class AnalysedDependent(AnalysedFile, ABC):
     During dependency analysis, symbol dependencies are turned into file dependencies.
 
     """
+    __slots__ = ('symbol_defs', 'symbol_deps', 'file_deps')
+    _binary_fields = {1: (('symbol_defs', NAMES), ('symbol_deps', NAMES), ('file_deps', PATHS))}
+
     def __init__(self, fpath: Union[str, Path], file_hash: Optional[int] = None,
                  symbol_defs: Optional[Iterable[str]] = None, symbol_deps: Optional[Iterable[str]] = None,
                  file_deps: Optional[Iterable[Path]] = None):
@@ -50,8 +56,8 @@ class AnalysedDependent(AnalysedFile, ABC):
         """
         super().__init__(fpath=fpath, file_hash=file_hash)
 
-        self.symbol_defs: Set[str] = set(symbol_defs or {})
-        self.symbol_deps: Set[str] = set(symbol_deps or {})
+        self.symbol_defs: AbstractSet[str] = set(symbol_defs or {})
+        self.symbol_deps: AbstractSet[str] = set(symbol_deps or {})
         self.file_deps: Set[Path] = set(file_deps or [])
 
         assert all([d and len(d) for d in self.symbol_defs]), "bad symbol definitions"
@@ -68,6 +74,17 @@ class AnalysedDependent(AnalysedFile, ABC):
     def add_file_dep(self, name):
         self.file_deps.add(Path(name))
 
+    def freeze(self):
+        """
+        Make the symbol sets immutable, sharing one copy of each symbol name between all the analysed files.
+
+        Results loaded from the database, or sent from other processes, have their own copy of every name.
+        Popular symbols are used by thousands of files.
+
+        """
+        self.symbol_defs = _freeze_symbols(self.symbol_defs)
+        self.symbol_deps = _freeze_symbols(self.symbol_deps)
+
     @classmethod
     def field_names(cls):
         return super().field_names() + [
@@ -114,7 +131,31 @@ def extract_sub_tree(source_tree: Dict[Path, AnalysedDependent], root: Path, ver
     result: Dict[Path, AnalysedDependent] = dict()
     missing: Set[Path] = set()
 
-    _extract_sub_tree(src_tree=source_tree, key=root, dst_tree=result, missing=missing, verbose=verbose)
+    # iterative, so long chains of dependencies can't reach the recursion limit
+    to_visit = [root]
+    while to_visit:
+        key = to_visit.pop()
+        # is this node already in the sub tree?
+        if key in result:
+            continue
+
+        if verbose:
+            logger.debug(str(key))
+
+        # add it to the output tree
+        node = source_tree[key]
+        assert node.fpath == key, "tree corrupted"
+        result[key] = node
+
+        # add its child deps
+        for file_dep in node.file_deps:
+            # one of its deps is missing!
+            if not source_tree.get(file_dep):
+                if verbose:
+                    logger.debug(" !!MISSING!! " + str(file_dep))
+                missing.add(file_dep)
+                continue
+            to_visit.append(file_dep)
 
     if missing:
         logger.warning(f"{root} has missing deps: {missing}")
@@ -122,33 +163,234 @@ def extract_sub_tree(source_tree: Dict[Path, AnalysedDependent], root: Path, ver
     return result
 
 
-def _extract_sub_tree(src_tree: Dict[Path, AnalysedDependent], key: Path,
-                      dst_tree: Dict[Path, AnalysedDependent], missing: Set[Path], verbose: bool, indent: int = 0):
-    # is this node already in the sub tree?
-    if key in dst_tree:
-        return
+class SubTree(MutableMapping):
+    """
+    A view of part of a source tree, as made by :func:`extract_sub_trees`.
+
+    The view shares the source tree's analysed files rather than copying them. It reads like a dict, and files
+    can be added to it, as when adding unreferenced dependencies to a build tree.
+
+    """
+    def __init__(self, source_tree: Dict[Path, AnalysedDependent], keys: Iterable[Path]):
+        """
+        :param source_tree:
+            The source tree we're a view of.
+        :param keys:
+            The files in the view. They must be in the source tree.
 
-    if verbose:
-        logger.debug("----" * indent + str(key))
+        """
+        self._source_tree = source_tree
+        # an ordered set
+        self._keys: Dict[Path, None] = dict.fromkeys(keys)
+        # files added to the view which aren't in the source tree
+        self._extra: Dict[Path, AnalysedDependent] = {}
 
-    # add it to the output tree
-    node = src_tree[key]
-    assert node.fpath == key, "tree corrupted"
-    dst_tree[key] = node
+    def __getitem__(self, key: Path) -> AnalysedDependent:
+        if key in self._extra:
+            return self._extra[key]
+        if key in self._keys:
+            return self._source_tree[key]
+        raise KeyError(key)
 
-    # add its child deps
-    for file_dep in node.file_deps:
+    def __setitem__(self, key: Path, value: AnalysedDependent):
+        if self._source_tree.get(key) is value:
+            self._extra.pop(key, None)
+            self._keys[key] = None
+        else:
+            self._keys.pop(key, None)
+            self._extra[key] = value
 
-        # one of its deps is missing!
-        if not src_tree.get(file_dep):
-            if logger and verbose:
-                logger.debug("----" * indent + " !!MISSING!! " + str(file_dep))
-            missing.add(file_dep)
-            continue
+    def __delitem__(self, key: Path):
+        if key not in self:
+            raise KeyError(key)
+        self._keys.pop(key, None)
+        self._extra.pop(key, None)
+
+    def __contains__(self, key) -> bool:
+        return key in self._keys or key in self._extra
+
+    def __iter__(self) -> Iterator[Path]:
+        yield from self._keys
+        yield from self._extra
+
+    def __len__(self) -> int:
+        return len(self._keys) + len(self._extra)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({dict(self)})'
+
+
+_BITS_TO_BYTES = bytes.maketrans(b'01', b'\x00\x01')
+
+
+class DepGraph(object):
+    """
+    The file dependencies of a source tree, as arrays of integers.
 
-        # add this child dep
-        _extract_sub_tree(
-            src_tree=src_tree, key=file_dep, dst_tree=dst_tree, missing=missing, verbose=verbose, indent=indent + 1)
+    Each file is given a number, its position in :attr:`fpaths`. The dependencies of file *i* are
+    ``targets[offsets[i]:offsets[i + 1]]``, which is much smaller, and quicker to walk, than sets of paths.
+    Dependencies which aren't in the source tree are kept separately, in :attr:`missing`.
+
+    The graph doesn't change when the source tree does, so build it once the file dependencies are complete.
+
+    """
+    def __init__(self, source_tree: Dict[Path, AnalysedDependent]):
+        """
+        :param source_tree:
+            The source tree of analysed files, with their file dependencies filled in.
+
+        """
+        self.fpaths: List[Path] = list(source_tree)
+        self.ids: Dict[Path, int] = {fpath: i for i, fpath in enumerate(self.fpaths)}
+        self.offsets = array('i', [0])
+        self.targets = array('i')
+        self.missing: Dict[int, FrozenSet[Path]] = {}
+
+        for i, fpath in enumerate(self.fpaths):
+            missing = set()
+            for file_dep in source_tree[fpath].file_deps:
+                j = self.ids.get(file_dep)
+                if j is None:
+                    missing.add(file_dep)
+                elif j != i:
+                    self.targets.append(j)
+            self.offsets.append(len(self.targets))
+            if missing:
+                self.missing[i] = frozenset(missing)
+
+    def __len__(self):
+        return len(self.fpaths)
+
+    def reachable(self, roots: Iterable[int]) -> Dict[int, Tuple[int, FrozenSet[Path]]]:
+        """
+        Find every file reachable from each root, in one pass over the graph.
+
+        Files which depend on each other in a cycle are grouped into strongly connected components,
+        using an iterative version of Tarjan's algorithm, giving a graph with no cycles. Each component's
+        reachable files are worked out once, as a bitset built from those of the components it depends on,
+        and shared by every root which reaches it.
+
+        Returns, for each root, the bitset of reachable files and their missing dependencies.
+
+        :param roots:
+            The numbers of the root files.
+
+        """
+        offsets, targets = self.offsets, self.targets
+        index = [-1] * len(self)
+        low_link = [0] * len(self)
+        on_stack = bytearray(len(self))
+        stack: List[int] = []
+        counter = 0
+
+        reach = [0] * len(self)
+        missing: List[FrozenSet[Path]] = [frozenset()] * len(self)
+
+        roots = list(roots)
+        for root in roots:
+            if index[root] >= 0:
+                continue
+            index[root] = low_link[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack[root] = 1
+            # each file we're visiting, and the position of the next dependency to look at
+            work = [[root, offsets[root]]]
+
+            while work:
+                item = work[-1]
+                v, pos = item
+                if pos < offsets[v + 1]:
+                    item[1] += 1
+                    w = targets[pos]
+                    if index[w] < 0:
+                        index[w] = low_link[w] = counter
+                        counter += 1
+                        stack.append(w)
+                        on_stack[w] = 1
+                        work.append([w, offsets[w]])
+                    elif on_stack[w] and index[w] < low_link[v]:
+                        low_link[v] = index[w]
+                    continue
+
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    if low_link[v] < low_link[parent]:
+                        low_link[parent] = low_link[v]
+
+                if low_link[v] == index[v]:
+                    # v is the root of a component, whose dependencies are all done
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = 0
+                        component.append(member)
+                        if member == v:
+                            break
+                    self._reach_component(component, reach, missing)
+
+        return {root: (reach[root], missing[root]) for root in roots}
+
+    def _reach_component(self, component: List[int], reach: List[int], missing: List[FrozenSet[Path]]):
+        # Everything the component depends on has been done, apart from the component itself.
+        component_reach = 0
+        for member in component:
+            component_reach |= 1 << member
+        component_missing: Set[Path] = set()
+        for member in component:
+            component_missing.update(self.missing.get(member, ()))
+            for pos in range(self.offsets[member], self.offsets[member + 1]):
+                dep = self.targets[pos]
+                if not component_reach >> dep & 1:
+                    component_reach |= reach[dep]
+                    component_missing.update(missing[dep])
+
+        # most components have nothing missing, so they share the empty set
+        frozen_missing = frozenset(component_missing) if component_missing else missing[component[0]]
+        for member in component:
+            reach[member] = component_reach
+            missing[member] = frozen_missing
+
+    def members(self, bitset: int) -> List[Path]:
+        """
+        The files in a bitset, as returned by :meth:`reachable`.
+
+        """
+        # one byte per bit, lowest first, which is zero for the bits which aren't set
+        bits = bin(bitset)[:1:-1].encode().translate(_BITS_TO_BYTES)
+        return list(compress(self.fpaths, bits))
+
+
+def extract_sub_trees(source_tree: Dict[Path, AnalysedDependent], roots: Iterable[Path],
+                      graph: Optional[DepGraph] = None) -> Dict[Path, SubTree]:
+    """
+    Extract the subtree required to build each root, in one pass over the source tree.
+
+    Like :func:`extract_sub_tree`, for many roots. The results are views of the source tree, rather than copies.
+    See :meth:`DepGraph.reachable`.
+
+    Returns a :class:`SubTree` for each root.
+
+    :param source_tree:
+        The source tree of analysed files.
+    :param roots:
+        The files containing the roots, such as Fortran programs.
+    :param graph:
+        The :class:`DepGraph` of the source tree, if we already have one.
+
+    """
+    graph = graph or DepGraph(source_tree)
+    roots = list(roots)
+    reachable = graph.reachable(graph.ids[root] for root in roots)
+
+    result = {}
+    for root in roots:
+        bitset, missing = reachable[graph.ids[root]]
+        if missing:
+            logger.warning(f"{root} has missing deps: {set(missing)}")
+        result[root] = SubTree(source_tree, graph.members(bitset))
+    return result
 
 
 def filter_source_tree(source_tree: Dict[Path, AnalysedDependent], suffixes: Iterable[str]) -> List[AnalysedDependent]:
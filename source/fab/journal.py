@@ -0,0 +1,297 @@
+##############################################################################
+# (c) Crown copyright Met Office. All rights reserved.
+# For further details please refer to the file COPYRIGHT
+# which you should have received as part of this distribution
+##############################################################################
+"""
+A record of the steps completed by a build, so an interrupted build can resume where it stopped.
+
+After each step, we write an entry containing a snapshot of the artefact store.
+When the build is run again, each step whose entry matches is skipped, and its artefacts are restored.
+The journal is removed when the build succeeds.
+
+"""
+import functools
+import hashlib
+import logging
+import os
+import pickle
+import types
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set
+
+from fab.util import PausedGC
+
+logger = logging.getLogger(__name__)
+
+
+class StepJournal(object):
+    """
+    The completed steps of a build, in the order they ran, stored in a folder in the project workspace.
+
+    An entry is replayed when the step has the same name and arguments, and the files in the artefact store,
+    before and after the step, have the same size and modification time as when it ran.
+    Once an entry doesn't match, the rest of the journal is discarded and the build carries on as normal.
+
+    The journal doesn't know about files outside the artefact store. For example, if the source grabbed by
+    a build changes before it's resumed, the grab won't be repeated. Delete the journal in that case.
+
+    """
+    def __init__(self, folder: Path):
+        """
+        :param folder:
+            Where the journal is kept. It's created if it doesn't exist.
+
+        """
+        self.folder = folder
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+        # the entries we haven't yet replayed, or discarded
+        self._headers: List[Dict[str, Any]] = self._load_headers()
+        self._position = 0
+
+        # steps run by other steps are part of the outer step's entry
+        self.depth = 0
+
+    def _entry_fpath(self, index: int) -> Path:
+        return self.folder / f'{index:04d}.pkl'
+
+    def _load_headers(self) -> List[Dict[str, Any]]:
+        headers: List[Dict[str, Any]] = []
+        while self._entry_fpath(len(headers)).exists():
+            try:
+                with open(self._entry_fpath(len(headers)), 'rb') as infile:
+                    headers.append(pickle.load(infile))
+            except Exception as err:
+                logger.warning(f'discarding unreadable journal entry {self._entry_fpath(len(headers))}: {err}')
+                break
+
+        self._remove_entries(len(headers))
+        return headers
+
+    def restore(self, key: int, artefact_store: Dict[str, Any]) -> bool:
+        """
+        Replay the next entry into the artefact store, if it matches the step we're about to run.
+
+        Returns whether the step can be skipped.
+
+        :param key:
+            Identifies the step and its inputs, see :func:`step_key`.
+        :param artefact_store:
+            The artefact store, which is updated from the entry.
+
+        """
+        if self._position >= len(self._headers):
+            return False
+
+        header = self._headers[self._position]
+        if header['key'] == key:
+            # the store can hold tens of thousands of analysis results
+            with open(self._entry_fpath(self._position), 'rb') as infile, PausedGC():
+                pickle.load(infile)
+                store = pickle.load(infile)
+
+            if header['outputs'] == stat_checksum(store):
+                artefact_store.clear()
+                artefact_store.update(store)
+                self._position += 1
+                return True
+
+        logger.info(f"journal entry for step '{header['name']}' no longer matches, discarding the rest of the journal")
+        self._discard(self._position)
+        return False
+
+    def record(self, name: str, key: int, artefact_store: Dict[str, Any]):
+        """
+        Add an entry for a completed step.
+
+        The entry is written to a temporary file, then renamed, so a crash can't leave a partial entry.
+
+        :param name:
+            The name of the step, for logging.
+        :param key:
+            Identifies the step and its inputs, see :func:`step_key`.
+        :param artefact_store:
+            The artefact store after the step ran.
+
+        """
+        # anything after this entry is from an earlier run
+        self._discard(self._position)
+
+        header = {'name': name, 'key': key, 'outputs': stat_checksum(artefact_store)}
+        fpath = self._entry_fpath(self._position)
+        tmp_fpath = fpath.with_suffix('.tmp')
+        with open(tmp_fpath, 'wb') as outfile:
+            pickle.dump(header, outfile)
+            pickle.dump(artefact_store, outfile)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        os.replace(tmp_fpath, fpath)
+
+        self._headers.append(header)
+        self._position += 1
+
+    def _discard(self, index: int):
+        # forget the entries from the given index onwards
+        del self._headers[index:]
+        self._remove_entries(index)
+
+    def _remove_entries(self, index: int):
+        while self._entry_fpath(index).exists():
+            self._entry_fpath(index).unlink()
+            index += 1
+
+    def clear(self):
+        """
+        Remove the whole journal, when the build has succeeded.
+
+        """
+        self._position = 0
+        self._discard(0)
+        for tmp in self.folder.glob('*.tmp'):
+            tmp.unlink()
+
+
+def step_key(name: str, step_args, artefact_store: Dict[str, Any]) -> int:
+    """
+    Identify a step and its inputs, from its name, arguments, and the files in the artefact store before it runs.
+
+    The arguments are written out in a canonical form, so the key doesn't depend on the order of sets
+    or on where objects are in memory. An argument which can only be identified by its address, such as a lambda,
+    gives a key which never matches, so the step won't be replayed.
+
+    :param name:
+        The name of the step.
+    :param step_args:
+        The step's arguments, not including the config.
+    :param artefact_store:
+        The artefact store before the step runs.
+
+    """
+    try:
+        args_text = _canonical(step_args, set())
+    except _Unidentifiable as err:
+        logger.warning(f"step '{name}' can't be replayed from the journal, it has an argument we can't identify: {err}")
+        args_text = uuid.uuid4().hex
+
+    return _digest([name, args_text, str(stat_checksum(artefact_store))])
+
+
+def stat_checksum(artefacts: Any) -> int:
+    """
+    Return a checksum of the size and modification time of every file path found in the artefacts.
+
+    This is much quicker than reading the files. Paths are found in collections, and in the attributes of objects
+    such as an :class:`~fab.parse.AnalysedFile`.
+
+    :param artefacts:
+        Usually the artefact store.
+
+    """
+    fpaths: Set[Path] = set()
+    _find_paths(artefacts, fpaths, set())
+
+    fingerprints = []
+    for fpath in sorted(fpaths):
+        try:
+            stat = fpath.stat()
+            fingerprints.append(f'{fpath} {stat.st_size} {stat.st_mtime_ns}')
+        except OSError:
+            fingerprints.append(f'{fpath} missing')
+    return _digest(fingerprints)
+
+
+def _digest(parts: List[str]) -> int:
+    # A 128 bit hash, whatever the build's hash algorithm, because a wrong match restores the wrong artefacts.
+    # Each part is length-prefixed, so ['ab', 'c'] and ['a', 'bc'] differ.
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        data = part.encode()
+        digest.update(len(data).to_bytes(8, 'big'))
+        digest.update(data)
+    return int.from_bytes(digest.digest(), 'big')
+
+
+class _Unidentifiable(ValueError):
+    pass
+
+
+def _canonical(obj, path: Set[int]) -> str:
+    # Write out an object such that equal objects give the same text in any run.
+    # The path holds the ids of the containers we're inside, to stop at cycles.
+    if obj is None or isinstance(obj, (bool, int, float, str, bytes, Path)):
+        return repr(obj)
+
+    if isinstance(obj, (types.FunctionType, types.BuiltinFunctionType, type)):
+        qualname = obj.__qualname__
+        if '<' in qualname:
+            # lambdas and functions defined inside functions, we can't tell them apart
+            raise _Unidentifiable(repr(obj))
+        return f'{obj.__module__}.{qualname}'
+
+    if id(obj) in path:
+        return '<cycle>'
+    path.add(id(obj))
+    try:
+        if isinstance(obj, (list, tuple)):
+            items = [_canonical(item, path) for item in obj]
+        elif isinstance(obj, (set, frozenset)):
+            items = sorted(_canonical(item, path) for item in obj)
+        elif isinstance(obj, dict):
+            items = sorted(f'{_canonical(k, path)}: {_canonical(v, path)}' for k, v in obj.items())
+        elif isinstance(obj, functools.partial):
+            items = [_canonical(obj.func, path), _canonical(obj.args, path), _canonical(obj.keywords, path)]
+        elif isinstance(obj, types.MethodType):
+            items = [_canonical(obj.__func__, path), _canonical(obj.__self__, path)]
+        else:
+            state: Dict[str, Any] = dict(getattr(obj, '__dict__', {}))
+            # such as analysis results
+            for klass in type(obj).__mro__:
+                for name in getattr(klass, '__slots__', ()):
+                    if name not in ('__dict__', '__weakref__') and hasattr(obj, name):
+                        state[name] = getattr(obj, name)
+            if state:
+                items = [_canonical(state, path)]
+            elif ' at 0x' in repr(obj):
+                raise _Unidentifiable(repr(obj))
+            else:
+                items = [repr(obj)]
+    finally:
+        path.discard(id(obj))
+
+    klass = type(obj)
+    return f'{klass.__module__}.{klass.__qualname__}({", ".join(items)})'
+
+
+def _find_paths(obj, fpaths: Set[Path], seen: Set[int]):
+    if isinstance(obj, Path):
+        fpaths.add(obj)
+        return
+    if isinstance(obj, (str, bytes, int, float, bool)) or obj is None or id(obj) in seen:
+        return
+    seen.add(id(obj))
+
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            _find_paths(key, fpaths, seen)
+            _find_paths(value, fpaths, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for value in obj:
+            _find_paths(value, fpaths, seen)
+    else:
+        if hasattr(obj, '__dict__'):
+            _find_paths(vars(obj), fpaths, seen)
+        # such as analysis results
+        for klass in type(obj).__mro__:
+            for name in getattr(klass, '__slots__', ()):
+                _find_paths(getattr(obj, name, None), fpaths, seen)
+
+
+def get_journal(config) -> Optional[StepJournal]:
+    """
+    The config's journal, if it's resumable and the build has started.
+
+    """
+    journal = getattr(config, 'journal', None)
+    return journal if isinstance(journal, StepJournal) else None
@@ -32,9 +32,10 @@ import logging
 import warnings
 from collections import defaultdict
 from multiprocessing import Process, Pipe
+from threading import Lock
 from multiprocessing.connection import Connection
 from pathlib import Path
-from typing import Optional, Dict
+from typing import Any, Iterable, Optional, Dict
 
 JSON_FILENAME = 'metrics.json'
 
@@ -47,6 +48,9 @@ _metric_send_conn: Optional[Connection] = None
 # the process which receives individual metrics
 _metric_recv_process: Optional[Process] = None
 
+# metrics can be sent from several threads, see BuildConfig.tool_threads
+_metric_send_lock = Lock()
+
 
 def init_metrics(metrics_folder: Path):
     """
@@ -139,7 +143,59 @@ def send_metric(group: str, name: str, value):
     if not _metric_send_conn:
         warnings.warn('_metric_send_conn not set, cannot send metrics')
         return
-    _metric_send_conn.send([group, name, value])  # type: ignore
+    with _metric_send_lock:
+        _metric_send_conn.send([group, name, value])  # type: ignore
+
+
+def read_metrics(metrics_folder: Path) -> Dict[str, Dict]:
+    """
+    Read the metrics written by the previous run, if there was one.
+
+    During a run, the metrics file still contains the previous run's metrics, until :func:`stop_metrics` is called.
+
+    :param metrics_folder:
+        The folder where metrics were written.
+
+    """
+    try:
+        with open(metrics_folder / JSON_FILENAME, 'rt') as infile:
+            return json.load(infile)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def carry_forward_metrics(metrics_folder: Path, group: str, field: str, names: Iterable[str]) -> Dict[str, Any]:
+    """
+    Get a field of the previous run's metrics for each name in a group, such as the time taken to compile a file.
+
+    Names which weren't in the last run's metrics, for example because a prebuild was used,
+    keep their value from earlier runs. We pass these values forward into this run's metrics,
+    so they're available next time.
+
+    :param metrics_folder:
+        The folder where metrics were written.
+    :param group:
+        The metrics group, where each value is a dict.
+    :param field:
+        The field we want from each value.
+    :param names:
+        The names we want values for.
+
+    """
+    metrics = read_metrics(metrics_folder)
+    history_group = f'{group} {field} history'
+
+    # the latest values override older ones
+    values: Dict[str, Any] = dict(metrics.get(history_group, {}))
+    values.update({
+        name: value[field] for name, value in metrics.get(group, {}).items()
+        if isinstance(value, dict) and value.get(field) is not None})
+
+    found = {name: values[name] for name in names if name in values}
+    for name, value in found.items():
+        send_metric(history_group, name, value)
+
+    return found
 
 
 def stop_metrics():
@@ -176,6 +232,8 @@ def metrics_summary(metrics_folder: Path):
     #
     # metrics['compile fortran'][filename] = {'time_taken': timer.taken, 'start': timer.start}
     #
+    # metrics['worker memory'][pid] = {'peak_rss': peak resident memory of a worker process}
+    #
 
     try:
         import matplotlib  # type: ignore
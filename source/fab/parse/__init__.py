@@ -5,15 +5,29 @@
 # ##############################################################################
 import json
 import logging
+import struct
+import sys
 from abc import ABC
+from functools import lru_cache
 from pathlib import Path
-from typing import Union, Optional, Dict, Any, Set
+from typing import Union, Optional, Dict, Any, FrozenSet, Iterable, List, Tuple, Type
 
-from fab.util import file_checksum
+from fab.util import PausedGC, file_checksum
 
 
 logger = logging.getLogger(__name__)
 
+# The kinds of field in the binary format, see AnalysedFile.to_bytes().
+NAMES = 'names'  # a set of strings
+PATHS = 'paths'  # a set of paths
+HASHES = 'hashes'  # a dict of strings to 64 bit hashes
+
+# Each binary result starts with a marker, the version of its class's fields, its file hash if it has one,
+# the number of fields and the length of its strings. See AnalysedFile._pack().
+_HEADER = struct.Struct('<BB?QBI')
+_MARKER = 0xFA
+_COUNT = struct.Struct('<I')
+
 
 class ParseException(Exception):
     pass
@@ -23,7 +37,26 @@ class AnalysedFile(ABC):
     """
     Analysis results for a single file. Abstract base class.
 
+    Analysis results are identified by their path and file hash, which is all their hash value is made from.
+    Equality still compares every field.
+
+    We can have hundreds of thousands of these, so they use slots rather than a dict.
+    Subclasses must declare their own `__slots__`.
+
     """
+    __slots__ = ('_fpath', '_file_hash', '_hash')
+
+    # The fields written by to_bytes(), after the path and file hash, for each version of a class's binary format.
+    # When a class's fields change, add a version, keeping the old ones so stored results can still be read.
+    _binary_fields: Dict[int, Tuple[Tuple[str, str], ...]] = {1: ()}
+
+    # every result class, by name, so binary results can be read whichever class is expected
+    _result_classes: Dict[str, Type['AnalysedFile']] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        AnalysedFile._result_classes[cls.__name__] = cls
+
     def __init__(self, fpath: Union[str, Path], file_hash: Optional[int] = None):
         """
         :param fpath:
@@ -35,9 +68,20 @@ class AnalysedFile(ABC):
         If not provided, the `self.file_hash` property is lazily evaluated in case the file does not yet exist.
 
         """
+        self._hash: Optional[int] = None
         self.fpath = Path(fpath)
         self._file_hash = file_hash
 
+    @property
+    def fpath(self) -> Path:
+        return self._fpath
+
+    @fpath.setter
+    def fpath(self, fpath: Path):
+        # loaded results are moved to where the file is now, which changes our hash
+        self._fpath = fpath
+        self._hash = None
+
     @property
     def file_hash(self):
         if self._file_hash is None:
@@ -46,9 +90,37 @@ class AnalysedFile(ABC):
             self._file_hash: int = file_checksum(self.fpath).file_hash
         return self._file_hash
 
+    def freeze(self):
+        """
+        Make the symbol sets immutable, once the file has been analysed.
+
+        Subclasses with symbol sets override this. The file dependencies aren't frozen,
+        they're filled in later, by the dependency analysis.
+
+        """
+
     def __eq__(self, other):
-        # todo: better to use self.field_names() instead of vars(self) in order to evaluate any lazy attributes?
-        return vars(self) == vars(other)
+        if not isinstance(other, AnalysedFile):
+            return NotImplemented
+        # We use self.field_names() instead of our slots in order to evaluate any lazy attributes.
+        return type(self) is type(other) and \
+            all(getattr(self, field_name) == getattr(other, field_name) for field_name in self.field_names())
+
+    # We need to be hashable before we can go into a set, which is useful for our subclasses.
+    # Note, the numerical result will change with each Python invocation, so we don't pickle it.
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash((self.fpath, self.file_hash))
+        return self._hash
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in _slot_names(type(self))
+                if name != '_hash' and hasattr(self, name)}
+
+    def __setstate__(self, state):
+        self._hash = None
+        for name, value in state.items():
+            setattr(self, name, value)
 
     # persistence
     def to_dict(self) -> Dict[str, Any]:
@@ -68,21 +140,88 @@ class AnalysedFile(ABC):
     def from_dict(cls, d):
         raise NotImplementedError
 
-    def save(self, fpath: Union[str, Path]):
+    def to_json(self) -> str:
         # subclasses don't need to override this method
         d = self.to_dict()
         d["cls"] = self.__class__.__name__
-        json.dump(d, open(fpath, 'wt'), indent=4)
+        return json.dumps(d)
 
     @classmethod
-    def load(cls, fpath: Union[str, Path]):
+    def from_json(cls, s: str):
         # subclasses don't need to override this method
-        d = json.load(open(fpath))
+        d = json.loads(s)
         found_class = d["cls"]
+        # any analyser can find an empty file
+        if found_class == EmptySourceFile.__name__:
+            return EmptySourceFile.from_dict(d)
         if found_class != cls.__name__:
             raise ValueError(f"Expected class name '{cls.__name__}', found '{found_class}'")
         return cls.from_dict(d)
 
+    def save(self, fpath: Union[str, Path]):
+        with open(fpath, 'wt') as outfile:
+            outfile.write(self.to_json())
+
+    @classmethod
+    def load(cls, fpath: Union[str, Path]):
+        with open(fpath, 'rt') as infile:
+            return cls.from_json(infile.read())
+
+    def to_bytes(self) -> bytes:
+        """
+        Create a compact binary representation of the object, which is much quicker to load than json.
+
+        Sets are sorted, for reproducibility. A lazy file hash which hasn't been evaluated is left out.
+
+        """
+        out = bytearray()
+        self._pack(out)
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, validate: bool = True, fpath: Optional[Path] = None):
+        """
+        Create an object from the output of :meth:`to_bytes`, from this or any earlier version of Fab.
+
+        :param data:
+            The binary result.
+        :param validate:
+            Construct the object with :meth:`from_dict`, which checks its fields.
+            Trusted results, which we wrote ourselves, can skip this.
+        :param fpath:
+            Use this path instead of the stored one, for results shared by copies of the same source.
+
+        """
+        result, _ = _unpack(data, 0, validate, fpath)
+        # any analyser can find an empty file
+        if not isinstance(result, (cls, EmptySourceFile)):
+            raise ValueError(f"Expected class name '{cls.__name__}', found '{type(result).__name__}'")
+        return result
+
+    def _pack(self, out: bytearray):
+        # After the header, we write the number of strings in each field, then all the strings,
+        # null separated, starting with the class name and path, then the values of any hashes.
+        # Reading them is one decode and one split.
+        version = max(self._binary_fields)
+        strings = [type(self).__name__, str(self.fpath)]
+        counts: List[int] = []
+        hashes: List[int] = []
+        for field_name, kind in self._binary_fields[version]:
+            value = getattr(self, field_name)
+            names = sorted(map(str, value))
+            if kind == HASHES:
+                hashes.extend(value[name] for name in names)
+            strings.extend(names)
+            counts.append(len(names))
+
+        # paths and symbols can't contain a null
+        encoded = '\0'.join(strings).encode()
+        out += _HEADER.pack(
+            _MARKER, version, self._file_hash is not None, self._file_hash or 0, len(counts), len(encoded))
+        out += struct.pack(f'<{len(counts)}I', *counts)
+        out += encoded
+        out += struct.pack(f'<{len(hashes)}Q', *hashes)
+
     # human readability
     @classmethod
     def field_names(cls):
@@ -104,44 +243,124 @@ class AnalysedFile(ABC):
         params = ', '.join([f'{f}={repr(getattr(self, f))}' for f in self.field_names()])
         return f'{self.__class__.__name__}({params})'
 
-    # We need to be hashable before we can go into a set, which is useful for our subclasses.
-    # Note, the numerical result will change with each Python invocation.
-    def __hash__(self):
-        # Build up a list of things to hash, from our attributes.
-        # We use self.field_names() rather than vars(self) because we want to evaluate any lazy attributes.
-        # We turn dicts and sets into sorted tuples for hashing.
-        # todo: There's a good reason dicts and sets aren't supposed to be hashable.
-        #       Please see https://github.com/metomi/fab/issues/229
-        things = set()
-        for field_name in self.field_names():
-            thing = getattr(self, field_name)
-            if isinstance(thing, Dict):
-                things.add(tuple(sorted(thing.items())))
-            elif isinstance(thing, Set):
-                things.add(tuple(sorted(thing)))
-            else:
-                things.add(thing)
-
-        return hash(tuple(things))
-
-
-# todo: There's a design weakness relating to this class:
-#       we don't save empty results, which means we'll keep reanalysing them.
-#       We should save empty files and allow the loading to detect this, as it already reads the class name.
+
 class EmptySourceFile(AnalysedFile):
     """
     An analysis result for a file which resulted in an empty parse tree.
 
+    These are stored like any other result, so we don't keep reanalysing them.
+    :meth:`~fab.parse.AnalysedFile.from_json` and :meth:`~fab.parse.AnalysedFile.from_bytes`
+    return one whichever result class they're called on.
+
     """
-    def __init__(self, fpath: Union[str, Path]):
+    __slots__ = ()
+
+    def __init__(self, fpath: Union[str, Path], file_hash: Optional[int] = None):
         """
         :param fpath:
             The path of the file which was analysed.
+        :param file_hash:
+            The checksum of the file which was analysed.
+            If omitted, Fab will evaluate lazily.
 
         """
-        super().__init__(fpath=fpath)
+        super().__init__(fpath=fpath, file_hash=file_hash)
 
     @classmethod
     def from_dict(cls, d):
-        # todo: load & save should be implemented here and used by the calling code, to save reanalysis.
-        raise NotImplementedError
+        return cls(fpath=Path(d["fpath"]), file_hash=d["file_hash"])
+
+
+@lru_cache(maxsize=None)
+def _slot_names(cls) -> Tuple[str, ...]:
+    # all the slots of a class, including those of its bases
+    return tuple(name for klass in reversed(cls.__mro__) for name in getattr(klass, '__slots__', ()))
+
+
+def _freeze_symbols(symbols: Iterable[str]) -> FrozenSet[str]:
+    # Share one copy of each name between all the analysed files.
+    # A frozenset copied from a set is sized for its contents, one built from an iterator may be twice as big.
+    return frozenset(set(map(sys.intern, symbols)))
+
+
+def results_to_bytes(results: Iterable[AnalysedFile]) -> bytes:
+    """
+    Create a compact binary representation of many analysis results, of any class.
+
+    """
+    results = list(results)
+    out = bytearray(_COUNT.pack(len(results)))
+    for result in results:
+        result._pack(out)
+    return bytes(out)
+
+
+def results_from_bytes(data: bytes, validate: bool = True) -> List[AnalysedFile]:
+    """
+    Reverse :func:`results_to_bytes`.
+
+    :param data:
+        The binary results.
+    :param validate:
+        As for :meth:`~fab.parse.AnalysedFile.from_bytes`.
+
+    """
+    (count,) = _COUNT.unpack_from(data, 0)
+    offset = _COUNT.size
+    results = []
+    with PausedGC():
+        for _ in range(count):
+            result, offset = _unpack(data, offset, validate)
+            results.append(result)
+    return results
+
+
+def _unpack(data: bytes, offset: int, validate: bool, fpath: Optional[Path] = None) -> Tuple[AnalysedFile, int]:
+    # read one result, returning it and the offset of whatever follows it
+    marker, version, has_hash, file_hash, num_fields, length = _HEADER.unpack_from(data, offset)
+    if marker != _MARKER:
+        raise ValueError('not a binary analysis result')
+    offset += _HEADER.size
+    counts = struct.unpack_from(f'<{num_fields}I', data, offset)
+    offset += 4 * num_fields
+    strings = data[offset:offset + length].decode().split('\0')
+    offset += length
+
+    class_name = strings[0]
+    result_class = AnalysedFile._result_classes.get(class_name)
+    if not result_class:
+        raise ValueError(f"unknown analysis result class '{class_name}'")
+    fields = result_class._binary_fields.get(version)
+    if fields is None or len(fields) != num_fields:
+        raise ValueError(f"unknown version {version} of '{class_name}', from a newer version of Fab?")
+
+    values: Dict[str, Any] = {}
+    start = 2
+    for (field_name, kind), count in zip(fields, counts):
+        names = strings[start:start + count]
+        start += count
+        if kind == HASHES:
+            values[field_name] = dict(zip(names, struct.unpack_from(f'<{count}Q', data, offset)))
+            offset += 8 * count
+        elif kind == PATHS:
+            values[field_name] = set(map(Path, names))
+        else:
+            values[field_name] = set(names)
+
+    # fields added since this result was stored
+    for field_name, kind in result_class._binary_fields[max(result_class._binary_fields)]:
+        if field_name not in values:
+            values[field_name] = {} if kind == HASHES else set()
+
+    if not has_hash:
+        file_hash = None
+    if validate:
+        result = result_class.from_dict({'fpath': fpath or strings[1], 'file_hash': file_hash, **values})
+    else:
+        result = result_class.__new__(result_class)
+        result._hash = None
+        result._fpath = fpath or Path(strings[1])
+        result._file_hash = file_hash
+        for field_name, value in values.items():
+            setattr(result, field_name, value)
+    return result, offset
@@ -0,0 +1,178 @@
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+"""
+A single database of analysis results, shared by every file and analyser in the prebuild folder.
+
+"""
+import logging
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Union
+
+from fab.parse import AnalysedFile
+from fab.util import PausedGC, SQLiteDB, from_sqlite_int, get_hash_algorithm, to_sqlite_int
+
+logger = logging.getLogger(__name__)
+
+# SQLite limits the number of parameters in a query
+_QUERY_CHUNK = 500
+
+
+class AnalysisDB(SQLiteDB):
+    """
+    Analysis results stored in an SQLite database, keyed by file hash and analyser.
+
+    Each result is stored in the binary format from :meth:`~fab.parse.AnalysedFile.to_bytes`.
+    Older versions of Fab stored json, which can still be read, see :func:`load_result`.
+    Results from the same source, in any location, are shared. The caller replaces the path in a loaded result.
+    File hashes from different hash algorithms are kept apart.
+
+    Each result records when it was last stored or loaded, so :func:`~fab.steps.cleanup_prebuilds.cleanup_prebuilds`
+    can remove the results which are no longer used.
+
+    Worker processes open their own connections, and can write concurrently.
+    SQLite's default journal mode is used, rather than its write-ahead log, because the prebuild folder
+    may be on a shared filesystem.
+
+    """
+    _schema = [
+        'CREATE TABLE IF NOT EXISTS analysis ('
+        'file_hash INTEGER NOT NULL, analyser TEXT NOT NULL, result BLOB NOT NULL, last_used REAL NOT NULL, '
+        'PRIMARY KEY (file_hash, analyser))',
+    ]
+
+    def get(self, analyser: str, file_hash: int) -> Optional[Union[bytes, str]]:
+        """
+        Return the stored result for a file, or None.
+
+        :param analyser:
+            Identifies the analyser and its settings, which produced the result.
+        :param file_hash:
+            The hash of the analysed file.
+
+        """
+        key = (to_sqlite_int(file_hash), _key(analyser))
+        with self.conn:
+            row = self.conn.execute('SELECT result FROM analysis WHERE file_hash = ? AND analyser = ?', key).fetchone()
+            if row:
+                self.conn.execute(
+                    'UPDATE analysis SET last_used = ? WHERE file_hash = ? AND analyser = ?', (time.time(), *key))
+        return row[0] if row else None
+
+    def get_many(self, analyser: str, file_hashes: Iterable[int]) -> Dict[int, Union[bytes, str]]:
+        """
+        Return the stored results for many files, in as few queries as possible.
+
+        Returns a dict mapping each found file hash to its result.
+
+        :param analyser:
+            Identifies the analyser and its settings, which produced the results.
+        :param file_hashes:
+            The hashes of the analysed files.
+
+        """
+        file_hashes = list(set(map(to_sqlite_int, file_hashes)))
+        found: Dict[int, Union[bytes, str]] = {}
+        now = time.time()
+        with self.conn:
+            for i in range(0, len(file_hashes), _QUERY_CHUNK):
+                chunk = file_hashes[i:i + _QUERY_CHUNK]
+                in_chunk = f'file_hash IN ({", ".join("?" * len(chunk))})'
+                rows = self.conn.execute(
+                    f'SELECT file_hash, result FROM analysis WHERE analyser = ? AND {in_chunk}',
+                    (_key(analyser), *chunk))
+                found.update((from_sqlite_int(file_hash), result) for file_hash, result in rows)
+                self.conn.execute(
+                    f'UPDATE analysis SET last_used = ? WHERE analyser = ? AND {in_chunk}',
+                    (now, _key(analyser), *chunk))
+        return found
+
+    def put(self, analyser: str, file_hash: int, result: Union[bytes, str]):
+        """
+        Store the result for a file, replacing any previous result.
+
+        :param analyser:
+            Identifies the analyser and its settings, which produced the result.
+        :param file_hash:
+            The hash of the analysed file.
+        :param result:
+            The analysis result, from :meth:`~fab.parse.AnalysedFile.to_bytes`.
+            Json is also accepted, which can help when debugging.
+
+        """
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO analysis (file_hash, analyser, result, last_used) VALUES (?, ?, ?, ?)',
+                (to_sqlite_int(file_hash), _key(analyser), result, time.time()))
+
+    def latest_use(self) -> Optional[float]:
+        """
+        Return when any result was last stored or loaded, as seconds since the epoch, or None if there are none.
+
+        """
+        return self.conn.execute('SELECT MAX(last_used) FROM analysis').fetchone()[0]
+
+    def remove_unused(self, before: float) -> int:
+        """
+        Remove the results which haven't been stored or loaded since the given time.
+
+        Returns the number of results removed.
+
+        :param before:
+            Seconds since the epoch.
+
+        """
+        with self.conn:
+            return self.conn.execute('DELETE FROM analysis WHERE last_used < ?', (before,)).rowcount
+
+
+def _key(analyser: str) -> str:
+    # the same file has a different hash with each algorithm
+    return f'{analyser} {get_hash_algorithm()}'
+
+
+def load_result(result_class, stored: Union[bytes, str], fpath: Path):
+    """
+    Create an analysis result from its stored form.
+
+    :param result_class:
+        The class of result expected. An :class:`~fab.parse.EmptySourceFile` can also be returned.
+    :param stored:
+        A result from the database, which is binary, or json when stored by older versions of Fab.
+    :param fpath:
+        The file the result is for. Results are shared by copies of the same source, so the stored path
+        might be somewhere else.
+
+    """
+    if isinstance(stored, str):
+        result = result_class.from_json(stored)
+        result.fpath = fpath
+        return result
+    # we wrote this ourselves, so we don't need to check it
+    return result_class.from_bytes(stored, validate=False, fpath=fpath)
+
+
+def load_analyses(analyser, hashed_files: Iterable) -> List[AnalysedFile]:
+    """
+    Load the stored analysis results for many files in one go, from the analyser's database.
+
+    Returns the results which were found, with their paths set to the given files.
+
+    :param analyser:
+        A Fortran or C analyser, with its config set.
+    :param hashed_files:
+        :class:`~fab.util.HashedFile` tuples of the files' paths and hashes.
+
+    """
+    hashed_files = list(hashed_files)
+    stored = analyser._config.analysis_db.get_many(analyser.analysis_key, (hf.file_hash for hf in hashed_files))
+
+    results = []
+    with PausedGC():
+        for fpath, file_hash in hashed_files:
+            if file_hash in stored:
+                results.append(load_result(analyser.result_class, stored[file_hash], fpath))
+    return results
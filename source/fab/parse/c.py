@@ -7,11 +7,13 @@ C language handling classes.
 """
 import logging
 import warnings
+from bisect import bisect_right
 from collections import deque
 from pathlib import Path
 from typing import List, Optional, Union, Tuple
 
 from fab.dep_tree import AnalysedDependent
+from fab.parse.analysis_db import load_result
 
 try:
     import clang  # type: ignore
@@ -36,7 +38,19 @@ class AnalysedC(AnalysedDependent):
     # Note: This subclass adds nothing to it's parent, which provides everything it needs.
     #       We'd normally remove an irrelevant class like this but we want to keep the door open
     #       for filtering analysis results by type, rather than suffix.
-    pass
+    __slots__ = ()
+
+
+# The libclang index for this process, see _get_index.
+_index = None
+
+
+def _get_index():
+    # Creating an index sets up libclang, so every file analysed in this process shares one.
+    global _index
+    if _index is None:
+        _index = clang.cindex.Index.create()
+    return _index
 
 
 class CAnalyser(object):
@@ -45,18 +59,52 @@ class CAnalyser(object):
 
     """
 
+    # identifies this analyser in the analysis database
+    analysis_key = 'CAnalyser'
+
+    result_class = AnalysedC
+
     def __init__(self):
 
         # runtime
         self._config = None
 
+        # the include regions of the file being analysed
+        self._include_region = []
+
+    @property
+    def _include_region(self) -> List[Tuple[int, str]]:
+        """
+        The start and end of each include region, as *(line number, region type)* in line order.
+
+        Setting this precomputes the include type in force after each start or end,
+        so :meth:`_check_for_include` can bisect them.
+
+        """
+        return self._include_region_list
+
+    @_include_region.setter
+    def _include_region(self, include_region: List[Tuple[int, str]]):
+        self._include_region_list = include_region
+
+        include_stack: List[str] = []
+        self._region_lines: List[int] = []
+        self._region_types: List[Optional[str]] = []
+        for region_line, region_type in include_region:
+            if region_type.endswith("start"):
+                include_stack.append(region_type.replace("_start", ""))
+            elif region_type.endswith("end"):
+                include_stack.pop()
+            self._region_lines.append(region_line)
+            self._region_types.append(include_stack[-1] if include_stack else None)
+
     # todo: simplifiy by passing in the file path instead of the analysed tokens?
     def _locate_include_regions(self, trans_unit) -> None:
         """
         Look for Fab pragmas identifying included code which came from system or user #includes.
         """
         # Aim is to identify where included (top level) regions start and end in the file
-        self._include_region = []
+        include_region: List[Tuple[int, str]] = []
 
         # Use a deque to implement a rolling window of 4 identifiers
         # (enough to be sure we can spot an entire pragma)
@@ -75,33 +123,25 @@ class CAnalyser(object):
                 lineno = identifiers[2].location.line
                 full = " ".join(id.spelling for id in identifiers)
                 if full == "# pragma FAB SysIncludeStart":
-                    self._include_region.append(
+                    include_region.append(
                         (lineno, "sys_include_start"))
                 elif full == "# pragma FAB SysIncludeEnd":
-                    self._include_region.append(
+                    include_region.append(
                         (lineno, "sys_include_end"))
                 elif full == "# pragma FAB UsrIncludeStart":
-                    self._include_region.append(
+                    include_region.append(
                         (lineno, "usr_include_start"))
                 elif full == "# pragma FAB UsrIncludeEnd":
-                    self._include_region.append(
+                    include_region.append(
                         (lineno, "usr_include_end"))
 
+        self._include_region = include_region
+
     def _check_for_include(self, lineno) -> Optional[str]:
         """Check whether a given line number is in a region that has come from an include."""
-        # todo: don't need a stack?
-        include_stack = []
-        for region_line, region_type in self._include_region:
-            if region_line > lineno:
-                break
-            if region_type.endswith("start"):
-                include_stack.append(region_type.replace("_start", ""))
-            elif region_type.endswith("end"):
-                include_stack.pop()
-        if include_stack:
-            return include_stack[-1]
-        else:
-            return None
+        # the last start or end at or before this line
+        index = bisect_right(self._region_lines, lineno) - 1
+        return self._region_types[index] if index >= 0 else None
 
     def run(self, fpath: Path) \
             -> Union[Tuple[AnalysedC, Path], Tuple[Exception, None]]:
@@ -113,11 +153,13 @@ class CAnalyser(object):
 
         # do we already have analysis results for this file?
         # todo: dupe - probably best in a parser base class
+        analysis_db = self._config.analysis_db
         file_hash = file_checksum(fpath).file_hash
-        analysis_fpath = Path(self._config.prebuild_folder / f'{fpath.stem}.{file_hash}.an')
-        if analysis_fpath.exists():
+        stored = analysis_db.get(self.analysis_key, file_hash)
+        if stored:
             log_or_dot(logger, f"found analysis prebuild for {fpath}")
-            return AnalysedC.load(analysis_fpath), analysis_fpath
+            loaded_result = load_result(AnalysedC, stored, fpath)
+            return loaded_result, analysis_db.fpath
 
         log_or_dot(logger, f"analysing {fpath}")
 
@@ -125,8 +167,7 @@ class CAnalyser(object):
 
         # parse the file
         try:
-            index = clang.cindex.Index.create()
-            translation_unit = index.parse(fpath, args=["-xc"])
+            translation_unit = _get_index().parse(fpath, args=["-xc"])
         except Exception as err:
             logger.exception(f'error parsing {fpath}')
             return err, None
@@ -141,12 +182,9 @@ class CAnalyser(object):
         # Now walk the actual nodes and find all relevant external symbols
         try:
             usr_symbols: List[str] = []
-            for node in translation_unit.cursor.walk_preorder():
+            for node in self._walk(translation_unit.cursor):
                 if not node.spelling:
                     continue
-                # ignore sys include stuff
-                if self._check_for_include(node.location.line) == "sys_include":
-                    continue
                 logger.debug('Considering node: %s', node.spelling)
 
                 if node.kind in {clang.cindex.CursorKind.FUNCTION_DECL, clang.cindex.CursorKind.VAR_DECL}:
@@ -157,8 +195,24 @@ class CAnalyser(object):
             logger.exception(f'error walking parsed nodes {fpath}')
             return err, None
 
-        analysed_file.save(analysis_fpath)
-        return analysed_file, analysis_fpath
+        analysis_db.put(self.analysis_key, file_hash, analysed_file.to_bytes())
+        return analysed_file, analysis_db.fpath
+
+    def _walk(self, cursor):
+        """
+        Yield the cursor's descendants in preorder, except anything from a system include.
+
+        Everything inside a system declaration is from the same include, so we don't visit its children.
+        That's most of a typical preprocessed file.
+
+        """
+        stack = list(reversed(list(cursor.get_children())))
+        while stack:
+            node = stack.pop()
+            if self._check_for_include(node.location.line) == "sys_include":
+                continue
+            yield node
+            stack.extend(reversed(list(node.get_children())))
 
     def _process_symbol_declaration(self, analysed_file, node, usr_symbols):
         # Identify symbol declarations which are definitions or user includes
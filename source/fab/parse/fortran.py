@@ -9,7 +9,7 @@ Fortran language handling classes.
 """
 import logging
 from pathlib import Path
-from typing import Union, Optional, Iterable, Dict, Any, Set
+from typing import AbstractSet, Union, Optional, Iterable, Dict, Any, Set
 
 from fparser.two.Fortran2003 import (  # type: ignore
     Use_Stmt, Module_Stmt, Program_Stmt, Subroutine_Stmt, Function_Stmt, Language_Binding_Spec,
@@ -21,8 +21,11 @@ from fparser.two.Fortran2008 import (  # type: ignore
     Type_Declaration_Stmt, Attr_Spec_List, Entity_Decl_List)
 
 from fab.dep_tree import AnalysedDependent
+from fab.parse import HASHES, NAMES, PATHS, _freeze_symbols
+from fab.metrics import send_metric
 from fab.parse.fortran_common import iter_content, _has_ancestor_type, _typed_child, FortranAnalyserBase
-from fab.util import file_checksum, string_checksum
+from fab.parse.fortran_scan import ScanUnsure, scan_fortran
+from fab.util import file_checksum, string_checksum, Timer
 
 logger = logging.getLogger(__name__)
 
@@ -36,6 +39,13 @@ class AnalysedFortran(AnalysedDependent):
     :class:`~fab.steps.analyse.Analyse` step, which will be converted at runtime into an instance of this class.
 
     """
+    __slots__ = ('program_defs', 'module_defs', 'module_deps', 'mo_commented_file_deps', 'psyclone_kernels')
+    _binary_fields = {1: (
+        ('program_defs', NAMES), ('module_defs', NAMES), ('symbol_defs', NAMES),
+        ('module_deps', NAMES), ('symbol_deps', NAMES),
+        ('mo_commented_file_deps', NAMES), ('file_deps', PATHS), ('psyclone_kernels', HASHES),
+    )}
+
     def __init__(self, fpath: Union[str, Path], file_hash: Optional[int] = None,
                  program_defs: Optional[Iterable[str]] = None,
                  module_defs: Optional[Iterable[str]] = None, symbol_defs: Optional[Iterable[str]] = None,
@@ -72,10 +82,10 @@ class AnalysedFortran(AnalysedDependent):
         super().__init__(fpath=fpath, file_hash=file_hash,
                          symbol_defs=symbol_defs, symbol_deps=symbol_deps, file_deps=file_deps)
 
-        self.program_defs: Set[str] = set(program_defs or [])
-        self.module_defs: Set[str] = set(module_defs or [])
-        self.module_deps: Set[str] = set(module_deps or [])
-        self.mo_commented_file_deps: Set[str] = set(mo_commented_file_deps or [])
+        self.program_defs: AbstractSet[str] = set(program_defs or [])
+        self.module_defs: AbstractSet[str] = set(module_defs or [])
+        self.module_deps: AbstractSet[str] = set(module_deps or [])
+        self.mo_commented_file_deps: AbstractSet[str] = set(mo_commented_file_deps or [])
 
         # Todo: Ideally Psyclone stuff would not be part of this general fortran analysis code.
         #       Instead, perhaps we could inject bespoke node handling into the fortran analyser.
@@ -95,6 +105,16 @@ class AnalysedFortran(AnalysedDependent):
         self.module_deps.add(name.lower())
         self.add_symbol_dep(name)
 
+    def add_mo_commented_file_dep(self, name):
+        self.mo_commented_file_deps.add(name)
+
+    def freeze(self):
+        super().freeze()
+        self.program_defs = _freeze_symbols(self.program_defs)
+        self.module_defs = _freeze_symbols(self.module_defs)
+        self.module_deps = _freeze_symbols(self.module_deps)
+        self.mo_commented_file_deps = _freeze_symbols(self.mo_commented_file_deps)
+
     @property
     def mod_filenames(self):
         """The mod_filenames property defines which module files are expected to be created (but not where)."""
@@ -166,17 +186,48 @@ class FortranAnalyser(FortranAnalyserBase):
     A build step which analyses a fortran file using fparser2, creating an :class:`~fab.dep_tree.AnalysedFortran`.
 
     """
-    def __init__(self, std=None, ignore_mod_deps: Optional[Iterable[str]] = None):
+    def __init__(self, std=None, ignore_mod_deps: Optional[Iterable[str]] = None, scan: bool = False):
         """
         :param std:
             The Fortran standard.
         :param ignore_mod_deps:
             Module names to ignore in use statements.
+        :param scan:
+            Find the dependencies with the line based scanner in :mod:`fab.parse.fortran_scan`,
+            only parsing the files it can't handle.
 
         """
         super().__init__(result_class=AnalysedFortran, std=std)
         self.ignore_mod_deps: Iterable[str] = list(ignore_mod_deps or [])
         self.depends_on_comment_found = False
+        self.use_scanner = scan
+
+    @property
+    def analysis_key(self) -> str:
+        # the ignored modules are left out of the results, so they're part of the key
+        key = super().analysis_key
+        if self.ignore_mod_deps:
+            key += f' ignore {string_checksum(" ".join(sorted(self.ignore_mod_deps)))}'
+        # scanned results are kept apart, in case the scanner gets something wrong
+        return f'{key} scan' if self.use_scanner else key
+
+    def scan(self, fpath: Path, file_hash: int) -> Optional[AnalysedFortran]:
+        if not self.use_scanner:
+            return None
+
+        with Timer() as timer:
+            try:
+                analysed_file = scan_fortran(
+                    fpath, fpath.read_text(errors='replace'), file_hash,
+                    ignore_mod_deps=self.ignore_mod_deps, intrinsic_modules=self._intrinsic_modules)
+            except ScanUnsure as err:
+                logger.debug(f'parsing {fpath} with fparser: {err}')
+                return None
+        send_metric(group='scan fortran', name=str(fpath), value={'time_taken': timer.taken, 'start': timer.start})
+
+        if analysed_file.mo_commented_file_deps:
+            self.depends_on_comment_found = True
+        return analysed_file
 
     def walk_nodes(self, fpath, file_hash, node_tree) -> AnalysedFortran:
 
@@ -286,7 +337,7 @@ class FortranAnalyser(FortranAnalyserBase):
             dep = obj.items[0].split(depends_str)[-1].strip()
             # with .o means a c file
             if dep.endswith(".o"):
-                analysed_file.mo_commented_file_deps.add(dep.replace(".o", ".c"))
+                analysed_file.add_mo_commented_file_dep(dep.replace(".o", ".c"))
             # without .o means a fortran symbol
             else:
                 analysed_file.add_symbol_dep(dep)
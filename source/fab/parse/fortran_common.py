@@ -10,16 +10,19 @@ Common functionality for both Fortran and (sanitised) X90 processing.
 import logging
 from abc import ABC, abstractmethod
 from pathlib import Path
-from typing import Union, Tuple
+from typing import Any, Optional, Union, Tuple
 
 from fparser.common.readfortran import FortranFileReader  # type: ignore
 from fparser.two.parser import ParserFactory  # type: ignore
-from fparser.two.utils import FortranSyntaxError  # type: ignore
+from fparser.two.symbol_table import SYMBOL_TABLES  # type: ignore
+from fparser.two.utils import Base, FortranSyntaxError  # type: ignore
 
 from fab import FabException
 from fab.dep_tree import AnalysedDependent
 from fab.parse import EmptySourceFile
-from fab.util import log_or_dot, file_checksum
+from fab.parse.analysis_db import load_result
+from fab.metrics import send_metric
+from fab.util import log_or_dot, file_checksum, PeakRSS, Timer
 
 
 logger = logging.getLogger(__name__)
@@ -71,6 +74,34 @@ def _typed_child(parent, child_type, must_exist=False):
     return None
 
 
+def _dispose_tree(node_tree):
+    # Break the references from each node to its parent, and to its source line, which caches the node.
+    # Otherwise the tree is a web of reference cycles, which stays in memory until the garbage collector
+    # gets round to it, and the tree of a large file can be hundreds of megabytes.
+    stack = [node_tree]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Base):
+            node.parent = None
+            node.item = None
+            stack.extend(node.children)
+        elif isinstance(node, (list, tuple)):
+            stack.extend(node)
+
+
+# The parser most recently created in this process, and its standard.
+# Creating a parser sets up fparser's classes for that standard, so we only keep the latest.
+_parser: Tuple[Optional[str], Any] = (None, None)
+
+
+def _get_parser(std: str):
+    # Creating a parser is slow, so every analyser in this process shares one.
+    global _parser
+    if _parser[0] != std:
+        _parser = (std, ParserFactory().create(std=std))
+    return _parser[1]
+
+
 class FortranAnalyserBase(ABC):
     """
     Base class for Fortran parse-tree analysers, e.g FortranAnalyser and X90Analyser.
@@ -78,6 +109,9 @@ class FortranAnalyserBase(ABC):
     """
     _intrinsic_modules = ['iso_fortran_env', 'iso_c_binding']
 
+    # the metrics group for the time and memory taken to parse each file
+    metric_name = 'analyse fortran'
+
     def __init__(self, result_class, std=None):
         """
         :param result_class:
@@ -87,65 +121,90 @@ class FortranAnalyserBase(ABC):
 
         """
         self.result_class = result_class
-        self.f2008_parser = ParserFactory().create(std=std or "f2008")
+        self.std = std or "f2008"
 
         # todo: this, and perhaps other runtime variables like it, might be better set at construction
         #       if we construct these objects at runtime instead...
         # runtime, for child processes to read
         self._config = None
 
+    @property
+    def analysis_key(self) -> str:
+        """
+        Identifies this analyser and its settings in the :class:`~fab.parse.analysis_db.AnalysisDB`.
+
+        """
+        return f'{self.__class__.__name__} {self.std}'
+
+    @property
+    def f2008_parser(self):
+        # The parser relies on fparser's class hierarchy being set up in the current process, so we don't keep it,
+        # or send it to other processes. See _get_parser.
+        return _get_parser(self.std)
+
     def run(self, fpath: Path) \
-            -> Union[Tuple[AnalysedDependent, Path], Tuple[EmptySourceFile, None], Tuple[Exception, None]]:
+            -> Union[Tuple[AnalysedDependent, Path], Tuple[EmptySourceFile, Path], Tuple[Exception, None]]:
         """
         Parse the source file and record what we're interested in (subclass specific).
 
         Reloads previous analysis results if available.
 
-        Returns the analysis data and the result file where it was stored/loaded.
+        Returns the analysis data and the database where it was stored/loaded.
 
         """
-        # calculate the prebuild filename
+        analysis_db = self._config.analysis_db
         file_hash = file_checksum(fpath).file_hash
-        analysis_fpath = self._get_analysis_fpath(fpath, file_hash)
 
         # do we already have analysis results for this file?
-        if analysis_fpath.exists():
+        stored = analysis_db.get(self.analysis_key, file_hash)
+        if stored:
             log_or_dot(logger, f"found analysis prebuild for {fpath}")
 
-            # Load the result file into whatever result class we use.
-            loaded_result = self.result_class.load(analysis_fpath)
-            if loaded_result:
-                # This result might have been created by another user; their prebuild folder copied to ours.
-                # If so, the fpath in the result will *not* point to the file we eventually want to compile,
-                # it will point to the user's original file, somewhere else. So replace it with our own path.
-                loaded_result.fpath = fpath
-                return loaded_result, analysis_fpath
+            # Load the result into whatever result class we use.
+            # This result might have been created from a copy of this file somewhere else, perhaps by another user.
+            # If so, the fpath in the result will *not* point to the file we eventually want to compile,
+            # it will point to the user's original file, somewhere else. So we give it our own path.
+            loaded_result = load_result(self.result_class, stored, fpath)
+            return loaded_result, analysis_db.fpath
+
+        # can we avoid parsing the file?
+        scanned = self.scan(fpath=fpath, file_hash=file_hash)
+        if scanned:
+            log_or_dot(logger, f"scanned {fpath}")
+            analysis_db.put(self.analysis_key, file_hash, scanned.to_bytes())
+            return scanned, analysis_db.fpath
 
         log_or_dot(logger, f"analysing {fpath}")
 
         # parse the file, get a node tree
-        node_tree = self._parse_file(fpath=fpath)
+        with Timer() as timer, PeakRSS() as memory:
+            node_tree = self._parse_file(fpath=fpath)
+        send_metric(
+            group=self.metric_name,
+            name=str(fpath),
+            value={'time_taken': timer.taken, 'start': timer.start, 'peak_rss': memory.peak})
         if isinstance(node_tree, Exception):
             return Exception(f"error parsing file '{fpath}':\n{node_tree}"), None
-        if node_tree.content[0] is None:
+        if not node_tree.content or node_tree.content[0] is None:
             logger.debug(f"  empty tree found when parsing {fpath}")
-            # todo: If we don't save the empty result we'll keep analysing it every time!
-            return EmptySourceFile(fpath), None
-
-        # find things in the node tree
-        analysed_file = self.walk_nodes(fpath=fpath, file_hash=file_hash, node_tree=node_tree)
+            empty_file = EmptySourceFile(fpath, file_hash=file_hash)
+            analysis_db.put(self.analysis_key, file_hash, empty_file.to_bytes())
+            return empty_file, analysis_db.fpath
 
-        analysis_fpath = self._get_analysis_fpath(fpath, file_hash)
-        analysed_file.save(analysis_fpath)
+        # find things in the node tree, then free it before the next file
+        try:
+            analysed_file = self.walk_nodes(fpath=fpath, file_hash=file_hash, node_tree=node_tree)
+        finally:
+            _dispose_tree(node_tree)
+            del node_tree
 
-        return analysed_file, analysis_fpath
+        analysis_db.put(self.analysis_key, file_hash, analysed_file.to_bytes())
 
-    def _get_analysis_fpath(self, fpath, file_hash) -> Path:
-        return Path(self._config.prebuild_folder / f'{fpath.stem}.{file_hash}.an')
+        return analysed_file, analysis_db.fpath
 
     def _parse_file(self, fpath):
         """Get a node tree from a fortran file."""
-        reader = FortranFileReader(str(fpath), ignore_comments=False)
+        reader = self._get_reader(fpath)
         reader.exit_on_error = False  # don't call sys.exit, it messes up the multi-processing
 
         try:
@@ -158,6 +217,26 @@ class FortranAnalyserBase(ABC):
         except Exception as err:
             logger.error(f"\nunhandled error '{type(err)}' in {fpath}\n{err}")
             return Exception(f"unhandled error '{type(err)}' in {fpath}\n{err}")
+        finally:
+            # The parser is reused, see _get_parser, and its symbol tables would keep every file's tree.
+            # We don't use them, and a syntax error can leave them in the scope of the failed file.
+            SYMBOL_TABLES.clear()
+
+    def _get_reader(self, fpath: Path):
+        """
+        The fparser reader for a file. Subclasses can override this to change the source before it's parsed.
+
+        """
+        return FortranFileReader(str(fpath), ignore_comments=False)
+
+    def scan(self, fpath: Path, file_hash: int) -> Optional[AnalysedDependent]:
+        """
+        Analyse the file without parsing it, if the subclass can.
+
+        Returns None if the file must be parsed.
+
+        """
+        return None
 
     @abstractmethod
     def walk_nodes(self, fpath, file_hash, node_tree) -> AnalysedDependent:
@@ -0,0 +1,369 @@
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+"""
+A fast, line based alternative to parsing Fortran with fparser, for dependency analysis.
+
+We only need a few kinds of statement to find a file's dependencies: *use*, *module*, *program*, *call*,
+*subroutine* and *function* statements, *bind(c)* declarations and "DEPENDS ON:" comments.
+The scanner finds these with regular expressions, giving the same :class:`~fab.parse.fortran.AnalysedFortran`
+as the fparser analysis, without building a parse tree.
+
+When the scanner sees something it can't handle confidently, such as fixed form source, an include statement,
+a submodule or PSyclone kernel metadata, it gives up and the file is parsed with fparser.
+The scanner doesn't check the syntax, so a broken file will be reported by the compiler instead.
+
+Use :func:`validate_scan` to compare the scanner with fparser across a whole project.
+
+"""
+import logging
+import re
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from fab.util import file_checksum
+
+logger = logging.getLogger(__name__)
+
+# the fields we compare when validating
+SCANNED_FIELDS = ['program_defs', 'module_defs', 'symbol_defs', 'module_deps', 'symbol_deps', 'mo_commented_file_deps']
+
+FREE_FORM_SUFFIXES = {'.f90', '.f95', '.f03', '.f08'}
+
+DEPENDS_ON = "DEPENDS ON:"
+
+# strings and comments, in a line of code
+_STRING_OR_COMMENT = re.compile(r"'[^']*'|\"[^\"]*\"|[!'\"]")
+# strings and statement separators
+_STRING_OR_SEMICOLON = re.compile(r"'[^']*'|\"[^\"]*\"|;")
+_LABEL = re.compile(r'\d+\s+')
+
+# an optional kind or length, e.g real(kind=8) or character(len=*)
+_KIND = r'(?:\s*\*\s*\d+)?(?:\s*\((?:[^()]|\([^()]*\))*\))?'
+_TYPE_SPEC = rf'(?:(?:integer|real|logical|complex|character|double\s*precision|double\s*complex){_KIND}' \
+             r'|(?:type|class)\s*\((?:[^()]|\([^()]*\))*\))'
+_PREFIX = rf'(?:(?:(?:recursive|pure|elemental|impure|non_recursive|module)\b|{_TYPE_SPEC})\s*)*'
+
+_USE = re.compile(r'use(?:\s*,\s*(?:intrinsic|non_intrinsic))?(?:\s*::\s*|\s+)([a-z]\w*)\s*(?:,.*)?$')
+_MODULE = re.compile(r'module\s+([a-z]\w*)$')
+_PROGRAM = re.compile(r'program\s+([a-z]\w*)$')
+_SUBPROGRAM = re.compile(rf'{_PREFIX}(subroutine|function)\s+([a-z]\w*)\s*(\(.*)?$')
+_BIND = re.compile(r'bind\s*\(\s*c\s*(?:,\s*name\s*=\s*(\'[^\']*\'|"[^"]*"))?\s*\)')
+_BOUND_DECLARATION = re.compile(rf'{_TYPE_SPEC}\s*,(.*\bbind\s*\(.*?)::(.*)$')
+_CALL = re.compile(r'call\s+([a-z]\w*)\s*(\(.*)?$')
+_INTERFACE = re.compile(r'(?:abstract\s+)?interface\b(?!\s*=)')
+_END = re.compile(r'end\s*([a-z]*)')
+_NOT_END = re.compile(r'end\w*\s*[=(%]')
+_UNSURE = re.compile(r'include\s*[\'"]|submodule\b|block\s*data\b|type\b.*\bextends\s*\(\s*kernel_type\s*\)')
+
+# for find_definitions()
+_UNIT_NAME = re.compile(r'\b(?:module|program|subroutine|function)\s+([a-z]\w*)')
+_BIND_LINE = re.compile(r'^.*\bbind\s*\(\s*c\b.*$', re.MULTILINE)
+_BIND_NAME = re.compile(r'name\s*=\s*(?:\'([^\']*)\'|"([^"]*)")')
+_WORD = re.compile(r'[a-z]\w*')
+
+# blocks which are closed by a bare end statement
+_PROGRAM_UNITS = {'module', 'program', 'subroutine', 'function'}
+
+
+class ScanUnsure(Exception):
+    """
+    The scanner found something it can't handle confidently.
+
+    """
+
+
+def scan_fortran(fpath: Path, text: str, file_hash: int,
+                 ignore_mod_deps: Iterable[str] = (), intrinsic_modules: Iterable[str] = ()):
+    """
+    Find the definitions and dependencies in free form Fortran source.
+
+    Returns an :class:`~fab.parse.fortran.AnalysedFortran`.
+    Raises :class:`ScanUnsure` if the source should be parsed with fparser instead.
+
+    :param fpath:
+        The source file.
+    :param text:
+        The contents of the source file.
+    :param file_hash:
+        The checksum of the source file.
+    :param ignore_mod_deps:
+        Module names to ignore in use statements.
+    :param intrinsic_modules:
+        Module names which aren't dependencies.
+
+    """
+    # avoid a circular import
+    from fab.parse.fortran import AnalysedFortran
+
+    if fpath.suffix.lower() not in FREE_FORM_SUFFIXES:
+        raise ScanUnsure('not free form source')
+
+    analysed_file = AnalysedFortran(fpath=fpath, file_hash=file_hash)
+    intrinsic_modules = set(intrinsic_modules)
+    blocks: List[str] = []
+    found_statement = False
+
+    for stmt, comment in _statements(text):
+        if comment and DEPENDS_ON in comment:
+            dep = comment.split(DEPENDS_ON)[-1].strip()
+            # with .o means a c file
+            if dep.endswith(".o"):
+                analysed_file.add_mo_commented_file_dep(dep.replace(".o", ".c"))
+            # without .o means a fortran symbol
+            else:
+                analysed_file.add_symbol_dep(dep)
+        if not stmt:
+            continue
+        found_statement = True
+
+        # Names are lower case in the results, except for ignored modules, so we match the lower case statement
+        # and take names from the original.
+        lower = stmt.lower()
+        if len(lower) != len(stmt):
+            raise ScanUnsure('unusual characters')
+
+        if _UNSURE.match(lower):
+            raise ScanUnsure(f"can't scan '{stmt}'")
+
+        elif lower.startswith('end') and not _NOT_END.match(lower):
+            _end_block(blocks, _END.match(lower).group(1))  # type: ignore
+
+        elif lower.startswith('use'):
+            match = _USE.match(lower)
+            if match:
+                use_name = stmt[match.start(1):match.end(1)]
+                if use_name in ignore_mod_deps:
+                    logger.debug(f"ignoring use of {use_name}")
+                elif use_name.lower() not in intrinsic_modules:
+                    analysed_file.add_module_dep(use_name)
+
+        elif lower.startswith('call'):
+            match = _CALL.match(lower)
+            # calls like thing(1)%method() don't reveal a dependency on an external subroutine
+            if match and not _is_component(match.group(2)):
+                analysed_file.add_symbol_dep(match.group(1))
+
+        elif lower.startswith('module') and _MODULE.match(lower):
+            analysed_file.add_module_def(_MODULE.match(lower).group(1))  # type: ignore
+            blocks.append('module')
+
+        elif lower.startswith('program') and _PROGRAM.match(lower):
+            analysed_file.add_program_def(_PROGRAM.match(lower).group(1))  # type: ignore
+            blocks.append('program')
+
+        elif _INTERFACE.match(lower):
+            blocks.append('interface')
+
+        elif 'subroutine' in lower or 'function' in lower:
+            match = _SUBPROGRAM.match(lower)
+            if match:
+                _subprogram(analysed_file, blocks, kind=match.group(1), name=match.group(2), rest=match.group(3))
+
+        if 'bind' in lower:
+            match = _BOUND_DECLARATION.match(lower)
+            if match:
+                _bound_variables(analysed_file, match.group(2))
+
+    if blocks:
+        raise ScanUnsure(f'unclosed {blocks[-1]}')
+    if not found_statement:
+        # let fparser decide what an empty file is
+        raise ScanUnsure('no statements')
+
+    return analysed_file
+
+
+def _statements(text: str) -> Iterator[Tuple[str, str]]:
+    # Yield each statement with its comment, joining continuation lines and splitting at semicolons.
+    # A comment in a continued statement is yielded on its own.
+    pending = ''
+    for line in text.splitlines():
+        if line.lstrip().startswith('#'):
+            raise ScanUnsure('preprocessor directive')
+
+        code, comment = _split_comment(line)
+        code = code.strip()
+
+        if pending:
+            if not code:
+                if comment:
+                    yield '', comment
+                continue
+            if code.startswith('&'):
+                code = code[1:].lstrip()
+            code = pending + code
+            pending = ''
+
+        if code.endswith('&'):
+            pending = code[:-1].rstrip() + ' '
+            if comment:
+                yield '', comment
+            continue
+
+        if ';' in code:
+            parts = _split_statements(code)
+            for part in parts[:-1]:
+                yield part, ''
+            code = parts[-1]
+
+        yield _LABEL.sub('', code, count=1) if code[:1].isdigit() else code, comment
+
+    if pending:
+        raise ScanUnsure('unfinished continuation')
+
+
+def _split_comment(line: str) -> Tuple[str, str]:
+    if '!' not in line and "'" not in line and '"' not in line:
+        return line, ''
+    for match in _STRING_OR_COMMENT.finditer(line):
+        token = match.group()
+        if token == '!':
+            return line[:match.start()], line[match.start():]
+        if len(token) == 1:
+            raise ScanUnsure('string continues onto the next line')
+    return line, ''
+
+
+def _split_statements(code: str) -> List[str]:
+    parts = []
+    start = 0
+    for match in _STRING_OR_SEMICOLON.finditer(code):
+        if match.group() == ';':
+            parts.append(code[start:match.start()].strip())
+            start = match.end()
+    parts.append(code[start:].strip())
+    return [_LABEL.sub('', part, count=1) for part in parts]
+
+
+def _is_component(args: Optional[str]) -> bool:
+    # Does the text after a name, starting with its arguments, continue with a component?
+    if not args:
+        return False
+    depth = 0
+    for pos, char in enumerate(args):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if not depth:
+                return args[pos + 1:].lstrip().startswith('%')
+    raise ScanUnsure('unbalanced brackets')
+
+
+def _end_block(blocks: List[str], kind: str):
+    if kind in _PROGRAM_UNITS or kind == 'interface':
+        if not blocks or blocks[-1] != kind:
+            raise ScanUnsure(f'unexpected end {kind}')
+        blocks.pop()
+    elif not kind:
+        # A bare end closes a program unit or subprogram, or a main program without a program statement.
+        if blocks and blocks[-1] not in _PROGRAM_UNITS:
+            raise ScanUnsure('unexpected end')
+        if blocks:
+            blocks.pop()
+    # otherwise it's the end of a construct we don't track, e.g. end do
+
+
+def _subprogram(analysed_file, blocks: List[str], kind: str, name: str, rest: Optional[str]):
+    blocks.append(kind)
+    in_interface = 'interface' in blocks[:-1]
+
+    bind = _BIND.search(rest or '')
+    if bind:
+        bind_name = bind.group(1).replace('"', '') if bind.group(1) else name
+
+        # importing a c function into fortran, i.e binding within an interface block
+        if in_interface:
+            logger.debug(f"found function binding import '{bind_name}'")
+            analysed_file.add_symbol_dep(bind_name)
+
+        # exporting from fortran to c, i.e binding without an interface block
+        else:
+            analysed_file.add_symbol_def(bind_name)
+
+    # not bound, just record the presence of the fortran symbol
+    # we don't need to record stuff in modules (we think!)
+    elif 'module' not in blocks[:-1] and not in_interface:
+        analysed_file.add_symbol_def(name)
+
+
+def _bound_variables(analysed_file, entities: str):
+    # remove array bounds and initialisation expressions
+    if "'" in entities or '"' in entities:
+        raise ScanUnsure('string in bound variable declaration')
+    while '(' in entities:
+        stripped = re.sub(r'\([^()]*\)', '', entities)
+        if stripped == entities:
+            raise ScanUnsure('unbalanced brackets')
+        entities = stripped
+
+    for entity in entities.split(','):
+        match = re.match(r'\s*([a-z]\w*)', entity)
+        if not match:
+            raise ScanUnsure(f"can't read bound variable '{entity}'")
+        analysed_file.add_symbol_def(match.group(1))
+
+
+def find_definitions(text: str) -> Set[str]:
+    """
+    Find every symbol which a Fortran file might define, much more quickly than scanning it.
+
+    This is an over-estimate: the names of all modules, programs and procedures, whether or not they're inside
+    a module, every word on a line with a bind(c) attribute, and the names they're bound to.
+    A file which doesn't define any of these names doesn't need analysing to find a symbol.
+
+    :param text:
+        The contents of the source file.
+
+    """
+    text = text.lower()
+    definitions = set(_UNIT_NAME.findall(text))
+    for line in _BIND_LINE.findall(text):
+        definitions.update(_WORD.findall(line))
+        definitions.update(single or double for single, double in _BIND_NAME.findall(line))
+    definitions.discard('')
+    return definitions
+
+
+def validate_scan(analysed_files: Iterable, ignore_mod_deps: Iterable[str] = (),
+                  intrinsic_modules: Iterable[str] = ()) -> Dict[Path, Dict[str, Tuple[Set[str], Set[str]]]]:
+    """
+    Scan files which were analysed by fparser, and report any differences.
+
+    Returns the differences for each file, as a dict of field name to the values only found by fparser,
+    and the values only found by the scanner. Files the scanner can't handle are not included.
+
+    :param analysed_files:
+        :class:`~fab.parse.fortran.AnalysedFortran` results from fparser.
+    :param ignore_mod_deps:
+        As given to the analyser.
+    :param intrinsic_modules:
+        As used by the analyser.
+
+    """
+    differences: Dict[Path, Dict[str, Tuple[Set[str], Set[str]]]] = {}
+    num_scanned = 0
+    for expected in analysed_files:
+        try:
+            scanned = scan_fortran(
+                expected.fpath, expected.fpath.read_text(errors='replace'), file_checksum(expected.fpath).file_hash,
+                ignore_mod_deps=ignore_mod_deps, intrinsic_modules=intrinsic_modules)
+        except ScanUnsure as err:
+            logger.debug(f'scanner would use fparser for {expected.fpath}: {err}')
+            continue
+        num_scanned += 1
+
+        diff = {}
+        for field in SCANNED_FIELDS:
+            want, got = getattr(expected, field), getattr(scanned, field)
+            if want != got:
+                diff[field] = (want - got, got - want)
+        if diff:
+            logger.warning(f'scanner disagrees with fparser for {expected.fpath}: {diff}')
+            differences[expected.fpath] = diff
+
+    logger.info(f'scanned {num_scanned} files, {len(differences)} differ from fparser')
+    return differences
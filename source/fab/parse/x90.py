@@ -3,12 +3,14 @@
 #  For further details please refer to the file COPYRIGHT
 #  which you should have received as part of this distribution
 # ##############################################################################
+import re
 from pathlib import Path
-from typing import Iterable, Set, Union, Optional, Dict, Any
+from typing import AbstractSet, Iterable, Union, Optional, Dict, Any
 
+from fparser.common.readfortran import FortranStringReader  # type: ignore
 from fparser.two.Fortran2003 import Use_Stmt, Call_Stmt, Name, Only_List, Actual_Arg_Spec_List, Part_Ref  # type: ignore
 
-from fab.parse import AnalysedFile
+from fab.parse import AnalysedFile, NAMES, _freeze_symbols
 from fab.parse.fortran_common import FortranAnalyserBase, iter_content, logger, _typed_child
 from fab.util import by_type
 
@@ -18,6 +20,9 @@ class AnalysedX90(AnalysedFile):
     Analysis results for an x90 file.
 
     """
+    __slots__ = ('kernel_deps',)
+    _binary_fields = {1: (('kernel_deps', NAMES),)}
+
     def __init__(self, fpath: Union[str, Path], file_hash: int,
                  # todo: the fortran version doesn't include the remaining args - update this too, for simplicity.
                  kernel_deps: Optional[Iterable[str]] = None):
@@ -33,7 +38,10 @@ class AnalysedX90(AnalysedFile):
         super().__init__(fpath=fpath, file_hash=file_hash)
 
         # Maps used kernel metadata (type def names) to the modules they're found in
-        self.kernel_deps: Set[str] = set(kernel_deps or {})
+        self.kernel_deps: AbstractSet[str] = set(kernel_deps or {})
+
+    def freeze(self):
+        self.kernel_deps = _freeze_symbols(self.kernel_deps)
 
     def to_dict(self) -> Dict[str, Any]:
         result = super().to_dict()
@@ -59,14 +67,72 @@ class AnalysedX90(AnalysedFile):
         ]
 
 
+# regex to convert an x90 into parsable fortran, so it can be analysed using a third party tool
+
+WHITE = r'[\s&]+'
+OPT_WHITE = r'[\s&]*'
+
+SQ_STRING = "'[^']*'"
+DQ_STRING = '"[^"]*"'
+STRING = f'({SQ_STRING}|{DQ_STRING})'
+
+NAME_KEYWORD = 'name' + OPT_WHITE + '=' + OPT_WHITE + STRING + OPT_WHITE + ',' + OPT_WHITE
+NAMED_INVOKE = 'call' + WHITE + 'invoke' + OPT_WHITE + r'\(' + OPT_WHITE + NAME_KEYWORD
+
+_x90_compliance_pattern = re.compile(pattern=NAMED_INVOKE)
+
+
+# todo: In the future, we'd like to extend fparser to handle the leading invoke keywords. (Lots of effort.)
+def make_parsable_x90_source(src: str) -> str:
+    """
+    Take out the leading name keyword in calls to invoke(), making parsable fortran from x90 source.
+
+    If present it looks like this::
+
+        call invoke( name = "compute_dry_mass", ...
+
+    :param src:
+        The x90 source.
+
+    """
+    # Before we remove the name keywords to invoke, we must remove any comment lines.
+    # This is the simplest way to avoid producing bad fortran when the name keyword is followed by a comment line.
+    # I.e. The comment line doesn't have an "&", so we get "call invoke(!" with no "&", which is a syntax error.
+    src_lines = src.splitlines(keepends=True)
+    no_comment_lines = [line for line in src_lines if not line.lstrip().startswith('!')]
+    src = ''.join(no_comment_lines)
+
+    replaced = []
+
+    def repl(matchobj):
+        # matchobj[0] contains the entire matching string, from "call" to the "," after the name keyword.
+        # matchobj[1] contains the single group in the search pattern, which is defined in STRING.
+        name = matchobj[1].replace('"', '').replace("'", "")
+        replaced.append(name)
+        return 'call invoke('
+
+    out = _x90_compliance_pattern.sub(repl=repl, string=src)
+    logger.debug(f'names removed: {replaced}')
+
+    return out
+
+
 class X90Analyser(FortranAnalyserBase):
+    """
+    Finds the kernels used by an x90 file.
+
+    The x90 is made parsable in memory, and the result is stored against the hash of the original x90,
+    so an unchanged x90 isn't converted or parsed again.
 
-    # Makes a parsable fortran version of x90.
-    # todo: Use hashing to reuse previous analysis results.
+    """
+    metric_name = 'analyse x90'
 
     def __init__(self):
         super().__init__(result_class=AnalysedX90)
 
+    def _get_reader(self, fpath: Path):
+        return FortranStringReader(make_parsable_x90_source(fpath.read_text()), ignore_comments=False)
+
     def walk_nodes(self, fpath, file_hash, node_tree) -> AnalysedX90:  # type: ignore
 
         analysed_file = AnalysedX90(fpath=fpath, file_hash=file_hash)
@@ -84,10 +150,6 @@ class X90Analyser(FortranAnalyserBase):
             except Exception:
                 logger.exception(f'error processing node {obj.item or obj_type} in {fpath}')
 
-        # save results for reuse
-        # analysis_fpath = self._get_analysis_fpath(fpath, file_hash)
-        # analysed_file.save(analysis_fpath)
-
         return analysed_file
 
     def _process_use_statement(self, symbol_deps: Dict[str, str], obj):
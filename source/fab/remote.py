@@ -0,0 +1,250 @@
+##############################################################################
+# (c) Crown copyright Met Office. All rights reserved.
+# For further details please refer to the file COPYRIGHT
+# which you should have received as part of this distribution
+##############################################################################
+"""
+Run work on other machines which share our filesystem.
+
+Each build node runs a worker daemon, with the `fab-worker` command or :func:`serve`.
+The build script creates a :class:`RemoteExecutor` connected to the workers, and passes it to the
+:class:`~fab.build_config.BuildConfig`. Steps which only read and write files in the workspace,
+such as compilation, then send their work items to the workers instead of the local worker pool.
+
+The workers must see the workspace at the same path as the build script, and have the same Fab installed.
+Work is pickled, so only run workers on a trusted network. Connections are authenticated with a shared key,
+from the `FAB_WORKER_AUTHKEY` environment variable by default.
+
+"""
+import logging
+import os
+import queue
+import threading
+from argparse import ArgumentParser
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from multiprocessing import cpu_count
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Iterable, List, Optional, Tuple, Union
+
+import fab.metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PORT = 8749
+
+Address = Tuple[str, int]
+
+
+def get_authkey(authkey: Optional[bytes] = None) -> bytes:
+    """
+    Return the given key, or read it from the `FAB_WORKER_AUTHKEY` environment variable.
+
+    """
+    authkey = authkey or os.getenv('FAB_WORKER_AUTHKEY', '').encode()
+    if not authkey:
+        raise ValueError('No worker authkey given, and FAB_WORKER_AUTHKEY is not set')
+    return authkey
+
+
+def parse_address(address: Union[str, Address]) -> Address:
+    """
+    Turn a `host[:port]` string into an address tuple. Tuples are returned unchanged.
+
+    """
+    if isinstance(address, tuple):
+        return address
+    host, _, port = address.partition(':')
+    return host, int(port) if port else DEFAULT_PORT
+
+
+class _MetricCollector(threading.local):
+    # Stands in for the metrics pipe in a worker daemon. Each thread keeps the metrics from its current
+    # work item, which are returned with the result to be sent from the build script's process.
+    def __init__(self):
+        self.metrics: List = []
+
+    def send(self, metric):
+        self.metrics.append(metric)
+
+    def take(self) -> List:
+        metrics, self.metrics = self.metrics, []
+        return metrics
+
+
+def serve(address: Address, authkey: bytes, n_procs: int, ready=None):
+    """
+    Run a worker daemon, processing work items from :class:`RemoteExecutor` clients until stopped.
+
+    Each client connection is served in its own thread. Work items usually spend their time
+    waiting for a compiler, so threads let them run in parallel.
+    This replaces the metrics pipe in this process, so metrics sent by work items are returned to the client.
+
+    :param address:
+        The host and port to listen on.
+    :param authkey:
+        The key clients must present.
+    :param n_procs:
+        How many work items we tell clients to send us at once.
+    :param ready:
+        Optional event to set once we're listening, for tests.
+
+    """
+    collector = _MetricCollector()
+    fab.metrics._metric_send_conn = collector  # type: ignore
+
+    with Listener(address, authkey=authkey) as listener:
+        logger.info(f'fab worker listening on {listener.address} with n_procs = {n_procs}')
+        if ready:
+            ready.set()
+        while True:
+            try:
+                conn = listener.accept()
+            except (OSError, EOFError) as err:
+                # including failed authentication
+                logger.warning(f'fab worker rejected a connection: {err}')
+                continue
+            threading.Thread(target=_serve_client, args=(conn, n_procs, collector), daemon=True).start()
+
+
+def _serve_client(conn: Connection, n_procs: int, collector: _MetricCollector):
+    with conn:
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                return
+
+            if message == 'n_procs':
+                conn.send(n_procs)
+                continue
+
+            # we tell the client whether the function raised its result
+            func, item = message
+            try:
+                result, raised = func(item), False
+            except Exception as err:
+                result, raised = err, True
+            metrics = collector.take()
+
+            try:
+                conn.send((result, raised, metrics))
+            except Exception as err:
+                # perhaps the result can't be pickled
+                conn.send((RuntimeError(f'fab worker could not return result: {err}'), True, metrics))
+
+
+class _Slot(object):
+    # One connection to a worker, which processes one work item at a time.
+    # A broken connection is reopened for the next item.
+    def __init__(self, address: Address, authkey: bytes):
+        self.address = address
+        self.authkey = authkey
+        self.conn: Optional[Connection] = None
+
+    def connect(self) -> Connection:
+        if self.conn is None:
+            self.conn = Client(self.address, authkey=self.authkey)
+        return self.conn
+
+    def run(self, func, item):
+        try:
+            conn = self.connect()
+            conn.send((func, item))
+            result, raised, metrics = conn.recv()
+        except (EOFError, OSError) as err:
+            self.close()
+            raise ConnectionError(f'lost connection to fab worker {self.address}: {err}')
+
+        for metric in metrics:
+            fab.metrics.send_metric(*metric)
+        if raised:
+            raise result
+        return result
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class RemoteExecutor(Executor):
+    """
+    An executor which sends work items to worker daemons, see :func:`serve`.
+
+    It's pluggable into the :class:`~fab.build_config.BuildConfig` as the `remote_executor`.
+    Each worker runs as many items at once as its n_procs. Functions and items are pickled, so they must be
+    importable by the workers, and any files they use must be on the shared filesystem.
+
+    A function which raises an exception on the worker raises it from the future's result, as with any executor.
+    If a worker becomes unreachable, its items raise a :class:`ConnectionError`.
+
+    """
+    def __init__(self, workers: Iterable[Union[str, Address]], authkey: Optional[bytes] = None):
+        """
+        :param workers:
+            The addresses of the worker daemons, as `host[:port]` strings or (host, port) tuples.
+        :param authkey:
+            The key the workers were started with. Defaults to the `FAB_WORKER_AUTHKEY` environment variable.
+
+        """
+        authkey = get_authkey(authkey)
+
+        # ask each worker how many items it can run at once
+        self._idle: queue.Queue = queue.Queue()
+        for address in map(parse_address, workers):
+            slot = _Slot(address, authkey)
+            conn = slot.connect()
+            conn.send('n_procs')
+            n_procs = conn.recv()
+            logger.info(f'fab worker {address} has n_procs = {n_procs}')
+
+            self._idle.put(slot)
+            for _ in range(n_procs - 1):
+                self._idle.put(_Slot(address, authkey))
+
+        self.max_workers = self._idle.qsize()
+        if not self.max_workers:
+            raise ValueError('no fab workers given')
+
+        # A thread waits on each slot, so one is always idle when a thread starts an item.
+        self._threads = ThreadPoolExecutor(self.max_workers)
+
+    def submit(self, __fn, *args, **kwargs) -> Future:
+        # we send the function and a single item, as used by run_mp
+        if len(args) != 1 or kwargs:
+            raise ValueError('RemoteExecutor functions must take a single item')
+        return self._threads.submit(self._run, __fn, args[0])
+
+    def _run(self, func, item):
+        slot = self._idle.get()
+        try:
+            return slot.run(func, item)
+        finally:
+            self._idle.put(slot)
+
+    def shutdown(self, wait=True, **kwargs):
+        self._threads.shutdown(wait=wait)
+        while not self._idle.empty():
+            self._idle.get().close()
+
+
+def cli_worker():
+    """
+    Run a worker daemon from the command line, serving work to build scripts on other machines.
+
+    """
+    try:
+        n_procs = len(os.sched_getaffinity(0))
+    except AttributeError:
+        # not available on macOS
+        n_procs = cpu_count()
+
+    arg_parser = ArgumentParser(description='Process Fab work items sent from other machines.')
+    arg_parser.add_argument('--host', default='0.0.0.0', help='The interface to listen on.')
+    arg_parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    arg_parser.add_argument('--n-procs', type=int, default=n_procs,
+                            help='How many work items to run at once. Defaults to the number of available cores.')
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    serve((args.host, args.port), authkey=get_authkey(), n_procs=args.n_procs)
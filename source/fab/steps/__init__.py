@@ -7,30 +7,236 @@
 Predefined build steps with sensible defaults.
 
 """
-import multiprocessing
+import heapq
+import logging
+import os
+import pickle
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Set, Tuple
+from uuid import uuid4
 
-from fab.metrics import send_metric
-from fab.util import by_type, TimerLogger
+from fab.journal import get_journal, step_key
+from fab.metrics import carry_forward_metrics, send_metric
+from fab.util import by_type, process_memory, process_peak_rss, TimerLogger
 from functools import wraps
 
+logger = logging.getLogger(__name__)
+
 
 def step(func):
-    """Function decorator for steps."""
+    """
+    Function decorator for steps.
+
+    If the config has a :class:`~fab.journal.StepJournal`, a step which completed in an interrupted run
+    is skipped, and its artefacts restored. Otherwise, the completed step is added to the journal.
+
+    """
     @wraps(func)
     def wrapper(*args, **kwargs):
 
         name = func.__name__
 
+        # steps run by other steps are part of the outer step's journal entry
+        config = args[0] if args else kwargs.get('config')
+        journal = get_journal(config)
+        if journal and not journal.depth:
+            step_args = (args[1:], {k: v for k, v in kwargs.items() if k != 'config'})
+            key = step_key(name, step_args, config._artefact_store)
+            if journal.restore(key, config._artefact_store):
+                logger.info(f'{name} completed in a previous run, restored from the journal')
+                return
+        else:
+            journal = None
+
         # call the function
         with TimerLogger(name) as step:
-            func(*args, **kwargs)
+            if journal:
+                journal.depth += 1
+            try:
+                func(*args, **kwargs)
+            finally:
+                if journal:
+                    journal.depth -= 1
 
         send_metric('steps', name, step.taken)
 
+        if journal:
+            journal.record(name, key, config._artefact_store)
+
     return wrapper
 
 
-def run_mp(config, items, func, no_multiprocessing: bool = False):
+# The tokens of the worker initialisers which have already run in this process. See :class:`WorkerInit`.
+_worker_initialised: Set[str] = set()
+
+
+class WorkerInit(object):
+    """
+    Wraps a function so that an initialiser runs once in each worker process, before it processes its first item.
+
+    This lets a step set up per-process state in the long-lived worker pool, for example an expensive object
+    which we don't want to create, or send to the worker, for every item.
+    Each instance has its own token, so the initialiser runs again for each call to :func:`run_mp`.
+
+    """
+    def __init__(self, func, initialiser, initargs=()):
+        """
+        :param func:
+            A function to process a single item.
+        :param initialiser:
+            Called once in each worker process before the first item is processed.
+        :param initargs:
+            Arguments for the initialiser.
+
+        """
+        self.func = func
+        self.initialiser = initialiser
+        self.initargs = initargs
+        self.token = uuid4().hex
+
+    def __call__(self, item):
+        if self.token not in _worker_initialised:
+            self.initialiser(*self.initargs)
+            _worker_initialised.add(self.token)
+        return self.func(item)
+
+
+# The objects shared with this process by :class:`PerWorker`, by token.
+_per_worker: Dict[str, Any] = {}
+_per_worker_lock = threading.Lock()
+_PER_WORKER_LIMIT = 8
+
+
+class PerWorker(object):
+    """
+    Wraps a function so it's sent to each worker process once, instead of with every item.
+
+    Pickling a PerWorker only sends a token. The first time it's pickled, the function is written to a file
+    in the project workspace, and each worker loads it from there when it processes its first item,
+    keeping it for the rest of the step. Remote workers share the workspace, so they can load it too.
+    Forked workers which already have it don't need the file.
+
+    This saves us pickling a large function, such as an analyser holding the config, for every item,
+    and lets the function keep expensive state, such as a parser, between items.
+    Use it as a context manager, which removes the file when the step is done.
+
+    """
+    def __init__(self, func, config):
+        """
+        :param func:
+            A function to process a single item. Must be picklable.
+        :param config:
+            The :class:`~fab.build_config.BuildConfig`, for the project workspace.
+
+        """
+        self.token = uuid4().hex
+        self._workspace = config.project_workspace
+        self._written = False
+        _per_worker[self.token] = func
+
+    def __getstate__(self):
+        with _per_worker_lock:
+            if not self._written:
+                self.fpath.parent.mkdir(parents=True, exist_ok=True)
+                with open(self.fpath, 'wb') as outfile:
+                    pickle.dump(_per_worker[self.token], outfile)
+                self._written = True
+        return {'token': self.token, '_workspace': self._workspace}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._written = True
+
+    def __call__(self, item):
+        func = _per_worker.get(self.token)
+        if func is None:
+            with _per_worker_lock:
+                if self.token not in _per_worker:
+                    with open(self.fpath, 'rb') as infile:
+                        _per_worker[self.token] = pickle.load(infile)
+                    # forget the oldest, which are probably from earlier steps
+                    while len(_per_worker) > _PER_WORKER_LIMIT:
+                        del _per_worker[next(iter(_per_worker))]
+                func = _per_worker[self.token]
+        return func(item)
+
+    @property
+    def fpath(self) -> Path:
+        return self._workspace / 'per_worker' / f'{self.token}.pkl'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Forget the function in this process and remove its file. Workers which loaded it keep their copy.
+
+        """
+        _per_worker.pop(self.token, None)
+        if self._written:
+            self.fpath.unlink()
+
+
+class _Indexed(object):
+    # Wraps a function to take and return the index of each item, so results can arrive in any order.
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, indexed_item):
+        index, item = indexed_item
+        return index, self.func(item)
+
+
+# The peak resident memory of this worker process, as last put in the metrics. See :class:`_WorkerMemory`.
+_worker_peak_rss = 0
+
+
+class _WorkerMemory(object):
+    # Wraps a function run in the worker pool, returning its result with the worker's pid and resident memory,
+    # so the config can replace workers which have grown too large. See BuildConfig.recycle_workers.
+    # The peak memory of each worker process goes in the metrics, to help choose the config's worker limits.
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, item):
+        global _worker_peak_rss
+        try:
+            return self.func(item), os.getpid(), process_memory().get('VmRSS', 0)
+        finally:
+            peak_rss = process_peak_rss()
+            if peak_rss > _worker_peak_rss:
+                _worker_peak_rss = peak_rss
+                send_metric('worker memory', str(os.getpid()), {'peak_rss': peak_rss})
+
+
+def _worker_result(config, wrapped):
+    # Record the memory of the worker which returned a result from _WorkerMemory, and return the result.
+    result, pid, rss = wrapped
+    config._worker_rss[pid] = rss
+    return result
+
+
+def is_error(result) -> bool:
+    """
+    Is this result from a multiprocessing function an error?
+
+    By convention, a function which fails returns an exception, either alone or first in a tuple.
+
+    """
+    if isinstance(result, tuple) and result:
+        result = result[0]
+    return isinstance(result, Exception)
+
+
+def run_mp(config, items, func, no_multiprocessing: bool = False, initialiser=None, initargs=(),
+           stop_on_error: bool = False, memory=None, uses_tools: bool = False, remote: bool = False):
     """
     Called from Step.run() to process multiple items in parallel.
 
@@ -38,24 +244,98 @@ def run_mp(config, items, func, no_multiprocessing: bool = False):
     It could then pass those paths to this method, along with a function to compile a *single* file.
     The whole set of results are returned in a list-like, with undefined order.
 
+    The work is done in the config's worker :attr:`~fab.build_config.BuildConfig.pool`,
+    which is shared by all steps.
+
     :param items:
         An iterable of items to process in parallel.
     :param func:
         A function to process a single item. Must accept a single argument.
     :param no_multiprocessing:
         Overrides the config's multiprocessing flag, disabling multiprocessing for this call.
+    :param initialiser:
+        Optional function to call once in each worker process, before it processes its first item.
+    :param initargs:
+        Arguments for the initialiser.
+    :param stop_on_error:
+        Set this when the caller checks the results for errors, see :func:`is_error`.
+        If the config is set to fail fast, we start no more work as soon as an error arrives,
+        wait for the running items, and return the results so far, including the error.
+        Otherwise, every item is processed.
+    :param memory:
+        Optional function returning the estimated peak memory for an item, in bytes.
+        If the config has a memory budget, items only start when their estimates fit in the budget.
+        See :func:`get_memory_estimates`.
+    :param uses_tools:
+        Set this when the function spends its time waiting for a command line tool, such as a compiler.
+        If the config uses tool threads, the items are processed in threads of this process instead of the pool.
+    :param remote:
+        Set this when the function only needs the files in the project workspace, so it can run on another machine.
+        If the config has a remote executor, the items are processed there instead of the pool.
 
     """
+    if initialiser:
+        func = WorkerInit(func, initialiser, initargs)
+
+    fail_fast = stop_on_error and config.fail_fast
     if config.multiprocessing and not no_multiprocessing:
-        with multiprocessing.Pool(config.n_procs) as p:
-            results = p.map(func, items)
+        # the workers can only be replaced part way through if we decide when each item starts
+        if fail_fast or (memory and config.memory_budget) or config.worker_max_rss:
+            results = _run_mp_scheduled(
+                config, items, func, fail_fast=fail_fast, memory=memory, uses_tools=uses_tools, remote=remote)
+        elif remote and config.remote_executor:
+            results = list(config.remote_executor.map(func, items))
+        elif uses_tools and config.tool_threads:
+            with ThreadPoolExecutor(config.n_procs) as threads:
+                results = list(threads.map(func, items))
+        else:
+            config.recycle_workers()
+            results = [_worker_result(config, result) for result in config.pool.map(_WorkerMemory(func), items)]
     else:
-        results = [func(f) for f in items]
+        results = []
+        for item in items:
+            results.append(func(item))
+            if fail_fast and is_error(results[-1]):
+                break
+
+    return results
+
+
+class _FailFast(Exception):
+    pass
+
+
+def _run_mp_scheduled(config, items, func, fail_fast: bool, memory=None, uses_tools: bool = False,
+                      remote: bool = False) -> List:
+    # Like pool.map, but we decide when each item starts, so we can stay in the memory budget,
+    # or stop at the first error and return the results received so far.
+    items = list(items)
+    results: List = [None] * len(items)
+    received: List = []
+
+    def handle_result(_, indexed_result):
+        # a function which raises an exception is an error, like pool.map
+        if isinstance(indexed_result, Exception):
+            raise indexed_result
+        index, result = indexed_result
+        results[index] = result
+        received.append(result)
+        if fail_fast and is_error(result):
+            raise _FailFast()
+        return []
+
+    try:
+        run_mp_dynamic(
+            config, items=enumerate(items), func=_Indexed(func), result_handler=handle_result,
+            memory=(lambda indexed_item: memory(indexed_item[1])) if memory else None, uses_tools=uses_tools,
+            remote=remote)
+    except _FailFast:
+        return received
 
     return results
 
 
-def run_mp_imap(config, items, func, result_handler):
+def run_mp_imap(config, items, func, result_handler, initialiser=None, initargs=()):
     """
     Like run_mp, but uses imap instead of map so that we can process each result as it happens.
 
@@ -68,17 +348,179 @@ def run_mp_imap(config, items, func, result_handler):
         A function to process a single item. Must accept a single argument.
     :param result_handler:
         A function to handle a single result. Must accept a single argument.
+    :param initialiser:
+        Optional function to call once in each worker process, before it processes its first item.
+    :param initargs:
+        Arguments for the initialiser.
 
     """
+    if initialiser:
+        func = WorkerInit(func, initialiser, initargs)
+
     if config.multiprocessing:
-        with multiprocessing.Pool(config.n_procs) as p:
-            analysis_results = p.imap_unordered(func, items)
-            result_handler(analysis_results)
+        config.recycle_workers()
+        analysis_results = config.pool.imap_unordered(_WorkerMemory(func), items)
+        result_handler(_worker_result(config, result) for result in analysis_results)
     else:
         analysis_results = (func(a) for a in items)  # generator
         result_handler(analysis_results)
 
 
+def run_mp_dynamic(config, items, func, result_handler, priority=None, initialiser=None, initargs=(), memory=None,
+                   uses_tools: bool = False, remote: bool = False):
+    """
+    Like run_mp_imap, but the result handler can return new items to process as each result arrives.
+
+    This is useful when items become ready to process as others finish, for example when compiling a file
+    requires its dependencies to be compiled first. New items are processed as soon as there's a free worker,
+    so we never wait for a whole batch of work to complete before starting on the next.
+
+    :param items:
+        An iterable of items which are ready to process.
+    :param func:
+        A function to process a single item. Must accept a single argument.
+        If it raises an exception, the exception is passed to the result handler as the result.
+    :param result_handler:
+        A function to handle a single result, called in this process. Must accept the item and its result,
+        and return an iterable of any new items which are now ready to process.
+        If it raises an exception, we start no more work, wait for the running items to finish,
+        and the exception is raised from here.
+    :param priority:
+        Optional function returning a number for an item. When several items are ready,
+        those with the highest priority are processed first. Otherwise, items are processed in the order they're ready.
+    :param initialiser:
+        Optional function to call once in each worker process, before it processes its first item.
+    :param initargs:
+        Arguments for the initialiser.
+    :param memory:
+        Optional function returning the estimated peak memory for an item, in bytes.
+        If the config has a memory budget, the next item waits until its estimate fits in the budget,
+        alongside the items which are already running. Items behind it wait too, so it can't be starved.
+    :param uses_tools:
+        Set this when the function spends its time waiting for a command line tool, such as a compiler.
+        If the config uses tool threads, the items are processed in threads of this process instead of the pool.
+    :param remote:
+        Set this when the function only needs the files in the project workspace, so it can run on another machine.
+        If the config has a remote executor, the items are processed there instead of the pool,
+        running as many at once as the executor's `max_workers`.
+
+    """
+    if initialiser:
+        func = WorkerInit(func, initialiser, initargs)
+
+    # Ready items wait here until there's a worker free, so a high priority item can overtake others.
+    # The counter keeps equal priorities in arrival order, and means we never compare the items themselves.
+    pending: List[Tuple[float, int, Any]] = []
+    counter = count()
+
+    def add_pending(new_items):
+        for item in new_items or []:
+            heapq.heappush(pending, (-priority(item) if priority else 0, next(counter), item))
+
+    add_pending(items)
+
+    if config.multiprocessing:
+        # results arrive in the pool's result thread, or an executor's thread, and we handle them in this thread
+        done: queue.Queue = queue.Queue()
+        max_running = config.n_procs
+        threads = executor = None
+        if remote and config.remote_executor:
+            executor = config.remote_executor
+            max_running = getattr(executor, 'max_workers', config.n_procs)
+        elif uses_tools and config.tool_threads:
+            executor = threads = ThreadPoolExecutor(config.n_procs)
+        else:
+            config.recycle_workers()
+        pool_func = _WorkerMemory(func)
+
+        def executor_done(item, future):
+            err = future.exception()
+            done.put((item, err if err is not None else future.result()))
+
+        def submit(item):
+            if executor:
+                executor.submit(func, item).add_done_callback(lambda future: executor_done(item, future))
+            else:
+                config.pool.apply_async(
+                    pool_func, (item,),
+                    callback=lambda result: done.put((item, _worker_result(config, result))),
+                    error_callback=lambda err: done.put((item, err)))
+
+        budget = config.memory_budget if memory else None
+        num_running = 0
+        running_memory = 0.0
+
+        def fits(item):
+            return not budget or not num_running or running_memory + memory(item) <= budget
+
+        def recycling():
+            # When a worker is too large, we hold back new items until the pool is idle, then replace it.
+            if executor or not config.workers_too_large():
+                return False
+            if not num_running:
+                config.recycle_workers()
+                return False
+            return True
+
+        try:
+            while pending or num_running:
+                while pending and num_running < max_running and fits(pending[0][2]) and not recycling():
+                    item = heapq.heappop(pending)[2]
+                    submit(item)
+                    num_running += 1
+                    running_memory += memory(item) if budget else 0
+
+                item, result = done.get()
+                num_running -= 1
+                running_memory -= memory(item) if budget else 0
+                add_pending(result_handler(item, result))
+        except Exception:
+            # We don't start any more work, but let the running items finish, discarding their results.
+            # Terminating a worker could leave a partly written prebuild file, or an orphaned compiler.
+            for _ in range(num_running):
+                done.get()
+            raise
+        finally:
+            if threads:
+                threads.shutdown()
+
+    else:
+        while pending:
+            item = heapq.heappop(pending)[2]
+            try:
+                result = func(item)
+            except Exception as err:
+                result = err
+            add_pending(result_handler(item, result))
+
+
+def get_memory_estimates(config, metric_name: str, fpaths: Iterable[Path]) -> Dict[Path, float]:
+    """
+    Estimate the peak memory, in bytes, needed to process each file, from the `peak_rss` in previous runs' metrics.
+
+    Files without a previous measurement are given the average.
+    Returns an empty dict when the config has no memory budget, or when there are no previous measurements.
+
+    :param config:
+        The :class:`fab.build_config.BuildConfig` object, where we find the memory budget and metrics folder.
+    :param metric_name:
+        The metrics group where each file's peak memory is recorded.
+    :param fpaths:
+        The files we want estimates for.
+
+    """
+    if not config.memory_budget:
+        return {}
+
+    fpaths = list(fpaths)
+    peaks = carry_forward_metrics(config.metrics_folder, metric_name, 'peak_rss', map(str, fpaths))
+    if not peaks:
+        return {}
+
+    average = sum(peaks.values()) / len(peaks)
+    return {fpath: peaks.get(str(fpath), average) for fpath in fpaths}
+
+
 def check_for_errors(results, caller_label=None):
     """
     Check an iterable of results for any exceptions and handle them gracefully.
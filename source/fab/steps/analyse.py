@@ -38,18 +38,22 @@ import logging
 import sys
 import warnings
 from pathlib import Path
-from typing import Dict, List, Iterable, Set, Optional, Union
+from typing import Any, Dict, List, Iterable, MutableMapping, Set, Optional, Tuple, Union
 
 from fab import FabException
 from fab.artefacts import ArtefactsGetter, CollectionConcat, SuffixFilter
 from fab.constants import BUILD_TREES
-from fab.dep_tree import extract_sub_tree, validate_dependencies, AnalysedDependent
+from fab.dep_tree import AnalysedDependent, DepGraph, extract_sub_tree, extract_sub_trees, validate_dependencies
 from fab.mo import add_mo_commented_file_deps
 from fab.parse import AnalysedFile, EmptySourceFile
+from fab.parse.analysis_db import load_analyses
 from fab.parse.c import AnalysedC, CAnalyser
 from fab.parse.fortran import AnalysedFortran, FortranParserWorkaround, FortranAnalyser
-from fab.steps import run_mp, step
-from fab.util import TimerLogger, by_type
+from fab.parse.fortran_scan import find_definitions, validate_scan as validate_fortran_scan
+from fab.steps import get_memory_estimates, run_mp, run_mp_dynamic, step, PerWorker
+from fab.steps.compile_fortran import PipelineCompiler, process_file
+from fab.symbol_index import SymbolIndex
+from fab.util import TimerLogger, by_type, file_checksum, string_checksum
 
 logger = logging.getLogger(__name__)
 
@@ -78,6 +82,10 @@ def analyse(
         special_measure_analysis_results: Optional[Iterable[FortranParserWorkaround]] = None,
         unreferenced_deps: Optional[Iterable[str]] = None,
         ignore_mod_deps: Optional[Iterable[str]] = None,
+        pipeline_compile: Optional[Dict[str, Any]] = None,
+        scan_fortran: bool = False,
+        validate_scan: bool = False,
+        lazy: bool = False,
         name='analyser'):
     """
     Produce one or more build trees by analysing source code dependencies.
@@ -117,6 +125,22 @@ def analyse(
         those files and all their dependencies will be added to the build tree(s).
     :param ignore_mod_deps:
         Third party Fortran module names to be ignored.
+    :param pipeline_compile:
+        Start compiling Fortran files while the rest of the source is still being analysed.
+        Pass a dict containing the `common_flags` and `path_flags` which will be given to
+        :func:`~fab.steps.compile_fortran.compile_fortran`. An empty dict means no flags.
+        That step will then reuse the files compiled here. See :class:`~fab.steps.compile_fortran.PipelineCompiler`.
+    :param scan_fortran:
+        Find Fortran dependencies with a fast line based scanner, instead of parsing every file with fparser.
+        Files the scanner can't handle are still parsed. See :mod:`fab.parse.fortran_scan`.
+    :param validate_scan:
+        Parse the Fortran with fparser, then check the scanner finds the same dependencies in every file,
+        logging any differences. Can't be used with scan_fortran.
+    :param lazy:
+        Only parse the Fortran files which are reachable from the root symbols, and the unreferenced deps.
+        Fortran files which were analysed before, and C files, are still all loaded or analysed.
+        Needs root_symbol, and can't be used with find_programs or pipeline_compile.
+        See :func:`~fab.parse.fortran_scan.find_definitions` for how we find which files to parse.
     :param name:
         Human friendly name for logger output, with sensible default.
 
@@ -129,6 +153,12 @@ def analyse(
 
     if find_programs and root_symbol:
         raise ValueError("find_programs and root_symbol can't be used together")
+    if scan_fortran and validate_scan:
+        raise ValueError("scan_fortran and validate_scan can't be used together")
+    if lazy and not root_symbol:
+        raise ValueError("lazy analysis needs a root_symbol")
+    if lazy and pipeline_compile is not None:
+        raise ValueError("lazy and pipeline_compile can't be used together")
 
     source_getter = source or DEFAULT_SOURCE_GETTER
     root_symbols: Optional[List[str]] = [root_symbol] if isinstance(root_symbol, str) else root_symbol
@@ -136,7 +166,7 @@ def analyse(
     unreferenced_deps = list(unreferenced_deps or [])
 
     # todo: these seem more like functions
-    fortran_analyser = FortranAnalyser(std=std, ignore_mod_deps=ignore_mod_deps)
+    fortran_analyser = FortranAnalyser(std=std, ignore_mod_deps=ignore_mod_deps, scan=scan_fortran)
     c_analyser = CAnalyser()
 
     """
@@ -168,7 +198,24 @@ def analyse(
 
     # parse
     files: List[Path] = source_getter(config._artefact_store)
-    analysed_files = _parse_files(config, files=files, fortran_analyser=fortran_analyser, c_analyser=c_analyser)
+    pipeline_compiler = PipelineCompiler(config, **pipeline_compile) if pipeline_compile is not None else None
+    if lazy:
+        assert root_symbols
+        analysed_files = _parse_reachable_files(
+            config, files=files, symbols=root_symbols + unreferenced_deps,
+            fortran_analyser=fortran_analyser, c_analyser=c_analyser,
+            manual_results=[r.as_analysed_fortran() for r in special_measure_analysis_results])
+    else:
+        analysed_files = _parse_files(
+            config, files=files, fortran_analyser=fortran_analyser, c_analyser=c_analyser,
+            pipeline_compiler=pipeline_compiler)
+
+    if validate_scan:
+        with TimerLogger('validating the fortran scanner'):
+            validate_fortran_scan(
+                by_type(analysed_files, AnalysedFortran), ignore_mod_deps=fortran_analyser.ignore_mod_deps,
+                intrinsic_modules=fortran_analyser._intrinsic_modules)
+
     _add_manual_results(special_measure_analysis_results, analysed_files)
 
     # shall we search the results for fortran programs and a c function called main?
@@ -187,7 +234,17 @@ def analyse(
         logger.info(f'automatically found the following programs to build: {", ".join(root_symbols)}')
 
     # analyse
-    project_source_tree, symbol_table = _analyse_dependencies(analysed_files)
+    # The symbol table and file deps are kept between builds, and only updated for what's changed.
+    # Manual results can change without their files changing, so they're part of the settings.
+    manual_results = sorted(
+        f'{r.fpath} {sorted(r.symbol_defs | r.module_defs)} {sorted(r.symbol_deps | r.module_deps)}'
+        for r in special_measure_analysis_results)
+    # A lazy analysis doesn't have the whole source, which the index would have to forget.
+    symbol_index = None if lazy else SymbolIndex(
+        config.project_workspace / 'symbol_index' / f'{name}.pkl',
+        settings=f'{fortran_analyser.analysis_key} {c_analyser.analysis_key} '
+                 f'{string_checksum(" ".join(manual_results))}')
+    project_source_tree, symbol_table = _analyse_dependencies(analysed_files, symbol_index=symbol_index)
 
     # add the file dependencies for MO FCM's "DEPENDS ON:" commented file deps (being removed soon)
     with TimerLogger("adding MO FCM 'DEPENDS ON:' file dependency comments"):
@@ -195,31 +252,44 @@ def analyse(
 
     logger.info(f"source tree size {len(project_source_tree)}")
 
+    # the file deps are complete, so we can make a compact graph for extracting build trees
+    graph = None
+    if root_symbols or unreferenced_deps:
+        with TimerLogger("creating the dependency graph"):
+            graph = DepGraph(project_source_tree)
+
     # extract "build trees" for executables.
     if root_symbols:
-        build_trees = _extract_build_trees(root_symbols, project_source_tree, symbol_table)
+        build_trees = _extract_build_trees(root_symbols, project_source_tree, symbol_table, graph=graph)
     else:
         build_trees = {None: project_source_tree}
 
     # throw in any extra source we need, which Fab can't automatically detect
     for build_tree in build_trees.values():
-        _add_unreferenced_deps(unreferenced_deps, symbol_table, project_source_tree, build_tree)
+        _add_unreferenced_deps(unreferenced_deps, symbol_table, project_source_tree, build_tree, graph=graph)
         validate_dependencies(build_tree)
 
     config._artefact_store[BUILD_TREES] = build_trees
 
 
-def _analyse_dependencies(analysed_files: Iterable[AnalysedDependent]):
+def _analyse_dependencies(analysed_files: Iterable[AnalysedDependent], symbol_index: Optional[SymbolIndex] = None):
     """
     Build a source dependency tree for the entire source.
 
+    If a :class:`~fab.symbol_index.SymbolIndex` is given, only the changes since the last build are resolved,
+    and the index is saved for the next build.
+
     """
     with TimerLogger("converting symbol dependencies to file dependencies"):
-        # map symbols to the files they're in
-        symbol_table: Dict[str, Path] = _gen_symbol_table(analysed_files)
+        if symbol_index:
+            symbol_table = symbol_index.update(analysed_files)
+            symbol_index.save()
+        else:
+            # map symbols to the files they're in
+            symbol_table = _gen_symbol_table(analysed_files)
 
-        # fill in the file deps attribute in the analysed file objects
-        _gen_file_deps(analysed_files, symbol_table)
+            # fill in the file deps attribute in the analysed file objects
+            _gen_file_deps(analysed_files, symbol_table)
 
     # build the tree
     # the nodes refer to other nodes via the file dependencies we just made, which are keys into this dict
@@ -228,27 +298,30 @@ def _analyse_dependencies(analysed_files: Iterable[AnalysedDependent]):
     return source_tree, symbol_table
 
 
-def _extract_build_trees(root_symbols, project_source_tree, symbol_table):
+def _extract_build_trees(root_symbols, project_source_tree, symbol_table, graph: Optional[DepGraph] = None):
     """
     Find the subset of files needed to build each root symbol (executable).
 
     Assumes we have been given a root symbol(s) or we wouldn't have been called.
-    Returns a build tree for every root symbol.
+    Returns a build tree for every root symbol, as a view of the project source tree.
 
     """
-    build_trees = {}
     assert root_symbols is not None
-    for root in root_symbols:
-        with TimerLogger(f"extracting build tree for root '{root}'"):
-            build_tree = extract_sub_tree(project_source_tree, symbol_table[root], verbose=False)
+    with TimerLogger(f"extracting build trees for {len(root_symbols)} roots"):
+        sub_trees = extract_sub_trees(
+            project_source_tree, (symbol_table[root] for root in root_symbols), graph=graph)
 
+    build_trees = {}
+    for root in root_symbols:
+        build_tree = sub_trees[symbol_table[root]]
         logger.info(f"target source tree size {len(build_tree)} (target '{symbol_table[root]}')")
         build_trees[root] = build_tree
 
     return build_trees
 
 
-def _parse_files(config, files: List[Path], fortran_analyser, c_analyser) -> Set[AnalysedDependent]:
+def _parse_files(config, files: List[Path], fortran_analyser, c_analyser,
+                 pipeline_compiler: Optional[PipelineCompiler] = None) -> Set[AnalysedDependent]:
     """
     Determine the symbols which are defined in, and used by, each file.
 
@@ -258,8 +331,19 @@ def _parse_files(config, files: List[Path], fortran_analyser, c_analyser) -> Set
     """
     # fortran
     fortran_files = set(filter(lambda f: f.suffix == '.f90', files))
+    fortran_loaded, fortran_files = _load_analyses(config, fortran_files, fortran_analyser)
+    memory_estimates = get_memory_estimates(config, fortran_analyser.metric_name, fortran_files)
     with TimerLogger(f"analysing {len(fortran_files)} preprocessed fortran files"):
-        fortran_results = run_mp(config, items=fortran_files, func=fortran_analyser.run)
+        if pipeline_compiler:
+            fortran_results = _parse_and_compile_fortran(
+                config, fortran_files, fortran_analyser, pipeline_compiler, memory_estimates=memory_estimates,
+                already_analysed=fortran_loaded)
+        else:
+            with PerWorker(fortran_analyser.run, config) as analyse_file:
+                fortran_results = run_mp(
+                    config, items=fortran_files, func=analyse_file,
+                    memory=memory_estimates.get if memory_estimates else None)
+    fortran_results = [(af, config.analysis_db.fpath) for af in fortran_loaded] + list(fortran_results)
     fortran_analyses, fortran_artefacts = zip(*fortran_results) if fortran_results else (tuple(), tuple())
 
     # warn about naughty fortran usage
@@ -268,6 +352,7 @@ def _parse_files(config, files: List[Path], fortran_analyser, c_analyser) -> Set
 
     # c
     c_files = set(filter(lambda f: f.suffix == '.c', files))
+    c_loaded, c_files = _load_analyses(config, c_files, c_analyser)
     with TimerLogger(f"analysing {len(c_files)} preprocessed c files"):
         # The C analyser hangs with multiprocessing in Python 3.7!
         # Override the multiprocessing flag.
@@ -275,7 +360,9 @@ def _parse_files(config, files: List[Path], fortran_analyser, c_analyser) -> Set
         if sys.version.startswith('3.7'):
             warnings.warn('Python 3.7 detected. Disabling multiprocessing for C analysis.')
             no_multiprocessing = True
-        c_results = run_mp(config, items=c_files, func=c_analyser.run, no_multiprocessing=no_multiprocessing)
+        with PerWorker(c_analyser.run, config) as analyse_file:
+            c_results = run_mp(config, items=c_files, func=analyse_file, no_multiprocessing=no_multiprocessing)
+    c_results = [(af, config.analysis_db.fpath) for af in c_loaded] + list(c_results)
     c_analyses, c_artefacts = zip(*c_results) if c_results else (tuple(), tuple())
 
     # Check for parse errors but don't fail. The failed files might not be required.
@@ -292,9 +379,174 @@ def _parse_files(config, files: List[Path], fortran_analyser, c_analyser) -> Set
     # ignore empty files
     analysed_files = by_type(analyses, AnalysedFile)
     non_empty = {af for af in analysed_files if not isinstance(af, EmptySourceFile)}
+    for af in non_empty:
+        af.freeze()
     return non_empty
 
 
+def _parse_reachable_files(config, files: List[Path], symbols: Iterable[str], fortran_analyser, c_analyser,
+                           manual_results: Iterable[AnalysedDependent] = ()) -> Set[AnalysedDependent]:
+    """
+    Like :func:`_parse_files`, but only parse the Fortran files reachable from the given symbols.
+
+    Stored Fortran results are loaded, and the C files are analysed, as usual. The other Fortran files
+    are searched for the symbols they might define, see :func:`~fab.parse.fortran_scan.find_definitions`.
+    Starting from the given symbols, we parse the files which might define the symbols we need,
+    then the files which might define the symbols they use, and so on, in waves.
+
+    Returns the results for the loaded and C files, and the Fortran files which were parsed.
+
+    :param manual_results:
+        Results for files which can't be parsed. Their files aren't parsed, and they aren't returned.
+
+    """
+    manual_results = list(manual_results)
+    manual_fpaths = {af.fpath for af in manual_results}
+    fortran_files = {f for f in files if f.suffix == '.f90' and f not in manual_fpaths}
+
+    analysed_files = _parse_files(
+        config, files=[f for f in files if f.suffix == '.c'], fortran_analyser=fortran_analyser, c_analyser=c_analyser)
+    fortran_loaded, unanalysed = _load_analyses(config, fortran_files, fortran_analyser)
+    if fortran_loaded:
+        config.add_current_prebuilds([config.analysis_db.fpath])
+    for af in fortran_loaded:
+        if isinstance(af, AnalysedDependent):
+            af.freeze()
+            analysed_files.add(af)
+
+    with TimerLogger(f"finding the symbols {len(unanalysed)} unanalysed fortran files might define"):
+        candidates: Dict[str, Set[Path]] = {}
+        for fpath, definitions in run_mp(config, items=unanalysed, func=_find_definitions):
+            for symbol in definitions:
+                candidates.setdefault(symbol, set()).add(fpath)
+
+    # the file which defines each symbol, so far
+    defined: Dict[str, AnalysedDependent] = {}
+
+    def add_definitions(new_files):
+        for af in new_files:
+            for symbol in af.symbol_defs:
+                defined.setdefault(symbol, af)
+
+    add_definitions(manual_results)
+    add_definitions(analysed_files)
+
+    to_visit = list(symbols)
+    visited: Set[str] = set()
+    unresolved: Set[str] = set()
+    followed: Set[Path] = set()
+    parsed: Set[Path] = set()
+    waves = 0
+    while to_visit:
+        to_parse: Set[Path] = set()
+        while to_visit:
+            symbol = to_visit.pop()
+            if symbol in visited:
+                continue
+            visited.add(symbol)
+
+            definer = defined.get(symbol)
+            if not definer:
+                unresolved.add(symbol)
+                to_parse.update(candidates.get(symbol, set()) - parsed)
+            elif definer.fpath not in followed:
+                followed.add(definer.fpath)
+                to_visit.extend(definer.symbol_deps)
+
+        if to_parse:
+            waves += 1
+            parsed.update(to_parse)
+            new_files = _parse_files(
+                config, files=list(to_parse), fortran_analyser=fortran_analyser, c_analyser=c_analyser)
+            add_definitions(new_files)
+            analysed_files.update(new_files)
+
+            # visit the symbols these files were parsed for again, to follow their dependencies
+            now_defined = {symbol for symbol in unresolved if symbol in defined}
+            unresolved -= now_defined
+            visited -= now_defined
+            to_visit.extend(now_defined)
+
+    logger.info(f"lazy analysis parsed {len(parsed)} of {len(unanalysed)} unanalysed fortran files, "
+                f"in {waves} waves")
+    return analysed_files
+
+
+def _find_definitions(fpath: Path) -> Tuple[Path, Set[str]]:
+    return fpath, find_definitions(fpath.read_text(errors='replace'))
+
+
+def _load_analyses(config, files: Set[Path], analyser) -> Tuple[List[AnalysedFile], Set[Path]]:
+    """
+    Load the stored analysis results for the given files, with one database query.
+
+    Returns the loaded results, and the files which still need analysing.
+    The results can include an :class:`~fab.parse.EmptySourceFile`, which isn't an AnalysedDependent.
+
+    """
+    if not files:
+        return [], files
+
+    hashed_files = run_mp(config, items=files, func=file_checksum)
+    loaded = load_analyses(analyser, hashed_files)
+    logger.info(f'loaded {len(loaded)} previous analysis results')
+    return loaded, files - {af.fpath for af in loaded}
+
+
+class _AnalyseOrCompile(object):
+    # The function run in the child processes when compiling while we analyse.
+    # Paths are analysed, anything else is a compilation argument.
+    def __init__(self, fortran_analyser):
+        self.fortran_analyser = fortran_analyser
+
+    def __call__(self, item):
+        if isinstance(item, Path):
+            return self.fortran_analyser.run(item)
+        return process_file(item)
+
+
+def _parse_and_compile_fortran(config, fortran_files: Iterable[Path], fortran_analyser,
+                               pipeline_compiler: PipelineCompiler,
+                               memory_estimates: Optional[Dict[Path, float]] = None,
+                               already_analysed: Iterable[AnalysedFile] = ()) -> List:
+    """
+    Analyse the fortran files, compiling each one as soon as the modules it uses have been compiled.
+    Files which were already analysed can be compiled straight away.
+
+    Returns the analysis results, like :func:`~fab.steps.run_mp`.
+
+    """
+    analysis_results = []
+    compile_memory_estimates = get_memory_estimates(config, 'compile_fortran', fortran_files)
+
+    def memory(item) -> float:
+        if isinstance(item, Path):
+            return (memory_estimates or {}).get(item, 0)
+        return compile_memory_estimates.get(item[0].fpath, 0)
+
+    def handle_result(item, result):
+        if isinstance(item, Path):
+            if isinstance(result, Exception):
+                result = result, None
+            analysis_results.append(result)
+            return pipeline_compiler.analysed(result[0])
+        return pipeline_compiler.compiled(item, result)
+
+    ready: List[Any] = list(fortran_files)
+    for analysed_file in already_analysed:
+        ready.extend(pipeline_compiler.analysed(analysed_file))
+
+    # Compilation goes ahead of the remaining analysis, so the files which depend on it can start sooner.
+    with PerWorker(_AnalyseOrCompile(fortran_analyser), config) as analyse_or_compile:
+        run_mp_dynamic(
+            config, items=ready, func=analyse_or_compile, result_handler=handle_result,
+            priority=lambda item: 0 if isinstance(item, Path) else 1,
+            memory=memory if memory_estimates or compile_memory_estimates else None)
+
+    logger.info(f'compiled {pipeline_compiler.num_compiled} fortran files during analysis')
+    return analysis_results
+
+
 def _add_manual_results(special_measure_analysis_results, analysed_files: Set[AnalysedDependent]):
     # add manual analysis results for files which could not be parsed
     if special_measure_analysis_results:
@@ -363,11 +615,12 @@ def _gen_file_deps(analysed_files: Iterable[AnalysedDependent], symbols: Dict[st
 
 def _add_unreferenced_deps(unreferenced_deps, symbol_table: Dict[str, Path],
                            all_analysed_files: Dict[Path, AnalysedDependent],
-                           build_tree: Dict[Path, AnalysedDependent]):
+                           build_tree: MutableMapping[Path, AnalysedDependent], graph: Optional[DepGraph] = None):
     """
     Add files to the build tree.
 
     This is used for building Fortran code which Fab doesn't know is a dependency.
+    The sub trees are extracted using the :class:`~fab.dep_tree.DepGraph` of all the files, if given.
 
     """
     if not unreferenced_deps:
@@ -395,5 +648,8 @@ def _add_unreferenced_deps(unreferenced_deps, symbol_table: Dict[str, Path],
             continue
 
         # add the file and it's file deps
-        sub_tree = extract_sub_tree(source_tree=all_analysed_files, root=analysed_fpath)
-        build_tree.update(sub_tree)
+        if graph:
+            sub_tree = extract_sub_trees(source_tree=all_analysed_files, roots=[analysed_fpath], graph=graph)
+            build_tree.update(sub_tree[analysed_fpath])
+        else:
+            build_tree.update(extract_sub_tree(source_tree=all_analysed_files, root=analysed_fpath))
@@ -14,6 +14,7 @@ from pathlib import Path
 from typing import Dict, Optional, Iterable, Set
 
 from fab.constants import CURRENT_PREBUILDS
+from fab.parse.analysis_db import AnalysisDB
 from fab.steps import run_mp, step
 from fab.util import file_walk, get_prebuild_file_groups
 
@@ -43,6 +44,9 @@ def cleanup_prebuilds(
 
     If no parameters are specified then `all_unused` will default to `True`.
 
+    The analysis results all live in one database, see :class:`~fab.parse.analysis_db.AnalysisDB`.
+    Its results are removed by when they were last used, with `older_than` or `all_unused`.
+
     """
     # If the user has not specified any cleanup parameters, we default to a hard cleanup.
     if not n_versions and not older_than:
@@ -81,6 +85,12 @@ def cleanup_prebuilds(
     logger.info(f'removed {num_removed} prebuild files')
     config._artefact_store[CLEANUP_COUNT] = num_removed
 
+    if config.analysis_db.fpath.exists():
+        num_results = remove_unused_analyses(
+            config.analysis_db, older_than=older_than, all_unused=bool(all_unused),
+            build_start=config._start_time.timestamp())
+        logger.info(f'removed {num_results} analysis results')
+
 
 def by_age(older_than: Optional[timedelta],
            prebuilds_ts: Dict[Path, datetime], current_files: Iterable[Path]) -> Set[Path]:
@@ -135,6 +145,23 @@ def remove_all_unused(found_files: Iterable[Path], current_files: Iterable[Path]
     return num_removed
 
 
+def remove_unused_analyses(analysis_db: AnalysisDB, older_than: Optional[timedelta], all_unused: bool,
+                           build_start: float) -> int:
+    # Like by_age and remove_all_unused, for the results in the analysis database.
+    # A result used since the build started is current.
+    if all_unused:
+        before = build_start
+    elif older_than:
+        latest_use = analysis_db.latest_use()
+        if latest_use is None:
+            return 0
+        before = min(latest_use - older_than.total_seconds(), build_start)
+    else:
+        return 0
+
+    return analysis_db.remove_unused(before)
+
+
 def get_access_time(fpath: Path) -> datetime:
     """
     Return the access time of the given file.
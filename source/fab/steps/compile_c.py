@@ -10,7 +10,6 @@ C file compilation.
 import logging
 import os
 import warnings
-import zlib
 from collections import defaultdict
 from dataclasses import dataclass
 from typing import List, Dict, Optional, Tuple
@@ -23,7 +22,7 @@ from fab.metrics import send_metric
 from fab.parse.c import AnalysedC
 from fab.steps import check_for_errors, run_mp, step
 from fab.tools import flags_checksum, run_command, get_tool, get_compiler_version
-from fab.util import CompiledFile, log_or_dot, Timer, by_type
+from fab.util import CompiledFile, log_or_dot, Timer, by_type, combo_checksum
 
 logger = logging.getLogger(__name__)
 
@@ -91,7 +90,8 @@ def compile_c(config, common_flags: Optional[List[str]] = None,
     mp_items = [(fpath, mp_payload) for fpath in to_compile]
 
     # compile everything in one go
-    compilation_results = run_mp(config, items=mp_items, func=_compile_file)
+    compilation_results = run_mp(config, items=mp_items, func=_compile_file, stop_on_error=True, uses_tools=True,
+                                 remote=True)
     check_for_errors(compilation_results, caller_label='compile c')
     compiled_c = list(by_type(compilation_results, CompiledFile))
     logger.info(f"compiled {len(compiled_c)} c files")
@@ -153,11 +153,11 @@ def _compile_file(arg: Tuple[AnalysedC, MpCommonArgs]):
 def _get_obj_combo_hash(compiler, compiler_version, analysed_file, flags):
     # get a combo hash of things which matter to the object file we define
     try:
-        obj_combo_hash = sum([
+        obj_combo_hash = combo_checksum([
             analysed_file.file_hash,
             flags_checksum(flags),
-            zlib.crc32(compiler.encode()),
-            zlib.crc32(compiler_version.encode()),
+            compiler,
+            compiler_version,
         ])
     except TypeError:
         raise ValueError("could not generate combo hash for object file")
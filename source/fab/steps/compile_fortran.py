@@ -14,22 +14,19 @@ Fortran file compilation.
 import logging
 import os
 import shutil
-import zlib
 from collections import defaultdict
-from dataclasses import dataclass
-from itertools import chain
+from dataclasses import dataclass, replace
 from pathlib import Path
-from typing import List, Set, Dict, Tuple, Optional, Union
+from typing import Iterable, List, Set, Dict, Tuple, Optional, Union
 
 from fab.artefacts import ArtefactsGetter, FilterBuildTrees
 from fab.build_config import BuildConfig, FlagsConfig
 from fab.constants import OBJECT_FILES
-from fab.metrics import send_metric
+from fab.metrics import carry_forward_metrics, send_metric
 from fab.parse.fortran import AnalysedFortran
-from fab.steps import check_for_errors, run_mp, step
+from fab.steps import check_for_errors, get_memory_estimates, run_mp_dynamic, step
 from fab.tools import COMPILERS, remove_managed_flags, flags_checksum, run_command, get_tool, get_compiler_version
-from fab.util import CompiledFile, log_or_dot_finish, log_or_dot, Timer, by_type, \
-    file_checksum
+from fab.util import CompiledFile, log_or_dot_finish, log_or_dot, Timer, combo_checksum, file_checksum
 
 logger = logging.getLogger(__name__)
 
@@ -50,11 +47,12 @@ class MpCommonArgs(object):
 
 @step
 def compile_fortran(config: BuildConfig, common_flags: Optional[List[str]] = None,
-                    path_flags: Optional[List] = None, source: Optional[ArtefactsGetter] = None):
+                    path_flags: Optional[List] = None, source: Optional[ArtefactsGetter] = None,
+                    prioritise_critical_path: bool = False):
     """
     Compiles all Fortran files in all build trees, creating/extending a set of compiled files for each build target.
 
-    Files are compiled in multiple passes, with each pass enabling further files to be compiled in the next pass.
+    Each file is compiled as soon as all the files it depends on have been compiled.
 
     Uses multiprocessing, unless disabled in the config.
 
@@ -68,6 +66,9 @@ def compile_fortran(config: BuildConfig, common_flags: Optional[List[str]] = Non
         for selected files.
     :param source:
         An :class:`~fab.artefacts.ArtefactsGetter` which give us our c files to process.
+    :param prioritise_critical_path:
+        When several files are ready to compile, start those at the head of the longest chain of dependent files.
+        Chains are weighted by how long each file took to compile in previous runs, as recorded in the metrics.
 
     """
     # todo: two_stage is now in the parsed args - say what it does with the flag - and find a better place for it?
@@ -92,33 +93,27 @@ def compile_fortran(config: BuildConfig, common_flags: Optional[List[str]] = Non
         config=config, flags=flags_config, compiler=compiler, compiler_version=compiler_version,
         mod_hashes=mod_hashes, two_stage_flag=two_stage_flag, stage=None)
 
-    # compile everything in multiple passes
-    compiled: Dict[Path, CompiledFile] = {}
+    # compile everything, starting each file as soon as its dependencies are compiled
     uncompiled: Set[AnalysedFortran] = set(sum(build_lists.values(), []))
     logger.info(f"compiling {len(uncompiled)} fortran files")
 
     if two_stage_flag:
-        logger.info("Starting two-stage compile: mod files, multiple passes")
+        logger.info("Starting two-stage compile: each object file follows its mod files")
         mp_common_args.stage = 1
 
-    while uncompiled:
-        uncompiled = compile_pass(config=config, compiled=compiled, uncompiled=uncompiled,
-                                  mp_common_args=mp_common_args, mod_hashes=mod_hashes)
+    priorities = None
+    stage_2_times = None
+    if prioritise_critical_path:
+        compile_times = get_compile_times(config, _metric_name(mp_common_args.stage), uncompiled)
+        priorities = get_critical_path_priorities(uncompiled, compile_times)
+        if two_stage_flag:
+            stage_2_times = get_compile_times(config, _metric_name(2), uncompiled)
+
+    compiled = compile_in_dependency_order(
+        config=config, uncompiled=uncompiled, mp_common_args=mp_common_args, mod_hashes=mod_hashes,
+        priorities=priorities, stage_2_times=stage_2_times)
     log_or_dot_finish(logger)
 
-    if two_stage_flag:
-        logger.info("Finalising two-stage compile: object files, single pass")
-        mp_common_args.stage = 2
-
-        # a single pass should now compile all the object files in one go
-        uncompiled = set(sum(build_lists.values(), []))  # todo: order by last compile duration
-        mp_args = [(fpath, mp_common_args) for fpath in uncompiled]
-        results_this_pass = run_mp(config, items=mp_args, func=process_file)
-        log_or_dot_finish(logger)
-        check_for_errors(results_this_pass, caller_label="compile_fortran")
-        compiled_this_pass = list(by_type(results_this_pass, CompiledFile))
-        logger.info(f"stage 2 compiled {len(compiled_this_pass)} files")
-
     # record the compilation results for the next step
     store_artefacts(compiled, build_lists, config._artefact_store)
 
@@ -151,63 +146,319 @@ def handle_compiler_args(common_flags=None, path_flags=None):
     return compiler, compiler_version, flags_config
 
 
-def compile_pass(config, compiled: Dict[Path, CompiledFile], uncompiled: Set[AnalysedFortran],
-                 mp_common_args: MpCommonArgs, mod_hashes: Dict[str, int]):
+class PipelineCompiler(object):
+    """
+    Compiles Fortran files while the project source is still being analysed.
 
-    # what can we compile next?
-    compile_next = get_compile_next(compiled, uncompiled)
+    Used by :func:`~fab.steps.analyse.analyse` when given its `pipeline_compile` argument.
+    A file is compiled as soon as every module it uses has been analysed and compiled.
+    Files which use modules from outside the project source wait for :func:`compile_fortran`.
 
-    # compile
-    logger.info(f"\ncompiling {len(compile_next)} of {len(uncompiled)} remaining files")
-    mp_args = [(fpath, mp_common_args) for fpath in compile_next]
-    results_this_pass = run_mp(config, items=mp_args, func=process_file)
+    We don't know the build trees yet, so this can compile files which turn out not to be needed.
+    Compilation failures are ignored here. The file will be compiled again by :func:`compile_fortran`,
+    which reports the error if the file is needed.
 
-    # there's a compilation result and a list of prebuild files for each compiled file
-    compilation_results, prebuild_files = zip(*results_this_pass) if results_this_pass else (tuple(), tuple())
-    check_for_errors(compilation_results, caller_label="compile_pass")
-    compiled_this_pass = list(by_type(compilation_results, CompiledFile))
-    logger.debug(f"compiled {len(compiled_this_pass)} files")
+    The results are left in the prebuild folder, where :func:`compile_fortran` will find and reuse them,
+    as long as it's given the same flags.
 
-    # record the prebuild files as being current, so the cleanup knows not to delete them
-    config.add_current_prebuilds(chain(*prebuild_files))
+    """
+    def __init__(self, config, common_flags: Optional[List[str]] = None, path_flags: Optional[List] = None):
+        """
+        :param config:
+            The :class:`fab.build_config.BuildConfig` object.
+        :param common_flags:
+            The same common flags which will be passed to :func:`compile_fortran`.
+        :param path_flags:
+            The same path flags which will be passed to :func:`compile_fortran`.
+
+        """
+        compiler, compiler_version, flags_config = handle_compiler_args(common_flags, path_flags)
+
+        self.config = config
+        self.mp_common_args = MpCommonArgs(
+            config=config, flags=flags_config, compiler=compiler, compiler_version=compiler_version,
+            mod_hashes={}, two_stage_flag=None, stage=None)
+
+        # The file which defines each module. If a module is defined more than once, we only compile the first.
+        self.mod_files: Dict[str, Path] = {}
+        # The hash of each compiled module.
+        self.mod_hashes: Dict[str, int] = {}
+
+        # The modules each file is waiting for, and the files waiting for each module.
+        self.analysed_files: Dict[Path, AnalysedFortran] = {}
+        self.waiting_for: Dict[Path, Set[str]] = {}
+        self.waiters: Dict[str, Set[Path]] = defaultdict(set)
+
+        self.num_compiled = 0
+
+    def analysed(self, analysis_result) -> List[Tuple[AnalysedFortran, MpCommonArgs]]:
+        """
+        Record an analysis result.
+
+        Returns the arguments for :func:`process_file` if the file can be compiled now.
+
+        """
+        if not isinstance(analysis_result, AnalysedFortran):
+            return []
+        af = analysis_result
+
+        # don't compile a second definition of a module, or we'd overwrite the mod file
+        if any(self.mod_files.get(mod_def, af.fpath) != af.fpath for mod_def in af.module_defs):
+            logger.debug(f'pipeline not compiling {af.fpath}, which redefines a module')
+            return []
+        for mod_def in af.module_defs:
+            self.mod_files[mod_def] = af.fpath
+
+        self.analysed_files[af.fpath] = af
+        self.waiting_for[af.fpath] = af.module_deps - af.module_defs - self.mod_hashes.keys()
+        for mod_dep in self.waiting_for[af.fpath]:
+            self.waiters[mod_dep].add(af.fpath)
+
+        return [] if self.waiting_for[af.fpath] else [self._mp_arg(af)]
+
+    def compiled(self, arg: Tuple[AnalysedFortran, MpCommonArgs], result) -> List[Tuple[AnalysedFortran, MpCommonArgs]]:
+        """
+        Record a compilation result from :func:`process_file`.
+
+        Returns the arguments for :func:`process_file` for any files which can now be compiled.
+
+        """
+        af, _ = arg
+        compiled_file = result[0] if isinstance(result, tuple) else result
+        if not isinstance(compiled_file, CompiledFile):
+            logger.debug(f'pipeline could not compile {af.fpath}, leaving it for compile_fortran')
+            return []
+        self.num_compiled += 1
+
+        new_mod_hashes = get_mod_hashes({af}, self.config)
+        self.mod_hashes.update(new_mod_hashes)
+
+        compile_next = []
+        for mod_def in new_mod_hashes:
+            for waiter in self.waiters.pop(mod_def, set()):
+                self.waiting_for[waiter].discard(mod_def)
+                if not self.waiting_for[waiter]:
+                    compile_next.append(self._mp_arg(self.analysed_files[waiter]))
+        return compile_next
+
+    def _mp_arg(self, af: AnalysedFortran) -> Tuple[AnalysedFortran, MpCommonArgs]:
+        mod_deps_hashes = {
+            mod_dep: self.mod_hashes[mod_dep] for mod_dep in af.module_deps if mod_dep in self.mod_hashes}
+        return af, replace(self.mp_common_args, mod_hashes=mod_deps_hashes)
+
+
+def compile_in_dependency_order(config, uncompiled: Set[AnalysedFortran], mp_common_args: MpCommonArgs,
+                                mod_hashes: Dict[str, int], priorities: Optional[Dict[Path, float]] = None,
+                                stage_2_times: Optional[Dict[Path, float]] = None) \
+        -> Dict[Path, CompiledFile]:
+    """
+    Compile every file, submitting each one as soon as all the fortran files it depends on have been compiled.
 
-    # hash the modules we just created
-    new_mod_hashes = get_mod_hashes(compile_next, config)
-    mod_hashes.update(new_mod_hashes)
+    We don't wait for a batch of files to finish before starting the next, so one slow file only holds up
+    the files which depend on it.
 
-    # add compiled files to all compiled files
-    compiled.update({cf.input_fpath: cf for cf in compiled_this_pass})
+    If a file fails to compile, we stop submitting new work and report the errors when the rest has finished.
+    If the config is set to fail fast, we stop the outstanding work immediately.
+    If the config is set to keep going, we carry on compiling every file which doesn't depend on a failure.
 
-    # remove compiled files from remaining files
-    uncompiled = set(filter(lambda af: af.fpath not in compiled, uncompiled))
-    return uncompiled
+    For a two-stage compile, the mp_common_args stage is 1. The files which depend on a file are released
+    when its stage 1 mod compile finishes, and so is its own stage 2 object compile.
+    The object compiles only run when there are no mod compiles waiting, filling in the gaps.
 
+    Returns the compiled files, by source path.
 
-def get_compile_next(compiled: Dict[Path, CompiledFile], uncompiled: Set[AnalysedFortran]) \
-        -> Set[AnalysedFortran]:
+    :param config:
+        The :class:`fab.build_config.BuildConfig` object.
+    :param uncompiled:
+        The analysed fortran files to compile.
+    :param mp_common_args:
+        Arguments passed to every call of :func:`process_file`.
+    :param mod_hashes:
+        Filled in with the hash of every module file created.
+    :param priorities:
+        Optional priority for each file, by source path. When several files are ready, the highest goes first.
+    :param stage_2_times:
+        Optional previous stage 2 compile times, by source path. The slowest stage 2 compiles go first.
+
+    """
+    to_compile: Dict[Path, AnalysedFortran] = {af.fpath: af for af in uncompiled}
 
-    # find what to compile next
-    compile_next = set()
-    not_ready: Dict[Path, List[Path]] = {}
+    # the fortran dependencies each file is waiting for, and which files are waiting for each dependency
+    waiting_for: Dict[Path, Set[Path]] = {}
+    dependents: Dict[Path, Set[Path]] = defaultdict(set)
     for af in uncompiled:
-        # all deps ready?
-        unfulfilled = [dep for dep in af.file_deps if dep not in compiled and dep.suffix == '.f90']
-        if unfulfilled:
-            not_ready[af.fpath] = unfulfilled
-        else:
-            compile_next.add(af)
+        waiting_for[af.fpath] = {dep for dep in af.file_deps if dep.suffix == '.f90' and dep != af.fpath}
+        for dep in waiting_for[af.fpath]:
+            dependents[dep].add(af.fpath)
+
+    compiled: Dict[Path, CompiledFile] = {}
+    failed: Set[Path] = set()
+    errors: List[Exception] = []
+    prebuild_files: List[Path] = []
+
+    def mp_arg(af: AnalysedFortran):
+        # Each child process receives its own copy of the mod hashes it needs.
+        # This keeps the payload small, and we don't want the shared dict pickled while we're still updating it.
+        mod_deps_hashes = {mod_dep: mod_hashes[mod_dep] for mod_dep in af.module_deps if mod_dep in mod_hashes}
+        return af, replace(mp_common_args, mod_hashes=mod_deps_hashes)
+
+    def handle_result(arg, result) -> List[Tuple[AnalysedFortran, MpCommonArgs]]:
+        analysed_file, args = arg
+        compiled_file, artefacts = result if isinstance(result, tuple) else (result, None)
+
+        if not isinstance(compiled_file, CompiledFile):
+            errors.append(compiled_file)
+            failed.add(analysed_file.fpath)
+            if config.fail_fast:
+                check_for_errors(errors, caller_label="compile_fortran")
+            return []
+
+        prebuild_files.extend(artefacts)
+
+        # nothing is waiting for an object file
+        if args.stage == 2:
+            return []
+
+        compiled[analysed_file.fpath] = compiled_file
+
+        # hash the modules we just created
+        mod_hashes.update(get_mod_hashes({analysed_file}, config))
+
+        # Once anything has failed, we stop submitting new work unless we're keeping going.
+        # The files which depend on a failure are never released.
+        if errors and not config.keep_going:
+            return []
+
+        # what can we compile next?
+        compile_next = []
+        if args.stage == 1:
+            compile_next.append((analysed_file, replace(args, stage=2)))
+        for dependent in dependents[analysed_file.fpath]:
+            waiting_for[dependent].discard(analysed_file.fpath)
+            if not waiting_for[dependent]:
+                compile_next.append(mp_arg(to_compile[dependent]))
+        return compile_next
+
+    def priority(arg) -> float:
+        analysed_file, args = arg
+        if args.stage == 2:
+            # below every mod compile, slowest first
+            return -1 / (1 + (stage_2_times or {}).get(analysed_file.fpath, 0))
+        return priorities[analysed_file.fpath] if priorities else 0
+
+    # how much memory did each compile need last time?
+    stages = [1, 2] if mp_common_args.stage == 1 else [mp_common_args.stage]
+    memory_estimates = {stage: get_memory_estimates(config, _metric_name(stage), to_compile) for stage in stages}
+
+    def memory(arg) -> float:
+        analysed_file, args = arg
+        return memory_estimates[args.stage].get(analysed_file.fpath, 0)
+
+    ready = [mp_arg(af) for af in uncompiled if not waiting_for[af.fpath]]
+    run_mp_dynamic(
+        config, items=ready, func=process_file, result_handler=handle_result, priority=priority,
+        memory=memory if any(memory_estimates.values()) else None, uses_tools=True, remote=True)
+
+    # record the prebuild files as being current, so the cleanup knows not to delete them
+    config.add_current_prebuilds(prebuild_files)
 
-    # unable to compile anything?
-    if len(uncompiled) and not compile_next:
-        msg = 'Nothing more can be compiled due to unfulfilled dependencies:\n'
-        for f, unf in not_ready.items():
-            msg += f'\n\n{f}'
-            for u in unf:
-                msg += f'\n    {str(u)}'
+    if errors and config.keep_going:
+        skipped = [af for af in uncompiled if af.fpath not in compiled and af.fpath not in failed]
+        logger.warning(f"{len(skipped)} files were not compiled because they depend on a failure")
 
-        raise ValueError(msg)
+    check_for_errors(errors, caller_label="compile_fortran")
+    logger.debug(f"compiled {len(compiled)} files")
 
-    return compile_next
+    # anything left must have unfulfilled dependencies
+    remaining = {af for af in uncompiled if af.fpath not in compiled}
+    if remaining:
+        _raise_unfulfilled(compiled, remaining)
+
+    return compiled
+
+
+def get_compile_times(config, metric_name: str, analysed_files: Iterable[AnalysedFortran]) -> Dict[Path, float]:
+    """
+    Get how long each file took to compile in previous runs, from the metrics.
+
+    Files which were not compiled in the last run, because a prebuild was used, keep their time from earlier runs.
+    We pass these times forward into this run's metrics, so they're available next time.
+
+    :param config:
+        The :class:`fab.build_config.BuildConfig` object, where we find the metrics folder.
+    :param metric_name:
+        The metrics group where compile times are recorded by :func:`compile_file`.
+    :param analysed_files:
+        The files we want to know about.
+
+    """
+    times = carry_forward_metrics(
+        config.metrics_folder, metric_name, 'time_taken', [str(af.fpath) for af in analysed_files])
+    compile_times = {Path(fpath): time_taken for fpath, time_taken in times.items()}
+
+    logger.info(f"found previous compile times for {len(compile_times)} files")
+    return compile_times
+
+
+def get_critical_path_priorities(uncompiled: Set[AnalysedFortran], compile_times: Dict[Path, float]) \
+        -> Dict[Path, float]:
+    """
+    Weight each file by the longest chain of compile times through the files which (indirectly) depend on it.
+
+    Starting the files with the highest weights first keeps the longest chains moving,
+    which shortens the total time when we have many processors.
+
+    Files without a previous compile time are given the average time,
+    so without any metrics, the weight is the length of the longest chain of dependent files.
+
+    :param uncompiled:
+        The files to compile.
+    :param compile_times:
+        Previous compile times, by source path.
+
+    """
+    default_time = sum(compile_times.values()) / len(compile_times) if compile_times else 1.0
+
+    to_compile = {af.fpath for af in uncompiled}
+    dependents: Dict[Path, Set[Path]] = defaultdict(set)
+    for af in uncompiled:
+        for dep in af.file_deps:
+            if dep in to_compile and dep != af.fpath:
+                dependents[dep].add(af.fpath)
+
+    # Depth first, iteratively so long chains can't hit the recursion limit.
+    # A dependency cycle can't be compiled anyway, so we just skip files we're already visiting.
+    priorities: Dict[Path, float] = {}
+    for root in to_compile:
+        if root in priorities:
+            continue
+        visiting = {root}
+        stack = [(root, iter(dependents[root]))]
+        while stack:
+            fpath, children = stack[-1]
+            child = next((c for c in children if c not in priorities and c not in visiting), None)
+            if child:
+                visiting.add(child)
+                stack.append((child, iter(dependents[child])))
+                continue
+
+            stack.pop()
+            visiting.remove(fpath)
+            longest_downstream = max([priorities.get(c, 0) for c in dependents[fpath]], default=0)
+            priorities[fpath] = compile_times.get(fpath, default_time) + longest_downstream
+
+    return priorities
+
+
+def _raise_unfulfilled(compiled: Dict[Path, CompiledFile], uncompiled: Set[AnalysedFortran]):
+    msg = 'Nothing more can be compiled due to unfulfilled dependencies:\n'
+    for af in uncompiled:
+        unfulfilled = [dep for dep in af.file_deps if dep not in compiled and dep.suffix == '.f90']
+        msg += f'\n\n{af.fpath}'
+        for u in unfulfilled:
+            msg += f'\n    {str(u)}'
+
+    raise ValueError(msg)
 
 
 def store_artefacts(compiled_files: Dict[Path, CompiledFile], build_lists: Dict[str, List], artefact_store):
@@ -294,15 +545,16 @@ def process_file(arg: Tuple[AnalysedFortran, MpCommonArgs]) \
 def _get_obj_combo_hash(analysed_file, mp_common_args: MpCommonArgs, flags):
     # get a combo hash of things which matter to the object file we define
     # todo: don't just silently use 0 for a missing dep hash
-    mod_deps_hashes = {
-        mod_dep: mp_common_args.mod_hashes.get(mod_dep, 0) for mod_dep in analysed_file.module_deps}
+    mod_deps_hashes = []
+    for mod_dep in sorted(analysed_file.module_deps):
+        mod_deps_hashes.extend([mod_dep, mp_common_args.mod_hashes.get(mod_dep, 0)])
     try:
-        obj_combo_hash = sum([
+        obj_combo_hash = combo_checksum([
             analysed_file.file_hash,
             flags_checksum(flags),
-            sum(mod_deps_hashes.values()),
-            zlib.crc32(mp_common_args.compiler.encode()),
-            zlib.crc32(mp_common_args.compiler_version.encode()),
+            mp_common_args.compiler,
+            mp_common_args.compiler_version,
+            *mod_deps_hashes,
         ])
     except TypeError:
         raise ValueError("could not generate combo hash for object file")
@@ -312,10 +564,10 @@ def _get_obj_combo_hash(analysed_file, mp_common_args: MpCommonArgs, flags):
 def _get_mod_combo_hash(analysed_file, mp_common_args: MpCommonArgs):
     # get a combo hash of things which matter to the mod files we define
     try:
-        mod_combo_hash = sum([
+        mod_combo_hash = combo_checksum([
             analysed_file.file_hash,
-            zlib.crc32(mp_common_args.compiler.encode()),
-            zlib.crc32(mp_common_args.compiler_version.encode()),
+            mp_common_args.compiler,
+            mp_common_args.compiler_version,
         ])
     except TypeError:
         raise ValueError("could not generate combo hash for mod files")
@@ -331,6 +583,7 @@ def compile_file(analysed_file, flags, output_fpath, mp_common_args):
     which would cause them to have different checksums depending on where they live.
 
     """
+    usage: Dict[str, int] = {}
     with Timer() as timer:
         output_fpath.parent.mkdir(parents=True, exist_ok=True)
 
@@ -357,14 +610,17 @@ def compile_file(analysed_file, flags, output_fpath, mp_common_args):
         command.append(analysed_file.fpath.name)
         command.extend(['-o', str(output_fpath)])
 
-        run_command(command, cwd=analysed_file.fpath.parent)
+        run_command(command, cwd=analysed_file.fpath.parent, usage=usage)
 
     # todo: probably better to record both mod and obj metrics
-    metric_name = "compile_fortran" + (f' stage {mp_common_args.stage}' if mp_common_args.stage else '')
     send_metric(
-        group=metric_name,
+        group=_metric_name(mp_common_args.stage),
         name=str(analysed_file.fpath),
-        value={'time_taken': timer.taken, 'start': timer.start})
+        value={'time_taken': timer.taken, 'start': timer.start, 'peak_rss': usage.get('peak_rss')})
+
+
+def _metric_name(stage: Optional[int]) -> str:
+    return "compile_fortran" + (f' stage {stage}' if stage else '')
 
 
 # todo: move this
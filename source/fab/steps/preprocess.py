@@ -84,7 +84,7 @@ def pre_processor(config: BuildConfig, preprocessor: str,
     # bundle files with common args
     mp_args = [(file, mp_common_args) for file in files]
 
-    results = run_mp(config, items=mp_args, func=process_artefact)
+    results = run_mp(config, items=mp_args, func=process_artefact, stop_on_error=True, uses_tools=True)
     check_for_errors(results, caller_label=name)
 
     log_or_dot_finish(logger)
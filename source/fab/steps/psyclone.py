@@ -10,7 +10,6 @@ https://github.com/stfc/PSyclone
 """
 from dataclasses import dataclass
 import logging
-import re
 import shutil
 import warnings
 from itertools import chain
@@ -22,11 +21,11 @@ from fab.tools import run_command
 
 from fab.artefacts import ArtefactsGetter, CollectionConcat, SuffixFilter
 from fab.parse.fortran import FortranAnalyser, AnalysedFortran
-from fab.parse.x90 import X90Analyser, AnalysedX90
-from fab.steps import run_mp, check_for_errors, step
+from fab.parse.x90 import X90Analyser, AnalysedX90, make_parsable_x90_source
+from fab.steps import run_mp, check_for_errors, step, PerWorker
 from fab.steps.preprocess import get_fortran_preprocessor, pre_processor
 from fab.util import log_or_dot, input_to_output_fpath, file_checksum, file_walk, TimerLogger, \
-    string_checksum, suffix_filter, by_type, log_or_dot_finish
+    string_checksum, suffix_filter, by_type, log_or_dot_finish, combo_checksum
 
 logger = logging.getLogger(__name__)
 
@@ -143,7 +142,7 @@ def psyclone(config, kernel_roots: Optional[List[Path]] = None,
     # for every file, we get back a list of its output files plus a list of the prebuild copies.
     mp_arg = [(x90, mp_payload) for x90 in x90s]
     with TimerLogger(f"running psyclone on {len(x90s)} x90 files"):
-        results = run_mp(config, mp_arg, do_one_file)
+        results = run_mp(config, mp_arg, do_one_file, stop_on_error=True, uses_tools=True)
     log_or_dot_finish(logger)
     outputs, prebuilds = zip(*results) if results else ((), ())
     check_for_errors(outputs, caller_label='psyclone')
@@ -249,17 +248,14 @@ def _analysis_for_prebuilds(config, x90s, transformation_script, kernel_roots) -
 
 
 def _analyse_x90s(config, x90s: Set[Path]) -> Dict[Path, AnalysedX90]:
-    # Analyse parsable versions of the x90s, finding kernel dependencies.
-
-    # make parsable - todo: fast enough not to require prebuilds?
-    with TimerLogger(f"converting {len(x90s)} x90s into parsable fortran"):
-        parsable_x90s = run_mp(config, items=x90s, func=make_parsable_x90)
-
-    # parse
+    # Analyse the x90s, finding kernel dependencies.
+    # The analyser makes parsable versions in memory, and stores the results against the hashes of the x90s,
+    # so unchanged x90s aren't converted or parsed again.
     x90_analyser = X90Analyser()
     x90_analyser._config = config
-    with TimerLogger(f"analysing {len(parsable_x90s)} parsable x90 files"):
-        x90_results = run_mp(config, items=parsable_x90s, func=x90_analyser.run)
+    with TimerLogger(f"analysing {len(x90s)} x90 files"):
+        with PerWorker(x90_analyser.run, config) as analyse_file:
+            x90_results = run_mp(config, items=x90s, func=analyse_file)
     log_or_dot_finish(logger)
     x90_analyses, x90_artefacts = zip(*x90_results) if x90_results else ((), ())
     check_for_errors(results=x90_analyses)
@@ -268,15 +264,10 @@ def _analyse_x90s(config, x90s: Set[Path]) -> Dict[Path, AnalysedX90]:
     prebuild_files = list(by_type(x90_artefacts, Path))
     config.add_current_prebuilds(prebuild_files)
 
-    # record the analysis results against the original x90 filenames (not the parsable versions we analysed)
-    analysed_x90 = by_type(x90_analyses, AnalysedX90)
-    analysed_x90 = {result.fpath.with_suffix('.x90'): result for result in analysed_x90}
-
-    # make the hashes from the original x90s, not the parsable versions which have invoke names removed.
-    for p, r in analysed_x90.items():
-        analysed_x90[p]._file_hash = file_checksum(p).file_hash
-
-    return analysed_x90
+    analysed_x90s = {result.fpath: result for result in by_type(x90_analyses, AnalysedX90)}
+    for analysed_x90 in analysed_x90s.values():
+        analysed_x90.freeze()
+    return analysed_x90s
 
 
 def _analyse_kernels(config, kernel_roots) -> Dict[str, int]:
@@ -292,7 +283,8 @@ def _analyse_kernels(config, kernel_roots) -> Dict[str, int]:
     fortran_analyser = FortranAnalyser()
     fortran_analyser._config = config
     with TimerLogger(f"analysing {len(kernel_files)} potential psyclone kernel files"):
-        fortran_results = run_mp(config, items=kernel_files, func=fortran_analyser.run)
+        with PerWorker(fortran_analyser.run, config) as analyse_file:
+            fortran_results = run_mp(config, items=kernel_files, func=analyse_file)
     log_or_dot_finish(logger)
     fortran_analyses, fortran_artefacts = zip(*fortran_results) if fortran_results else (tuple(), tuple())
 
@@ -384,18 +376,19 @@ def _gen_prebuild_hash(x90_file: Path, mp_payload: MpCommonArgs):
     analysis_result = mp_payload.analysed_x90[x90_file]  # type: ignore
 
     # include the hashes of kernels used by this x90
-    kernel_deps_hashes = {
-        mp_payload.all_kernel_hashes[kernel_name] for kernel_name in analysis_result.kernel_deps}  # type: ignore
+    kernel_deps_hashes: List[Union[int, str]] = []
+    for kernel_name in sorted(analysis_result.kernel_deps):  # type: ignore
+        kernel_deps_hashes.extend([kernel_name, mp_payload.all_kernel_hashes[kernel_name]])  # type: ignore
 
     # hash everything which should trigger re-processing
     # todo: hash the psyclone version in case the built-in kernels change?
-    prebuild_hash = sum([
+    prebuild_hash = combo_checksum([
 
         # the hash of the x90 (not of the parsable version, so includes invoke names)
         analysis_result.file_hash,
 
         # the hashes of the kernels used by this x90
-        sum(kernel_deps_hashes),
+        *kernel_deps_hashes,
 
         #
         mp_payload.transformation_script_hash,
@@ -456,62 +449,16 @@ def _check_override(check_path: Path, mp_payload: MpCommonArgs):
     return check_path
 
 
-# regex to convert an x90 into parsable fortran, so it can be analysed using a third party tool
-
-WHITE = r'[\s&]+'
-OPT_WHITE = r'[\s&]*'
-
-SQ_STRING = "'[^']*'"
-DQ_STRING = '"[^"]*"'
-STRING = f'({SQ_STRING}|{DQ_STRING})'
-
-NAME_KEYWORD = 'name' + OPT_WHITE + '=' + OPT_WHITE + STRING + OPT_WHITE + ',' + OPT_WHITE
-NAMED_INVOKE = 'call' + WHITE + 'invoke' + OPT_WHITE + r'\(' + OPT_WHITE + NAME_KEYWORD
-
-_x90_compliance_pattern = None
-
-
-# todo: In the future, we'd like to extend fparser to handle the leading invoke keywords. (Lots of effort.)
 def make_parsable_x90(x90_path: Path) -> Path:
     """
-    Take out the leading name keyword in calls to invoke(), making temporary, parsable fortran from x90s.
+    Write a parsable fortran version of an x90 file, next to it. See :func:`~fab.parse.x90.make_parsable_x90_source`.
 
-    If present it looks like this::
-
-        call invoke( name = "compute_dry_mass", ...
+    The x90 analyser does this in memory, so this is only used to look at the result.
 
     Returns the path of the parsable file.
 
-    This function is not slow so we're not creating prebuilds for this work.
-
     """
-    global _x90_compliance_pattern
-    if not _x90_compliance_pattern:
-        _x90_compliance_pattern = re.compile(pattern=NAMED_INVOKE)
-
-    # src = open(x90_path, 'rt').read()
-
-    # Before we remove the name keywords to invoke, we must remove any comment lines.
-    # This is the simplest way to avoid producing bad fortran when the name keyword is followed by a comment line.
-    # I.e. The comment line doesn't have an "&", so we get "call invoke(!" with no "&", which is a syntax error.
-    src_lines = open(x90_path, 'rt').readlines()
-    no_comment_lines = [line for line in src_lines if not line.lstrip().startswith('!')]
-    src = ''.join(no_comment_lines)
-
-    replaced = []
-
-    def repl(matchobj):
-        # matchobj[0] contains the entire matching string, from "call" to the "," after the name keyword.
-        # matchobj[1] contains the single group in the search pattern, which is defined in STRING.
-        name = matchobj[1].replace('"', '').replace("'", "")
-        replaced.append(name)
-        return 'call invoke('
-
-    out = _x90_compliance_pattern.sub(repl=repl, string=src)
-
+    out = make_parsable_x90_source(x90_path.read_text())
     out_path = x90_path.with_suffix('.parsable_x90')
-    open(out_path, 'wt').write(out)
-
-    logger.debug(f'names removed from {str(x90_path)}: {replaced}')
-
+    out_path.write_text(out)
     return out_path
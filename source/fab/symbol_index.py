@@ -0,0 +1,205 @@
+##############################################################################
+# (c) Crown copyright Met Office. All rights reserved.
+# For further details please refer to the file COPYRIGHT
+# which you should have received as part of this distribution
+##############################################################################
+"""
+A symbol table, and the file dependencies resolved from it, kept between builds.
+
+After a small change to the source, only the changed files, and the files which use symbols that have moved,
+need their dependencies resolving again.
+
+"""
+import logging
+import os
+import pickle
+import warnings
+from pathlib import Path
+from typing import Dict, FrozenSet, Iterable, List, NamedTuple, Set
+
+from fab.dep_tree import AnalysedDependent
+
+logger = logging.getLogger(__name__)
+
+
+class _IndexedFile(NamedTuple):
+    file_hash: int
+    symbol_defs: FrozenSet[str]
+    symbol_deps: FrozenSet[str]
+    file_deps: FrozenSet[Path]
+
+
+class SymbolIndex(object):
+    """
+    Maps symbols to the files which define them, and records the file dependencies of every analysed file.
+
+    A file is reindexed when its hash changes. When the file which defines a symbol changes, the files which use
+    that symbol have their dependencies resolved again. Everything is reindexed if the settings change,
+    such as the analysers used, because the same file might then have different results.
+
+    Like :func:`~fab.steps.analyse._gen_symbol_table`, when a symbol is defined in more than one file,
+    the first file we were given wins. If that file is removed, the next one takes over.
+
+    """
+    def __init__(self, fpath: Path, settings: str = ''):
+        """
+        :param fpath:
+            Where the index is kept between builds. It's created if it doesn't exist.
+        :param settings:
+            Describes anything, other than the files, which affects the analysis results.
+
+        """
+        self.fpath = fpath
+        self.settings = settings
+
+        self._files: Dict[Path, _IndexedFile] = {}
+        # all the files defining each symbol, in the order we found them
+        self._definers: Dict[str, List[Path]] = {}
+        # the files using each symbol
+        self._users: Dict[str, Set[Path]] = {}
+        self._duplicates: Set[str] = set()
+
+        self.symbol_table: Dict[str, Path] = {}
+
+        # whether the index differs from the file, so it needs saving
+        self._dirty = False
+
+        self._load()
+
+    def _load(self):
+        if not self.fpath.exists():
+            return
+        try:
+            with open(self.fpath, 'rb') as infile:
+                state = pickle.load(infile)
+        except Exception as err:
+            logger.warning(f'discarding unreadable symbol index {self.fpath}: {err}')
+            self._dirty = True
+            return
+
+        if state['settings'] != self.settings:
+            logger.info('analysis settings have changed, rebuilding the symbol index')
+            self._dirty = True
+            return
+        self._files = state['files']
+        self._definers = state['definers']
+        self._users = state['users']
+        self._duplicates = state['duplicates']
+        self.symbol_table = state['symbol_table']
+
+    def save(self):
+        """
+        Write the index, via a temporary file so a crash can't leave a partial index.
+
+        Nothing is written if the index hasn't changed since it was loaded.
+
+        """
+        if not self._dirty:
+            return
+
+        self.fpath.parent.mkdir(parents=True, exist_ok=True)
+        state = {
+            'settings': self.settings,
+            'files': self._files,
+            'definers': self._definers,
+            'users': self._users,
+            'duplicates': self._duplicates,
+            'symbol_table': self.symbol_table,
+        }
+        tmp_fpath = self.fpath.with_suffix('.tmp')
+        with open(tmp_fpath, 'wb') as outfile:
+            pickle.dump(state, outfile)
+        os.replace(tmp_fpath, self.fpath)
+        self._dirty = False
+
+    def update(self, analysed_files: Iterable[AnalysedDependent]) -> Dict[str, Path]:
+        """
+        Bring the index up to date with the given analysis results, and fill in their file dependencies.
+
+        Returns the symbol table, mapping each symbol to the file which defines it.
+
+        :param analysed_files:
+            Every analysed file in the project, with no file dependencies yet.
+            Files which were in the index, but aren't given, are removed from it.
+
+        """
+        by_path = {af.fpath: af for af in analysed_files}
+
+        changed = [af for fpath, af in by_path.items()
+                   if fpath not in self._files or self._files[fpath].file_hash != af.file_hash]
+        removed = [fpath for fpath in self._files if fpath not in by_path]
+        logger.info(f'symbol index: {len(changed)} new or changed files, {len(removed)} removed')
+        if changed or removed:
+            self._dirty = True
+
+        # forget the old results
+        touched: Set[str] = set()
+        for fpath in removed + [af.fpath for af in changed if af.fpath in self._files]:
+            indexed = self._files.pop(fpath)
+            touched.update(indexed.symbol_defs)
+            for symbol in indexed.symbol_defs:
+                self._definers[symbol].remove(fpath)
+            for symbol in indexed.symbol_deps:
+                self._users[symbol].discard(fpath)
+
+        # add the new ones
+        for af in changed:
+            touched.update(af.symbol_defs)
+            for symbol in af.symbol_defs:
+                self._definers.setdefault(symbol, []).append(af.fpath)
+            for symbol in af.symbol_deps:
+                self._users.setdefault(symbol, set()).add(af.fpath)
+
+        # which symbols are now defined somewhere else?
+        moved: Set[str] = set()
+        for symbol in touched:
+            definers = self._definers.get(symbol)
+            if not definers:
+                self._definers.pop(symbol, None)
+                self._duplicates.discard(symbol)
+                if self.symbol_table.pop(symbol, None):
+                    moved.add(symbol)
+                continue
+
+            if len(definers) > 1:
+                self._duplicates.add(symbol)
+            else:
+                self._duplicates.discard(symbol)
+            if self.symbol_table.get(symbol) != definers[0]:
+                self.symbol_table[symbol] = definers[0]
+                moved.add(symbol)
+
+        # resolve the dependencies of the changed files, and the files using the symbols which moved
+        to_resolve = {af.fpath for af in changed}
+        for symbol in moved:
+            to_resolve.update(self._users.get(symbol, ()))
+        for fpath in to_resolve:
+            self._resolve(by_path[fpath])
+        logger.info(f'symbol index: resolved the dependencies of {len(to_resolve)} files')
+
+        for fpath, af in by_path.items():
+            af.file_deps.update(self._files[fpath].file_deps)
+
+        if self._duplicates:
+            # we don't break the build because these symbols might not be required to build the exe
+            err_msg = "\n".join(
+                f"duplicate symbol '{symbol}' defined in {', '.join(map(str, self._definers[symbol]))}"
+                for symbol in sorted(self._duplicates))
+            warnings.warn(f"Duplicates found while generating symbol table:\n{err_msg}")
+
+        return self.symbol_table
+
+    def _resolve(self, analysed_file: AnalysedDependent):
+        file_deps = set()
+        for symbol_dep in analysed_file.symbol_deps:
+            file_dep = self.symbol_table.get(symbol_dep)
+            if not file_dep:
+                logger.debug(f"not found {symbol_dep} for {analysed_file.fpath}")
+            elif file_dep != analysed_file.fpath:
+                file_deps.add(file_dep)
+
+        self._files[analysed_file.fpath] = _IndexedFile(
+            file_hash=analysed_file.file_hash,
+            symbol_defs=frozenset(analysed_file.symbol_defs),
+            symbol_deps=frozenset(analysed_file.symbol_deps),
+            file_deps=frozenset(file_deps))
@@ -8,10 +8,13 @@ Known command line tools whose flags we wish to manage.
 
 """
 import logging
+import os
 from pathlib import Path
 import subprocess
+import sys
+from tempfile import TemporaryFile
 import warnings
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from fab.util import string_checksum
 
@@ -82,7 +85,8 @@ def flags_checksum(flags: List[str]):
     return string_checksum(str(flags))
 
 
-def run_command(command: List[str], env=None, cwd: Optional[Union[Path, str]] = None, capture_output=True):
+def run_command(command: List[str], env=None, cwd: Optional[Union[Path, str]] = None, capture_output=True,
+                usage: Optional[Dict[str, Any]] = None):
     """
     Run a CLI command.
 
@@ -92,11 +96,16 @@ def run_command(command: List[str], env=None, cwd: Optional[Union[Path, str]] =
         Optional env for the command. By default it will use the current session's environment.
     :param capture_output:
         If True, capture and return stdout. If False, the command will print its output directly to the console.
+    :param usage:
+        Optional dict, which is given the command's `peak_rss` in bytes where the platform can tell us.
 
     """
     command = list(map(str, command))
     logger.debug(f'run_command: {" ".join(command)}')
-    res = subprocess.run(command, capture_output=capture_output, env=env, cwd=cwd)
+    if usage is not None and hasattr(os, 'wait4'):
+        res = _run_with_usage(command, env=env, cwd=cwd, capture_output=capture_output, usage=usage)
+    else:
+        res = subprocess.run(command, capture_output=capture_output, env=env, cwd=cwd)
     if res.returncode != 0:
         msg = f'Command failed with return code {res.returncode}:\n{command}'
         if res.stdout:
@@ -109,6 +118,26 @@ def run_command(command: List[str], env=None, cwd: Optional[Union[Path, str]] =
         return res.stdout.decode()
 
 
+def _run_with_usage(command: List[str], env, cwd, capture_output, usage: Dict[str, Any]) \
+        -> subprocess.CompletedProcess:
+    # Like subprocess.run, but we wait for the process ourselves to get its resource usage.
+    # The output goes to temporary files because reading pipes, with communicate(), would also wait for it.
+    with TemporaryFile() as stdout, TemporaryFile() as stderr:
+        output = {'stdout': stdout, 'stderr': stderr} if capture_output else {}
+        proc = subprocess.Popen(command, env=env, cwd=cwd, **output)  # type: ignore
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+        # linux reports kilobytes, mac reports bytes
+        usage['peak_rss'] = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+        if capture_output:
+            stdout.seek(0)
+            stderr.seek(0)
+            return subprocess.CompletedProcess(command, proc.returncode, stdout.read(), stderr.read())
+        return subprocess.CompletedProcess(command, proc.returncode)
+
+
 def get_tool(tool_str: Optional[str] = None) -> Tuple[str, List[str]]:
     """
     Get the compiler, preprocessor, etc, from the given string.
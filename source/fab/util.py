@@ -9,15 +9,25 @@ Various utility functions live here - until we give them a proper place to live!
 """
 
 import datetime
+import gc
+import hashlib
 import logging
 import os
+import sqlite3
 import sys
+import threading
+import time
 import zlib
 from argparse import ArgumentParser
 from collections import namedtuple, defaultdict
 from pathlib import Path
 from time import perf_counter
-from typing import Iterator, Iterable, Optional, Dict, Set, Union, List
+from typing import Callable, Iterator, Iterable, Optional, Dict, Set, Union, List
+
+try:
+    import xxhash  # type: ignore
+except ImportError:
+    xxhash = None
 
 logger = logging.getLogger(__name__)
 
@@ -47,18 +57,229 @@ def log_or_dot_finish(logger):
 HashedFile = namedtuple("HashedFile", ['fpath', 'file_hash'])
 
 
+def _blake2b(data: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'big')
+
+
+# The algorithms we can use for checksums, each a function turning bytes into an unsigned int.
+# Python's out-the-box hash isn't deterministic across Python invocations, so can't be used.
+HASH_ALGORITHMS: Dict[str, Callable[[bytes], int]] = {
+    'crc32': zlib.crc32,
+    'blake2b': _blake2b,
+}
+if xxhash:
+    HASH_ALGORITHMS['xxhash'] = xxhash.xxh3_64_intdigest
+
+# 64 bit, in the standard library, and fast enough that it's rarely noticed next to reading the file.
+# See Experimental/BenchmarkHashes.
+DEFAULT_HASH_ALGORITHM = 'blake2b'
+
+_hash_algorithm = DEFAULT_HASH_ALGORITHM
+
+
+def set_hash_algorithm(name: str):
+    """
+    Choose the algorithm for all checksums, from :data:`HASH_ALGORITHMS`.
+
+    The build config sets this when the build starts, so every process in the build uses the same algorithm.
+    Prebuild files made with one algorithm won't be found with another.
+
+    """
+    global _hash_algorithm
+    if name not in HASH_ALGORITHMS:
+        raise ValueError(f"unknown hash algorithm '{name}', expected one of {', '.join(HASH_ALGORITHMS)}")
+    _hash_algorithm = name
+
+
+def get_hash_algorithm() -> str:
+    """
+    The name of the algorithm used for checksums.
+
+    """
+    return _hash_algorithm
+
+
+def bytes_checksum(data: bytes) -> int:
+    """
+    Return a checksum of the given bytes, using the current hash algorithm.
+
+    This function is deterministic, returning the same result across Python invocations.
+
+    """
+    return HASH_ALGORITHMS[_hash_algorithm](data)
+
+
 def file_checksum(fpath):
     """
     Return a checksum of the given file.
 
     This function is deterministic, returning the same result across Python invocations.
 
-    We use crc32 for now because it's deterministic, unlike out-the-box hash.
-    We could seed hash with a non-random or look into hashlib, if/when we want to improve this.
+    While a build is running, the checksum usually comes from the :class:`HashCache`,
+    without reading the file.
 
     """
+    if _hash_cache:
+        return HashedFile(fpath, _hash_cache.checksum(fpath))
+    return HashedFile(fpath, _read_checksum(fpath))
+
+
+def _read_checksum(fpath) -> int:
     with open(fpath, "rb") as infile:
-        return HashedFile(fpath, zlib.crc32(infile.read()))
+        return bytes_checksum(infile.read())
+
+
+class SQLiteDB(object):
+    """
+    Base class for a small SQLite database which can be used from worker processes and threads.
+
+    Each thread in each process opens its own connection when first needed. A pickled copy has no connection.
+
+    """
+    # statements to run when the database is opened
+    _schema: List[str] = []
+
+    def __init__(self, fpath: Path):
+        """
+        :param fpath:
+            The database file, which is created when first used.
+
+        """
+        self.fpath = Path(fpath)
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # connections can't be sent to other processes
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        # a connection for this thread, which can't be used from a forked process
+        if getattr(self._local, 'pid', None) != os.getpid():
+            self.fpath.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(str(self.fpath), timeout=60)
+            with conn:
+                for statement in self._schema:
+                    conn.execute(statement)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+
+def to_sqlite_int(value: int) -> int:
+    """
+    Convert an unsigned 64 bit checksum into the signed range of an SQLite integer.
+
+    """
+    return value - 2**64 if value >= 2**63 else value
+
+
+def from_sqlite_int(value: int) -> int:
+    """
+    Reverse :func:`to_sqlite_int`.
+
+    """
+    return value + 2**64 if value < 0 else value
+
+
+# the hash cache used by file_checksum, while a build is running
+_hash_cache: Optional['HashCache'] = None
+
+
+def set_hash_cache(hash_cache: Optional['HashCache']):
+    """
+    Set the :class:`HashCache` used by :func:`file_checksum`, or None to always read the files.
+
+    The build config sets this when the build starts, before the worker pool is created.
+
+    """
+    global _hash_cache
+    _hash_cache = hash_cache
+
+
+class HashCache(SQLiteDB):
+    """
+    Remembers file checksums, so that unchanged files don't need to be read again.
+
+    A file's checksum is stored with its size, modification time, inode and the hash algorithm.
+    If these are unchanged when we next need the checksum, we return the stored value.
+
+    Files modified in the last few seconds aren't stored, because a filesystem with a coarse timestamp
+    wouldn't see a second change in the same tick.
+    Writes are synced at SQLite's normal level, which keeps the database intact after a crash of Fab,
+    if not always after a power failure. If it's unusable, we read the files instead.
+
+    """
+    _schema = [
+        'PRAGMA synchronous = NORMAL',
+        'CREATE TABLE IF NOT EXISTS checksums ('
+        'fpath TEXT, algorithm TEXT, size INTEGER, mtime_ns INTEGER, inode INTEGER, file_hash INTEGER, '
+        'PRIMARY KEY (fpath, algorithm))',
+    ]
+
+    # how long ago, in nanoseconds, a file must have been modified for us to store its checksum
+    RACY_NS = 2 * 10**9
+
+    def __init__(self, fpath: Path, verify: bool = False):
+        """
+        :param fpath:
+            The database file, which is created when first used.
+        :param verify:
+            Read every file anyway, and warn about any stored checksum which is wrong.
+
+        """
+        super().__init__(fpath)
+        self.verify = verify
+        self.broken = False
+
+    def checksum(self, fpath) -> int:
+        """
+        Return the checksum of a file, from the cache if the file hasn't changed.
+
+        """
+        if self.broken:
+            return _read_checksum(fpath)
+
+        stat = os.stat(fpath)
+        key = str(Path(fpath).absolute()), _hash_algorithm
+        try:
+            row = self.conn.execute(
+                'SELECT size, mtime_ns, inode, file_hash FROM checksums WHERE fpath = ? AND algorithm = ?',
+                key).fetchone()
+        except sqlite3.DatabaseError as err:
+            return self._broken(fpath, err)
+
+        if row and tuple(row[:3]) == (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+            stored = from_sqlite_int(row[3])
+            if not self.verify:
+                return stored
+            file_hash = _read_checksum(fpath)
+            if file_hash != stored:
+                logger.warning(f'hash cache was wrong for {fpath}')
+        else:
+            file_hash = _read_checksum(fpath)
+
+        if time.time_ns() - stat.st_mtime_ns > self.RACY_NS:
+            try:
+                with self.conn:
+                    self.conn.execute(
+                        'INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?)',
+                        (*key, stat.st_size, stat.st_mtime_ns, stat.st_ino, to_sqlite_int(file_hash)))
+            except sqlite3.DatabaseError as err:
+                return self._broken(fpath, err)
+
+        return file_hash
+
+    def _broken(self, fpath, err) -> int:
+        logger.warning(f'hash cache {self.fpath} is unusable, reading files instead: {err}')
+        self.broken = True
+        return _read_checksum(fpath)
 
 
 def string_checksum(s: str):
@@ -67,11 +288,28 @@ def string_checksum(s: str):
 
     This function is deterministic, returning the same result across Python invocations.
 
-    We use crc32 for now because it's deterministic, unlike out-the-box hash.
-    We could seed hash with a non-random or look into hashlib, if/when we want to improve this.
+    """
+    return bytes_checksum(s.encode())
+
 
+def combo_checksum(parts: Iterable[Union[int, str]]) -> int:
     """
-    return zlib.crc32(s.encode())
+    Return a checksum of several values, such as the checksums of everything which goes into a prebuild.
+
+    The order matters, so swapping two values gives a different checksum, unlike adding them.
+    Each value is length-prefixed, so values can't run into each other.
+
+    :param parts:
+        Ints and strings, in a deterministic order.
+
+    """
+    data = bytearray()
+    for part in parts:
+        if not isinstance(part, (int, str)):
+            raise TypeError(f'cannot checksum {type(part)}')
+        part_bytes = str(part).encode()
+        data += len(part_bytes).to_bytes(4, 'big') + part_bytes
+    return bytes_checksum(bytes(data))
 
 
 def file_walk(path: Union[str, Path], ignore_folders: Optional[List[Path]] = None) -> Iterator[Path]:
@@ -157,6 +395,98 @@ class TimerLogger(Timer):
                 logger.info(f"{self.label} took {seconds:.3f}s")
 
 
+# The pid of this process, and its highest peak memory before PeakRSS reset it. See :func:`process_peak_rss`.
+_cleared_peak_rss = (0, 0)
+
+
+class PeakRSS(object):
+    """
+    A context manager which measures how far the resident memory of this process rose while it's active, in bytes.
+
+    The peak is above the memory in use when it started, so it's the work's own memory, not including the
+    process's baseline, such as the parser's class tables in a worker.
+
+    This needs Linux, where we can reset the process's peak memory. Elsewhere, the peak is None.
+    The peak before the reset is kept for :func:`process_peak_rss`.
+
+    """
+    def __init__(self):
+        self.peak: Optional[int] = None
+        self._measuring = False
+        self._start_rss = 0
+
+    def __enter__(self):
+        global _cleared_peak_rss
+        _cleared_peak_rss = os.getpid(), process_peak_rss()
+        try:
+            with open('/proc/self/clear_refs', 'wt') as clear_refs:
+                clear_refs.write('5')
+            self._measuring = True
+        except OSError:
+            self._measuring = False
+        self._start_rss = process_memory().get('VmRSS', 0)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not self._measuring:
+            return
+        peak = process_memory().get('VmHWM')
+        self.peak = max(peak - self._start_rss, 0) if peak is not None else None
+
+
+def process_peak_rss() -> int:
+    """
+    The peak resident memory of this process since it started, in bytes, even if :class:`PeakRSS` has reset
+    the peak which Linux reports. Elsewhere, this is zero.
+
+    """
+    pid, cleared_peak = _cleared_peak_rss
+    if pid != os.getpid():
+        # we were forked, the peak is our parent's
+        cleared_peak = 0
+    return max(cleared_peak, process_memory().get('VmHWM', 0))
+
+
+def process_memory(pid: Optional[int] = None) -> Dict[str, int]:
+    """
+    The resident memory of a process, in bytes, from Linux's process status. Elsewhere, this is empty.
+
+    Returns the current resident memory, *VmRSS*, and its peak, *VmHWM*.
+
+    :param pid:
+        The process to look at. Defaults to this one.
+
+    """
+    memory = {}
+    try:
+        with open(f'/proc/{pid or "self"}/status', 'rt') as status:
+            for line in status:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    key, value = line.split()[:2]
+                    memory[key[:-1]] = int(value) * 1024
+    except OSError:
+        pass
+    return memory
+
+
+class PausedGC(object):
+    """
+    A context manager which pauses Python's garbage collector while it's active.
+
+    Creating many objects, such as when loading tens of thousands of analysis results, triggers repeated
+    collections which scan everything we've already loaded, none of which is garbage.
+
+    """
+    def __enter__(self):
+        self._was_enabled = gc.isenabled()
+        gc.disable()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._was_enabled:
+            gc.enable()
+
+
 # todo: move this
 class CompiledFile(object):
     """
@@ -302,5 +632,23 @@ def common_arg_parser() -> ArgumentParser:
     group.add_argument(
         '--two-stage', action='store_true',
         help='Compile .mod files first in a separate pass. Theoretically faster in some projects.')
+    group.add_argument(
+        '--fail-fast', action='store_true',
+        help='Stop all outstanding work as soon as anything fails.')
+    group.add_argument(
+        '--keep-going', action='store_true',
+        help="Compile everything which doesn't depend on a failure before reporting the errors.")
+    group.add_argument(
+        '--resume', action='store_true',
+        help='Skip the steps completed by an interrupted run, restoring their artefacts.')
+    group.add_argument(
+        '--hash-cache', action='store_true',
+        help="Remember file checksums, so unchanged files don't need to be read again.")
+    group.add_argument(
+        '--verify-hashes', action='store_true',
+        help='Use the hash cache, but read every file to check the cached checksums.')
+    group.add_argument(
+        '--hash-algorithm', choices=sorted(HASH_ALGORITHMS), default=None,
+        help=f'The algorithm for file checksums and prebuild names. Defaults to {DEFAULT_HASH_ALGORITHM}.')
 
     return arg_parser
@@ -8,7 +8,8 @@ from pathlib import Path
 
 from fab.build_config import BuildConfig
 from fab.constants import EXECUTABLES
-from fab.parse.fortran import AnalysedFortran
+from fab.parse.analysis_db import load_analyses
+from fab.parse.fortran import AnalysedFortran, FortranAnalyser
 from fab.steps.analyse import analyse
 from fab.steps.compile_c import compile_c
 from fab.steps.compile_fortran import compile_fortran
@@ -16,6 +17,7 @@ from fab.steps.find_source_files import find_source_files
 from fab.steps.grab.folder import grab_folder
 from fab.steps.link import link_exe
 from fab.steps.preprocess import preprocess_fortran
+from fab.util import file_checksum
 
 
 def test_FortranDependencies(tmp_path):
@@ -45,29 +47,38 @@ def test_FortranDependencies(tmp_path):
     }
 
     # check the analysis results
-    assert AnalysedFortran.load(config.prebuild_folder / 'first.193489053.an') == AnalysedFortran(
-        fpath=config.source_root / 'first.f90', file_hash=193489053,
+    fortran_analyser = FortranAnalyser()
+    fortran_analyser._config = config
+    analysed = load_analyses(
+        fortran_analyser, [file_checksum(config.source_root / name) for name in
+                           ['first.f90', 'two.f90', 'greeting_mod.f90', 'bye_mod.f90', 'constants_mod.f90']])
+    analysed_files = {af.fpath.name: af for af in analysed}
+
+    assert analysed_files['first.f90'] == AnalysedFortran(
+        fpath=config.source_root / 'first.f90', file_hash=file_checksum(config.source_root / 'first.f90').file_hash,
         program_defs={'first'},
         module_defs=None, symbol_defs={'first'},
         module_deps={'greeting_mod', 'constants_mod'}, symbol_deps={'greeting_mod', 'constants_mod', 'greet'})
 
-    assert AnalysedFortran.load(config.prebuild_folder / 'two.2557739057.an') == AnalysedFortran(
-        fpath=config.source_root / 'two.f90', file_hash=2557739057,
+    assert analysed_files['two.f90'] == AnalysedFortran(
+        fpath=config.source_root / 'two.f90', file_hash=file_checksum(config.source_root / 'two.f90').file_hash,
         program_defs={'second'},
         module_defs=None, symbol_defs={'second'},
         module_deps={'constants_mod', 'bye_mod'}, symbol_deps={'constants_mod', 'bye_mod', 'farewell'})
 
-    assert AnalysedFortran.load(config.prebuild_folder / 'greeting_mod.62446538.an') == AnalysedFortran(
-        fpath=config.source_root / 'greeting_mod.f90', file_hash=62446538,
+    assert analysed_files['greeting_mod.f90'] == AnalysedFortran(
+        fpath=config.source_root / 'greeting_mod.f90',
+        file_hash=file_checksum(config.source_root / 'greeting_mod.f90').file_hash,
         module_defs={'greeting_mod'}, symbol_defs={'greeting_mod'},
         module_deps={'constants_mod'}, symbol_deps={'constants_mod'})
 
-    assert AnalysedFortran.load(config.prebuild_folder / 'bye_mod.3332267073.an') == AnalysedFortran(
-        fpath=config.source_root / 'bye_mod.f90', file_hash=3332267073,
+    assert analysed_files['bye_mod.f90'] == AnalysedFortran(
+        fpath=config.source_root / 'bye_mod.f90', file_hash=file_checksum(config.source_root / 'bye_mod.f90').file_hash,
         module_defs={'bye_mod'}, symbol_defs={'bye_mod'},
         module_deps={'constants_mod'}, symbol_deps={'constants_mod'})
 
-    assert AnalysedFortran.load(config.prebuild_folder / 'constants_mod.233796393.an') == AnalysedFortran(
-        fpath=config.source_root / 'constants_mod.f90', file_hash=233796393,
+    assert analysed_files['constants_mod.f90'] == AnalysedFortran(
+        fpath=config.source_root / 'constants_mod.f90',
+        file_hash=file_checksum(config.source_root / 'constants_mod.f90').file_hash,
         module_defs={'constants_mod'}, symbol_defs={'constants_mod'},
         module_deps=None, symbol_deps=None)
@@ -8,6 +8,7 @@ import pytest
 
 from fab.build_config import BuildConfig
 from fab.constants import PREBUILD, CURRENT_PREBUILDS, BUILD_OUTPUT
+from fab.parse.fortran import FortranAnalyser
 from fab.steps.analyse import analyse
 from fab.steps.cleanup_prebuilds import cleanup_prebuilds
 from fab.steps.compile_fortran import compile_fortran
@@ -15,7 +16,7 @@ from fab.steps.find_source_files import find_source_files
 from fab.steps.grab.folder import grab_folder
 from fab.steps.link import link_exe
 from fab.steps.preprocess import preprocess_fortran
-from fab.util import file_walk, get_prebuild_file_groups
+from fab.util import file_checksum, file_walk, get_prebuild_file_groups
 
 PROJECT_LABEL = 'tiny_project'
 
@@ -68,17 +69,20 @@ class TestIncremental(object):
 
         # clean build
         clean_files, clean_timestamps, clean_hashes = self.build(config)
+        clean_analysed = self.analysed_hashes(config)
 
         # rebuild
         rebuild_files, rebuild_timestamps, rebuild_hashes = self.build(config)
 
         # Ensure analysis and Fortran output is unchanged.
+        assert self.analysed_hashes(config) == clean_analysed
+
         prebuild_files = filter(lambda p: PREBUILD in str(p), rebuild_files)
         prebuild_groups = get_prebuild_file_groups(prebuild_files)
         prebuild_folder = config.prebuild_folder
 
         self.assert_one_artefact(
-            ['my_mod.*.an', 'my_mod.*.o', 'my_mod.*.mod', 'my_prog.*.an', 'my_prog.*.o'],
+            ['my_mod.*.o', 'my_mod.*.mod', 'my_prog.*.o'],
             prebuild_groups, prebuild_folder, clean_timestamps, clean_hashes, rebuild_timestamps, rebuild_hashes)
 
     def test_fortran_implementation_change(self, config):
@@ -86,6 +90,7 @@ class TestIncremental(object):
 
         # clean build
         clean_files, clean_timestamps, clean_hashes = self.build(config)
+        clean_analysed = self.analysed_hashes(config)
 
         # modify the fortran module source without changing the module interface
         mod_source = config.source_root / 'src/my_mod.F90'
@@ -101,13 +106,15 @@ class TestIncremental(object):
         rebuild_files, rebuild_timestamps, rebuild_hashes = self.build(config)
 
         # ensure the analysis and object files change but the mod file does not
+        self.assert_analysis_changed(config, clean_analysed, changed='my_mod')
+
         prebuild_files = filter(lambda p: PREBUILD in str(p), rebuild_files)
         prebuild_groups = get_prebuild_file_groups(prebuild_files)
         prebuild_folder = config.prebuild_folder
 
         # my_prog should be completely unaffected
         self.assert_one_artefact(
-            ['my_prog.*.an', 'my_prog.*.o'],
+            ['my_prog.*.o'],
             prebuild_groups, prebuild_folder, clean_timestamps, clean_hashes, rebuild_timestamps, rebuild_hashes)
 
         # my_mod will have a new mod file because the source has changed, so it's recompiled into a different artefact,
@@ -117,7 +124,7 @@ class TestIncremental(object):
             prebuild_groups, prebuild_folder, rebuild_hashes)
 
         self.assert_two_different_artefacts(
-            ['my_mod.*.an', 'my_mod.*.o'],
+            ['my_mod.*.o'],
             prebuild_groups, prebuild_folder, rebuild_hashes)
 
     def test_mod_interface_change(self, config):
@@ -125,6 +132,7 @@ class TestIncremental(object):
 
         # clean build
         clean_files, clean_timestamps, clean_hashes = self.build(config)
+        clean_analysed = self.analysed_hashes(config)
 
         # modify the fortran module source, changing the module interface
         mod_source = config.source_root / 'src/my_mod.F90'
@@ -147,15 +155,13 @@ class TestIncremental(object):
         rebuild_files, rebuild_timestamps, rebuild_hashes = self.build(config)
 
         # ensure the analysis and object files change but the mod file does not
+        # my_prog analysis should be unaffected
+        self.assert_analysis_changed(config, clean_analysed, changed='my_mod')
+
         prebuild_files = filter(lambda p: PREBUILD in str(p), rebuild_files)
         prebuild_groups = get_prebuild_file_groups(prebuild_files)
         prebuild_folder = config.prebuild_folder
 
-        # my_prog analysis should be unaffected
-        self.assert_one_artefact(
-            ['my_prog.*.an'],
-            prebuild_groups, prebuild_folder, clean_timestamps, clean_hashes, rebuild_timestamps, rebuild_hashes)
-
         # We've recompiled my_prog because a mod it depends on changed.
         # That means there'll be a different version of the artefact with a new hash of things it depends on.
         # However, it's not *doing* anything different (it doesn't call the new subroutine),
@@ -165,7 +171,7 @@ class TestIncremental(object):
             prebuild_groups, prebuild_folder, rebuild_hashes)
 
         self.assert_two_different_artefacts(
-            ['my_mod.*.an', 'my_mod.*.o', 'my_mod.*.mod'],
+            ['my_mod.*.o', 'my_mod.*.mod'],
             prebuild_groups, prebuild_folder, rebuild_hashes)
 
     # helpers
@@ -181,6 +187,26 @@ class TestIncremental(object):
         hashes = {f: zlib.crc32(open(f, 'rb').read()) for f in all_files}
         return all_files, timestamps, hashes
 
+    def analysed_hashes(self, build_config):
+        # The hashes of the analysed files, which are the preprocessed sources.
+        # Make sure their results are in the analysis database.
+        analysed = {
+            name: file_checksum(build_config.build_output / 'src' / f'{name}.f90').file_hash
+            for name in ['my_mod', 'my_prog']}
+        assert self.stored_analyses(build_config, analysed.values()) == set(analysed.values())
+        return analysed
+
+    def stored_analyses(self, build_config, file_hashes):
+        # which of these file hashes have analysis results in the database
+        return set(build_config.analysis_db.get_many(FortranAnalyser().analysis_key, file_hashes))
+
+    def assert_analysis_changed(self, build_config, clean_analysed, changed):
+        # Make sure only the changed file has new analysis results, and the previous results are still stored.
+        rebuild_analysed = self.analysed_hashes(build_config)
+        for name, file_hash in rebuild_analysed.items():
+            assert (file_hash != clean_analysed[name]) == (name == changed)
+        assert self.stored_analyses(build_config, clean_analysed.values()) == set(clean_analysed.values())
+
     def assert_two_different_artefacts(self, pb_keys, prebuild_groups, prebuild_folder, rebuild_hashes):
         # Make sure there are two versions for each given artefact wildcard, with different contents.
         for pb in pb_keys:
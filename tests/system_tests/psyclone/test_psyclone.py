@@ -64,7 +64,7 @@ class TestX90Analyser(object):
 
     expected_analysis_result = AnalysedX90(
         fpath=EXPECT_PARSABLE_X90,
-        file_hash=3906123776,
+        file_hash=4845470441347959277,
         kernel_deps={'kernel_one_type', 'kernel_two_type'})
 
     def run(self, tmp_path):
@@ -91,6 +91,20 @@ class TestX90Analyser(object):
         mock_walk.assert_not_called()
         assert analysed_x90 == self.expected_analysis_result
 
+    def test_no_parsable_file(self, tmp_path):
+        # the x90 is made parsable in memory, and the result is stored against the x90's own hash
+        x90_path = tmp_path / SAMPLE_X90.name
+        shutil.copy(SAMPLE_X90, x90_path)
+        x90_analyser = X90Analyser()
+        with BuildConfig('proj', fab_workspace=tmp_path) as config:
+            x90_analyser._config = config
+            analysed_x90, _ = x90_analyser.run(x90_path)  # type: ignore
+
+        assert not x90_path.with_suffix('.parsable_x90').exists()
+        assert analysed_x90 == AnalysedX90(
+            fpath=x90_path, file_hash=file_checksum(x90_path).file_hash,
+            kernel_deps={'kernel_one_type', 'kernel_two_type'})
+
 
 class Test_analysis_for_prebuilds(object):
 
@@ -110,16 +124,16 @@ class Test_analysis_for_prebuilds(object):
         # analysed_x90
         assert analysed_x90 == {
             SAMPLE_X90: AnalysedX90(
-                fpath=SAMPLE_X90.with_suffix('.parsable_x90'),
+                fpath=SAMPLE_X90,
                 file_hash=file_checksum(SAMPLE_X90).file_hash,
                 kernel_deps={'kernel_one_type', 'kernel_two_type'})}
 
         # all_kernel_hashes
         assert all_kernel_hashes == {
-            'kernel_one_type': 2915127408,
-            'kernel_two_type': 3793991362,
-            'kernel_three_type': 319981435,
-            'kernel_four_type': 1427207736,
+            'kernel_one_type': 15131097588017199372,
+            'kernel_two_type': 15510346174829177619,
+            'kernel_three_type': 17076979523800566990,
+            'kernel_four_type': 17084836540409349627,
         }
 
 
@@ -10,25 +10,24 @@ from unittest.mock import Mock
 import clang  # type: ignore
 
 from fab.build_config import BuildConfig
-from fab.parse.c import CAnalyser, AnalysedC
+from fab.parse.c import CAnalyser, AnalysedC, _get_index
 
 
 def test_simple_result(tmp_path):
     c_analyser = CAnalyser()
     c_analyser._config = BuildConfig('proj', fab_workspace=tmp_path)
 
-    with mock.patch('fab.parse.AnalysedFile.save'):
-        fpath = Path(__file__).parent / "test_c_analyser.c"
-        analysis, artefact = c_analyser.run(fpath)
+    fpath = Path(__file__).parent / "test_c_analyser.c"
+    analysis, artefact = c_analyser.run(fpath)
 
     expected = AnalysedC(
         fpath=fpath,
-        file_hash=1429445462,
+        file_hash=17317150894714879682,
         symbol_deps={'usr_var', 'usr_func'},
         symbol_defs={'func_decl', 'func_def', 'var_def', 'var_extern_def', 'main'},
     )
     assert analysis == expected
-    assert artefact == c_analyser._config.prebuild_folder / f'test_c_analyser.{analysis.file_hash}.an'
+    assert artefact == c_analyser._config.analysis_db.fpath
 
 
 class Test__locate_include_regions(object):
@@ -91,6 +90,48 @@ class Test__check_for_include(object):
         assert analyser._check_for_include(35) == "usr_include"
         assert analyser._check_for_include(45) is None
 
+    def test_nested(self):
+        # a start or end applies from its own line
+        analyser = CAnalyser()
+        analyser._include_region = [
+            (10, "usr_include_start"),
+            (20, "sys_include_start"),
+            (30, "sys_include_end"),
+            (40, "usr_include_end"),
+        ]
+
+        assert analyser._check_for_include(9) is None
+        assert analyser._check_for_include(10) == "usr_include"
+        assert analyser._check_for_include(20) == "sys_include"
+        assert analyser._check_for_include(30) == "usr_include"
+        assert analyser._check_for_include(40) is None
+
+
+class Test_walk(object):
+
+    def test_skip_sys_include(self):
+        # we don't visit anything in a system include, including the children
+        def node(line, children=()):
+            return Mock(location=Mock(line=line), get_children=Mock(return_value=list(children)))
+
+        usr_child, sys_child = node(35), node(15)
+        nodes = [node(5), node(12, [sys_child]), node(30, [usr_child]), node(45)]
+        analyser = CAnalyser()
+        analyser._include_region = [
+            (10, "sys_include_start"),
+            (20, "sys_include_end"),
+            (30, "usr_include_start"),
+            (40, "usr_include_end"),
+        ]
+
+        walked = list(analyser._walk(node(0, nodes)))
+        assert walked == [nodes[0], nodes[2], usr_child, nodes[3]]
+
+
+def test_shared_index():
+    # every file analysed in this process shares a libclang index
+    assert _get_index() is _get_index()
+
 
 class Test_process_symbol_declaration(object):
 
@@ -194,17 +194,21 @@ class TestAnalysedFortran(object):
     def test_hash(self, analysed_fortran):
         assert hash(analysed_fortran) == hash(copy.deepcopy(analysed_fortran))
 
-    def test_hash_different_module_defs(self, analysed_fortran, different_module_defs):
-        assert hash(analysed_fortran) != hash(different_module_defs)
-
-    def test_hash_different_module_deps(self, analysed_fortran, different_module_deps):
-        assert hash(analysed_fortran) != hash(different_module_deps)
-
-    def test_hash_different_mo_commented_file_deps(self, analysed_fortran, different_mo_commented_file_deps):
-        assert hash(analysed_fortran) != hash(different_mo_commented_file_deps)
-
-    def test_hash_different_psyclone_kernels(self, analysed_fortran, different_psyclone_kernels):
-        assert hash(analysed_fortran) != hash(different_psyclone_kernels)
+    def test_hash_identity(self, analysed_fortran, different_module_defs, different_module_deps,
+                           different_mo_commented_file_deps, different_psyclone_kernels):
+        # only the path and file hash are hashed
+        for different in [different_module_defs, different_module_deps,
+                          different_mo_commented_file_deps, different_psyclone_kernels]:
+            assert hash(analysed_fortran) == hash(different)
+
+    def test_freeze(self, analysed_fortran):
+        analysed_fortran.freeze()
+        assert isinstance(analysed_fortran.module_defs, frozenset)
+        assert isinstance(analysed_fortran.module_deps, frozenset)
+        with pytest.raises(AttributeError):
+            analysed_fortran.add_module_def('another_mod')
+        # the file dependencies are filled in after analysis
+        analysed_fortran.add_file_dep('another_file.f90')
 
 
 # to/from dict should use vars(), and just be in the base class
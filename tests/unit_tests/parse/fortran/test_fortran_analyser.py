@@ -10,6 +10,8 @@ from unittest import mock
 from fparser.common.readfortran import FortranFileReader  # type: ignore
 from fparser.two.Fortran2008 import Type_Declaration_Stmt  # type: ignore
 from fparser.two.parser import ParserFactory  # type: ignore
+from fparser.two.symbol_table import SYMBOL_TABLES  # type: ignore
+from fparser.two.utils import Base, walk  # type: ignore
 import pytest
 
 from fab.build_config import BuildConfig
@@ -30,7 +32,7 @@ def module_fpath():
 def module_expected(module_fpath):
     return AnalysedFortran(
         fpath=module_fpath,
-        file_hash=4039845747,
+        file_hash=242367548341081935,
         module_defs={'foo_mod'},
         symbol_defs={'external_sub', 'external_func', 'foo_mod'},
         module_deps={'bar_mod'},
@@ -48,36 +50,89 @@ class Test_Analyser(object):
         fortran_analyser._config = BuildConfig('proj', fab_workspace=tmp_path)
         return fortran_analyser
 
+    def test_shared_parser(self, fortran_analyser):
+        # analysers in the same process share a parser, which isn't pickled with them
+        assert fortran_analyser.f2008_parser is FortranAnalyser().f2008_parser
+        assert 'f2008_parser' not in vars(fortran_analyser)
+
     def test_empty_file(self, fortran_analyser):
         # make sure we get back an EmptySourceFile
-        with mock.patch('fab.parse.AnalysedFile.save'):
-            analysis, artefact = fortran_analyser.run(fpath=Path(Path(__file__).parent / "empty.f90"))
+        analysis, artefact = fortran_analyser.run(fpath=Path(Path(__file__).parent / "empty.f90"))
         assert type(analysis) is EmptySourceFile
-        assert artefact is None
+        assert artefact == fortran_analyser._config.analysis_db.fpath
+
+    def test_empty_file_stored(self, fortran_analyser, tmp_path):
+        # empty results are loaded like any other, so the file isn't parsed again
+        fpath = Path(Path(__file__).parent / "empty.f90")
+        fortran_analyser.run(fpath=fpath)
+
+        copy = tmp_path / 'copy.f90'
+        copy.write_bytes(fpath.read_bytes())
+        with mock.patch.object(fortran_analyser, '_parse_file') as mock_parse_file:
+            analysis, _ = fortran_analyser.run(fpath=copy)
+        mock_parse_file.assert_not_called()
+        assert analysis == EmptySourceFile(copy, file_hash=analysis.file_hash)
 
     def test_module_file(self, fortran_analyser, module_fpath, module_expected):
-        with mock.patch('fab.parse.AnalysedFile.save'):
-            analysis, artefact = fortran_analyser.run(fpath=module_fpath)
+        analysis, artefact = fortran_analyser.run(fpath=module_fpath)
+        assert analysis == module_expected
+        assert artefact == fortran_analyser._config.analysis_db.fpath
+
+    def test_reload(self, fortran_analyser, module_fpath, module_expected, tmp_path):
+        # the second analysis of the same source, even in another place, is loaded from the database
+        fortran_analyser.run(fpath=module_fpath)
+        copy_fpath = tmp_path / 'copy.f90'
+        copy_fpath.write_text(module_fpath.read_text())
+
+        with mock.patch.object(fortran_analyser, '_parse_file') as mock_parse_file:
+            analysis, artefact = fortran_analyser.run(fpath=copy_fpath)
+        mock_parse_file.assert_not_called()
+
+        module_expected.fpath = copy_fpath
         assert analysis == module_expected
-        assert artefact == fortran_analyser._config.prebuild_folder / f'test_fortran_analyser.{analysis.file_hash}.an'
+        assert artefact == fortran_analyser._config.analysis_db.fpath
+
+    def test_ignore_mod_deps(self, fortran_analyser, module_fpath, module_expected, tmp_path):
+        # results from an analyser ignoring other modules aren't reused
+        fortran_analyser.run(fpath=module_fpath)
+
+        ignoring = FortranAnalyser(ignore_mod_deps=['bar_mod'])
+        ignoring._config = fortran_analyser._config
+        assert ignoring.analysis_key != fortran_analyser.analysis_key
+        assert ignoring.analysis_key == FortranAnalyser(ignore_mod_deps=['bar_mod']).analysis_key
+
+        analysis, _ = ignoring.run(fpath=module_fpath)
+        assert analysis.module_deps == set()
+        assert analysis.symbol_deps == {'monty_func'}
+
+    def test_tree_disposed(self, fortran_analyser, module_fpath):
+        # the reused parser doesn't keep the tree, and its reference cycles are broken once it's analysed,
+        # so it's freed without waiting for the garbage collector
+        node_tree = fortran_analyser._parse_file(module_fpath)
+        with pytest.raises(KeyError):
+            SYMBOL_TABLES.lookup('foo_mod')
+
+        with mock.patch.object(fortran_analyser, '_parse_file', return_value=node_tree):
+            fortran_analyser.run(fpath=module_fpath)
+        nodes = walk(node_tree, Base)
+        assert nodes
+        assert not any(node.parent or node.item for node in nodes)
 
     def test_program_file(self, fortran_analyser, module_fpath, module_expected):
         # same as test_module_file() but replacing MODULE with PROGRAM
         with NamedTemporaryFile(mode='w+t', suffix='.f90') as tmp_file:
             tmp_file.write(module_fpath.open().read().replace("MODULE", "PROGRAM"))
             tmp_file.flush()
-            with mock.patch('fab.parse.AnalysedFile.save'):
-                analysis, artefact = fortran_analyser.run(fpath=Path(tmp_file.name))
+            analysis, artefact = fortran_analyser.run(fpath=Path(tmp_file.name))
 
             module_expected.fpath = Path(tmp_file.name)
-            module_expected._file_hash = 768896775
+            module_expected._file_hash = 11630976681636546892
             module_expected.program_defs = {'foo_mod'}
             module_expected.module_defs = set()
             module_expected.symbol_defs.update({'internal_sub', 'internal_func'})
 
             assert analysis == module_expected
-            assert artefact == fortran_analyser._config.prebuild_folder \
-                   / f'{Path(tmp_file.name).stem}.{analysis.file_hash}.an'
+            assert artefact == fortran_analyser._config.analysis_db.fpath
 
 
 # todo: test more methods!
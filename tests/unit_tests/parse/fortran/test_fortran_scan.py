@@ -0,0 +1,161 @@
+# ##############################################################################
+#  (c) Crown copyright Met Office. All rights reserved.
+#  For further details please refer to the file COPYRIGHT
+#  which you should have received as part of this distribution
+# ##############################################################################
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+from fab.build_config import BuildConfig
+from fab.parse.fortran import AnalysedFortran, FortranAnalyser
+from fab.parse.fortran_scan import ScanUnsure, find_definitions, scan_fortran, validate_scan
+
+
+def scan(text, **kwargs):
+    return scan_fortran(Path('foo.f90'), text, 123, intrinsic_modules=['iso_c_binding'], **kwargs)
+
+
+class Test_scan_fortran(object):
+
+    def test_same_as_fparser(self):
+        # the scanner agrees with the fparser analysis of the file used in test_fortran_analyser.py
+        fpath = Path(__file__).parent / "test_fortran_analyser.f90"
+        result = scan_fortran(fpath, fpath.read_text(), 123)
+        assert result == AnalysedFortran(
+            fpath=fpath,
+            file_hash=123,
+            module_defs={'foo_mod'},
+            symbol_defs={'external_sub', 'external_func', 'foo_mod'},
+            module_deps={'bar_mod'},
+            symbol_deps={'monty_func', 'bar_mod'},
+            mo_commented_file_deps={'some_file.c'},
+        )
+
+    def test_statements(self):
+        result = scan("""
+            program my_prog
+              use, intrinsic :: iso_c_binding
+              use :: my_mod, only: thing
+              x = 1; call first(x, &
+                 2)
+              100 call second
+              call thing(1)%method()
+              call obj%method()
+              if (x > 1) call one_line_if()
+            contains
+              recursive integer function inner(n) result(r)
+                r = n
+              end function inner
+            end
+        """)
+        assert result.program_defs == {'my_prog'}
+        assert result.module_deps == {'my_mod'}
+        assert result.symbol_defs == {'my_prog', 'inner'}
+        # fparser doesn't see calls in one line if statements, so neither do we
+        assert result.symbol_deps == {'my_mod', 'first', 'second'}
+
+    def test_binding(self):
+        result = scan("""
+            module my_mod
+              integer(c_int), bind(c, name="c_var") :: a, b(3)
+              interface
+                subroutine imported(x) bind(c, name="c_imported")
+                  integer :: x
+                end subroutine imported
+              end interface
+            contains
+              subroutine exported() bind(c)
+              end subroutine
+              subroutine in_module
+              end subroutine
+            end module my_mod
+        """)
+        assert result.symbol_defs == {'my_mod', 'a', 'b', 'exported'}
+        assert result.symbol_deps == {'c_imported'}
+
+    def test_strings_and_comments(self):
+        result = scan("""
+            subroutine foo
+              character(len=*), parameter :: s = "call not_a_call() ! not a comment"
+              ! call commented_out()
+              x = 1  ! DEPENDS ON: my_func
+            end subroutine foo
+        """)
+        assert result.symbol_deps == {'my_func'}
+
+    def test_ignore_mod_deps(self):
+        result = scan("use Ignored_Mod\nuse other_mod\nend", ignore_mod_deps=['Ignored_Mod'])
+        assert result.module_deps == {'other_mod'}
+
+    @pytest.mark.parametrize('text', [
+        "#ifdef FOO\nend",
+        "include 'foo.inc'\nend",
+        "submodule (my_mod) my_sub\nend submodule",
+        "module m\ntype, extends(kernel_type) :: my_kernel\nend type\nend module m",
+        "module m\n",
+        "end module m",
+        "x = 'unfinished &\n string'",
+        "",
+    ])
+    def test_unsure(self, text):
+        with pytest.raises(ScanUnsure):
+            scan(text)
+
+    def test_fixed_form(self):
+        with pytest.raises(ScanUnsure):
+            scan_fortran(Path('foo.f'), "      end", 123)
+
+
+class Test_find_definitions(object):
+
+    def test_same_as_fparser(self):
+        # everything fparser finds, and more
+        fpath = Path(__file__).parent / "test_fortran_analyser.f90"
+        definitions = find_definitions(fpath.read_text())
+        assert {'external_sub', 'external_func', 'foo_mod', 'internal_sub', 'internal_func'} <= definitions
+
+    def test_binding(self):
+        definitions = find_definitions(
+            'integer(c_int), bind(c) :: My_Var\nsubroutine foo() bind(c, name="My_Foo")\nend subroutine')
+        assert {'my_var', 'foo', 'my_foo'} <= definitions
+
+
+class Test_validate_scan(object):
+
+    def test_vanilla(self, tmp_path):
+        fpath = tmp_path / 'foo.f90'
+        fpath.write_text("subroutine foo\ncall bar\nend subroutine\n")
+        analysed_file = AnalysedFortran(fpath=fpath, file_hash=123, symbol_defs={'foo'}, symbol_deps={'baz'})
+
+        differences = validate_scan([analysed_file])
+        assert differences == {fpath: {'symbol_deps': ({'baz'}, {'bar'})}}
+
+
+class Test_FortranAnalyser_scan(object):
+
+    @pytest.fixture
+    def fortran_analyser(self, tmp_path):
+        fortran_analyser = FortranAnalyser(scan=True)
+        fortran_analyser._config = BuildConfig('proj', fab_workspace=tmp_path)
+        return fortran_analyser
+
+    def test_scanned(self, fortran_analyser, tmp_path):
+        fpath = tmp_path / 'foo.f90'
+        fpath.write_text("subroutine foo\nend subroutine\n")
+        with mock.patch.object(fortran_analyser, '_parse_file') as mock_parse_file:
+            analysis, _ = fortran_analyser.run(fpath=fpath)
+        mock_parse_file.assert_not_called()
+        assert analysis.symbol_defs == {'foo'}
+
+    def test_fallback(self, fortran_analyser, tmp_path):
+        # when the scanner isn't sure, the file is parsed with fparser
+        fpath = Path(__file__).parent / "test_fortran_analyser.f90"
+        with mock.patch('fab.parse.fortran.scan_fortran', side_effect=ScanUnsure('no')):
+            analysis, _ = fortran_analyser.run(fpath=fpath)
+        assert analysis.module_defs == {'foo_mod'}
+
+    def test_analysis_key(self, fortran_analyser):
+        # scanned results are stored apart from parsed results
+        assert fortran_analyser.analysis_key != FortranAnalyser().analysis_key
@@ -0,0 +1,91 @@
+import pickle
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+from fab.build_config import BuildConfig
+from fab.parse.analysis_db import AnalysisDB, load_analyses
+from fab.parse.fortran import AnalysedFortran
+from fab.steps import run_mp
+from fab.util import HashedFile
+
+
+@pytest.fixture
+def db(tmp_path):
+    return AnalysisDB(tmp_path / 'analysis.db')
+
+
+def put(arg):
+    db, file_hash = arg
+    db.put('foo', file_hash, str(file_hash))
+
+
+class TestAnalysisDB(object):
+
+    def test_get_put(self, db):
+        assert db.get('foo', 123) is None
+        db.put('foo', 123, 'result')
+        assert db.get('foo', 123) == 'result'
+        assert db.get('bar', 123) is None
+
+    def test_replace(self, db):
+        db.put('foo', 123, 'result')
+        db.put('foo', 123, 'new result')
+        assert db.get('foo', 123) == 'new result'
+
+    def test_get_many(self, db):
+        # more than fit in a single query
+        for i in range(1200):
+            db.put('foo', i, str(i))
+        db.put('bar', 1, 'bar')
+
+        found = db.get_many('foo', range(1000, 1300))
+        assert found == {i: str(i) for i in range(1000, 1200)}
+
+    def test_remove_unused(self, db):
+        # results are kept by when they were last stored or loaded
+        with mock.patch('fab.parse.analysis_db.time.time', return_value=100):
+            db.put('foo', 1, 'one')
+            db.put('foo', 2, 'two')
+            db.put('foo', 3, 'three')
+        with mock.patch('fab.parse.analysis_db.time.time', return_value=200):
+            db.get('foo', 2)
+        with mock.patch('fab.parse.analysis_db.time.time', return_value=300):
+            db.get_many('foo', [3, 4])
+
+        assert db.latest_use() == 300
+        assert db.remove_unused(before=250) == 2
+        assert db.get_many('foo', [1, 2, 3]) == {3: 'three'}
+
+    def test_latest_use_empty(self, db):
+        assert db.latest_use() is None
+
+    def test_pickle(self, db):
+        db.put('foo', 123, 'result')
+        clone = pickle.loads(pickle.dumps(db))
+        assert clone.get('foo', 123) == 'result'
+
+    def test_concurrent_writers(self, db, tmp_path):
+        config = BuildConfig('proj', n_procs=4, fab_workspace=tmp_path)
+        try:
+            run_mp(config, items=[(db, i) for i in range(100)], func=put)
+        finally:
+            config.close_pool()
+        assert db.get_many('foo', range(100)) == {i: str(i) for i in range(100)}
+
+
+class Test_load_analyses(object):
+
+    # results stored as json by older versions of fab can still be loaded
+    @pytest.mark.parametrize('encode', [AnalysedFortran.to_bytes, AnalysedFortran.to_json])
+    def test_vanilla(self, tmp_path, encode):
+        analyser = mock.Mock(
+            _config=BuildConfig('proj', fab_workspace=tmp_path), analysis_key='foo', result_class=AnalysedFortran)
+        stored = AnalysedFortran(fpath='elsewhere/foo.f90', file_hash=123, symbol_defs=['foo'])
+        analyser._config.analysis_db.put('foo', 123, encode(stored))
+
+        loaded = load_analyses(analyser, [HashedFile(Path('foo.f90'), 123), HashedFile(Path('bar.f90'), 456)])
+
+        # the path is replaced with the one we're using
+        assert loaded == [AnalysedFortran(fpath='foo.f90', file_hash=123, symbol_defs=['foo'])]
@@ -8,11 +8,15 @@ Test contents of parse/__init__.py
 
 """
 import copy
+import json
+import pickle
 from pathlib import Path
 
 import pytest
-from fab.parse import AnalysedFile
+from fab.parse import AnalysedFile, EmptySourceFile, NAMES, results_from_bytes, results_to_bytes
 from fab.dep_tree import AnalysedDependent
+from fab.parse.fortran import AnalysedFortran
+from fab.parse.x90 import AnalysedX90
 
 
 class TestAnalysedFile(object):
@@ -57,6 +61,95 @@ class TestAnalysedFile(object):
     def test_hash_different_file_hash(self, analysed_file, different_file_hash):
         assert hash(analysed_file) != hash(different_file_hash)
 
+    def test_hash_moved(self, analysed_file, different_fpath):
+        # loaded results are moved to where the file is now
+        hash(analysed_file)
+        analysed_file.fpath = Path('bar.f90')
+        assert hash(analysed_file) == hash(different_fpath)
+
+    def test_pickle(self, analysed_file):
+        # the hash is different in each process, so it isn't sent to other processes
+        hash(analysed_file)
+        unpickled = pickle.loads(pickle.dumps(analysed_file))
+        assert unpickled._hash is None
+        assert unpickled == analysed_file
+
+    def test_slots(self, analysed_file):
+        assert not hasattr(analysed_file, '__dict__')
+
+
+class TestEmptySourceFile(object):
+
+    def test_json(self):
+        # an empty result can be loaded by any result class
+        empty_file = EmptySourceFile(fpath=Path('foo.f90'), file_hash=123)
+        assert AnalysedDependent.from_json(empty_file.to_json()) == empty_file
+
+
+class TestBinary(object):
+
+    @pytest.fixture
+    def results(self):
+        return [
+            AnalysedFortran(
+                fpath=Path('foo.f90'), file_hash=2**64 - 1, program_defs={'prog'}, module_defs={'foo_mod'},
+                symbol_defs={'prog', 'foo_mod'}, module_deps={'bar_mod'}, symbol_deps={'bar_mod', 'bär'},
+                mo_commented_file_deps={'util.c'}, file_deps={Path('bar.f90')}, psyclone_kernels={'kernel': 456}),
+            AnalysedX90(fpath=Path('foo.x90'), file_hash=123, kernel_deps={'kernel'}),
+            EmptySourceFile(fpath=Path('empty.f90'), file_hash=0),
+        ]
+
+    @pytest.mark.parametrize('validate', [True, False])
+    def test_round_trip(self, results, validate):
+        for result in results:
+            assert type(result).from_bytes(result.to_bytes(), validate=validate) == result
+
+    def test_many(self, results):
+        assert results_from_bytes(results_to_bytes(results)) == results
+
+    def test_fpath(self, results):
+        loaded = AnalysedFortran.from_bytes(results[0].to_bytes(), validate=False, fpath=Path('bar/foo.f90'))
+        assert loaded.fpath == Path('bar/foo.f90')
+
+    def test_lazy_file_hash(self, tmp_path):
+        # not evaluated, so not stored
+        fpath = tmp_path / 'foo.f90'
+        fpath.write_text('foo')
+        loaded = AnalysedDependent.from_bytes(AnalysedDependent(fpath=fpath).to_bytes(), validate=False)
+        assert loaded._file_hash is None
+        assert loaded.file_hash
+
+    def test_wrong_class(self, results):
+        with pytest.raises(ValueError):
+            AnalysedX90.from_bytes(results[0].to_bytes())
+        # any analyser can find an empty file
+        assert AnalysedX90.from_bytes(results[2].to_bytes()) == results[2]
+
+    def test_validate(self):
+        # the module isn't a symbol definition
+        data = AnalysedFortran(fpath=Path('foo.f90'), file_hash=123, module_defs={'foo_mod'},
+                               symbol_defs={'foo_mod'}).to_bytes()
+        data = data.replace(b'foo_mod\0foo_mod', b'foo_mod\0bar_mod')
+        AnalysedFortran.from_bytes(data, validate=False)
+        with pytest.raises(AssertionError):
+            AnalysedFortran.from_bytes(data)
+
+    def test_old_version(self, monkeypatch):
+        # a field added in a later version is empty when reading an older result
+        monkeypatch.setattr(AnalysedX90, '_binary_fields', {1: ()})
+        data = AnalysedX90(fpath=Path('foo.x90'), file_hash=123, kernel_deps={'kernel'}).to_bytes()
+        monkeypatch.setattr(AnalysedX90, '_binary_fields', {1: (), 2: (('kernel_deps', NAMES),)})
+
+        assert AnalysedX90.from_bytes(data) == AnalysedX90(fpath=Path('foo.x90'), file_hash=123)
+
+    def test_newer_version(self, monkeypatch):
+        monkeypatch.setattr(AnalysedX90, '_binary_fields', {2: (('kernel_deps', NAMES),)})
+        data = AnalysedX90(fpath=Path('foo.x90'), file_hash=123, kernel_deps={'kernel'}).to_bytes()
+        monkeypatch.undo()
+
+        with pytest.raises(ValueError, match='unknown version 2'):
+            AnalysedX90.from_bytes(data)
+
 
 class TestAnalysedDependent(object):
 
@@ -123,6 +216,19 @@ class TestAnalysedDependent(object):
     def test_to_dict(self, analysed_dependent, as_dict):
         assert analysed_dependent.to_dict() == as_dict
 
+    def test_freeze(self, analysed_dependent):
+        # files loaded separately share their symbol names
+        loaded = [AnalysedDependent.from_dict(json.loads(json.dumps(analysed_dependent.to_dict()))) for _ in range(2)]
+        for af in loaded:
+            af.freeze()
+        first, second = (sorted(af.symbol_deps, key=str) for af in loaded)
+        assert all(a is b for a, b in zip(first, second))
+
+        assert isinstance(loaded[0].symbol_defs, frozenset)
+        assert loaded[0] == analysed_dependent
+        with pytest.raises(AttributeError):
+            loaded[0].add_symbol_dep('other_func3')
+
     def test_from_dict(self, analysed_dependent, as_dict):
         assert AnalysedDependent.from_dict(as_dict) == analysed_dependent
 
@@ -143,11 +249,8 @@ class TestAnalysedDependent(object):
     def test_hash(self, analysed_dependent):
         assert hash(analysed_dependent) == hash(copy.deepcopy(analysed_dependent))
 
-    def test_hash_different_symbol_defs(self, analysed_dependent, different_symbol_defs):
-        assert hash(analysed_dependent) != hash(different_symbol_defs)
-
-    def test_hash_different_symbol_deps(self, analysed_dependent, different_symbol_deps):
-        assert hash(analysed_dependent) != hash(different_symbol_deps)
-
-    def test_hash_different_file_deps(self, analysed_dependent, different_file_deps):
-        assert hash(analysed_dependent) != hash(different_file_deps)
+    def test_hash_identity(self, analysed_dependent, different_symbol_defs, different_symbol_deps,
+                           different_file_deps):
+        # only the path and file hash are hashed, so the file deps can be filled in while we're in a set
+        for different in [different_symbol_defs, different_symbol_deps, different_file_deps]:
+            assert hash(analysed_dependent) == hash(different)
@@ -58,4 +58,5 @@ class TestAnalysedX90(object):
         assert hash(analysed_x90) == hash(copy.deepcopy(analysed_x90))
 
     def test_hash_different_kernel_deps(self, analysed_x90, different_kernel_deps):
-        assert hash(analysed_x90) != hash(different_kernel_deps)
+        # only the path and file hash are hashed
+        assert hash(analysed_x90) == hash(different_kernel_deps)
@@ -4,11 +4,12 @@ from unittest import mock
 import pytest
 
 from fab.build_config import BuildConfig
-from fab.dep_tree import AnalysedDependent
-from fab.parse.fortran import AnalysedFortran, FortranParserWorkaround
+from fab.constants import CURRENT_PREBUILDS
+from fab.dep_tree import AnalysedDependent, DepGraph
+from fab.parse.fortran import AnalysedFortran, FortranAnalyser, FortranParserWorkaround
 from fab.steps.analyse import _add_manual_results, _add_unreferenced_deps, _gen_file_deps, _gen_symbol_table, \
-    _parse_files
-from fab.util import HashedFile
+    _parse_and_compile_fortran, _parse_files, _parse_reachable_files
+from fab.util import HashedFile, file_checksum
 
 
 class Test_gen_symbol_table(object):
@@ -102,6 +103,20 @@ class Test_add_unreferenced_deps(object):
         assert Path('util.f90') in build_tree
         assert Path('util_dep.f90') in build_tree
 
+    def test_graph(self):
+        # the same, using the dependency graph
+        all_analysed_files = {
+            Path('util.f90'): AnalysedFortran(fpath=Path('util.f90'), file_deps={Path('util_dep.f90')}, file_hash=0),
+            Path('util_dep.f90'): AnalysedFortran(fpath=Path('util_dep.f90'), file_hash=0),
+        }
+        build_tree = {}
+
+        _add_unreferenced_deps(
+            unreferenced_deps=['util'], symbol_table={'util': Path('util.f90')},
+            all_analysed_files=all_analysed_files, build_tree=build_tree, graph=DepGraph(all_analysed_files))
+
+        assert build_tree == all_analysed_files
+
     # todo:
     # def test_duplicate(self):
     #     # ensure warning
@@ -121,6 +136,92 @@ class Test_parse_files(object):
             # the exception should be suppressed (and logged) and this step should run to completion
             _parse_files(config, files=[], fortran_analyser=mock.Mock(), c_analyser=mock.Mock())
 
+    def test_load_stored(self, tmp_path):
+        # stored results are loaded up front, and only the other files are analysed
+        config = BuildConfig('proj', fab_workspace=tmp_path, multiprocessing=False)
+        a, b = tmp_path / 'a.f90', tmp_path / 'b.f90'
+        a.write_text('a')
+        b.write_text('b')
+        analysed_a = AnalysedFortran(fpath=a, file_hash=file_checksum(a).file_hash, symbol_defs=['a'])
+        analysed_b = AnalysedFortran(fpath=b, file_hash=file_checksum(b).file_hash, symbol_defs=['b'])
+        config.analysis_db.put('foo', analysed_a.file_hash, analysed_a.to_json())
+
+        fortran_analyser = mock.Mock(
+            _config=config, analysis_key='foo', result_class=AnalysedFortran, depends_on_comment_found=False)
+        fortran_analyser.run.return_value = analysed_b, config.analysis_db.fpath
+
+        with mock.patch('fab.steps.analyse.get_memory_estimates', return_value={}):
+            analysed_files = _parse_files(
+                config, files=[a, b], fortran_analyser=fortran_analyser, c_analyser=mock.Mock())
+
+        fortran_analyser.run.assert_called_once_with(b)
+        assert analysed_files == {analysed_a, analysed_b}
+        assert config._artefact_store[CURRENT_PREBUILDS] == {config.analysis_db.fpath}
+
+
+class Test_parse_reachable_files(object):
+
+    @pytest.fixture
+    def source(self, tmp_path):
+        # prog uses mod_a, which calls sub_b, which calls sub_c, defined in a file which can't be parsed
+        source = {
+            'prog.f90': 'program prog\n  use mod_a\nend program prog\n',
+            'a.f90': 'module mod_a\ncontains\n  subroutine sub_a()\n    call sub_b()\n  end subroutine\nend module\n',
+            'b.f90': 'subroutine sub_b()\n  call sub_c()\nend subroutine sub_b\n',
+            'c.f90': 'not fortran',
+            'unused.f90': 'module unused\nend module unused\n',
+        }
+        for name, text in source.items():
+            (tmp_path / name).write_text(text)
+        return tmp_path
+
+    def parse(self, config, source):
+        fortran_analyser = FortranAnalyser()
+        fortran_analyser._config = config
+        workaround = FortranParserWorkaround(fpath=source / 'c.f90', symbol_defs=['sub_c'])
+        with mock.patch('fab.steps.analyse.get_memory_estimates', return_value={}):
+            return _parse_reachable_files(
+                config, files=sorted(source.glob('*.f90')), symbols=['prog'], fortran_analyser=fortran_analyser,
+                c_analyser=mock.Mock(), manual_results=[workaround.as_analysed_fortran()])
+
+    def test_vanilla(self, source, tmp_path):
+        config = BuildConfig('proj', fab_workspace=tmp_path / 'fab', multiprocessing=False)
+        analysed_files = self.parse(config, source)
+        assert {af.fpath.name for af in analysed_files} == {'prog.f90', 'a.f90', 'b.f90'}
+
+    def test_stored(self, source, tmp_path):
+        # files which were analysed before are all loaded
+        config = BuildConfig('proj', fab_workspace=tmp_path / 'fab', multiprocessing=False)
+        fortran_analyser = FortranAnalyser()
+        fortran_analyser._config = config
+        fortran_analyser.run(source / 'unused.f90')
+
+        analysed_files = self.parse(config, source)
+        assert {af.fpath.name for af in analysed_files} == {'prog.f90', 'a.f90', 'b.f90', 'unused.f90'}
+
+
+class Test_parse_and_compile_fortran(object):
+
+    def test_vanilla(self):
+        # files are compiled as they're released by the pipeline, while the analysis continues
+        a = AnalysedFortran(fpath=Path('a.f90'), file_hash=0)
+        b = AnalysedFortran(fpath=Path('b.f90'), file_hash=0)
+        fortran_analyser = mock.Mock()
+        fortran_analyser.run.side_effect = lambda fpath: ({Path('a.f90'): a, Path('b.f90'): b}[fpath], None)
+
+        pipeline_compiler = mock.Mock(num_compiled=1)
+        pipeline_compiler.analysed.side_effect = lambda af: [(af, None)] if af == a else []
+        pipeline_compiler.compiled.return_value = []
+
+        with mock.patch('fab.steps.analyse.process_file', return_value='compiled a') as mock_process_file:
+            results = _parse_and_compile_fortran(
+                mock.Mock(multiprocessing=False, memory_budget=None), fortran_files=[Path('a.f90'), Path('b.f90')],
+                fortran_analyser=fortran_analyser, pipeline_compiler=pipeline_compiler)
+
+        assert sorted(results, key=lambda r: r[0].fpath) == [(a, None), (b, None)]
+        mock_process_file.assert_called_once_with((a, None))
+        pipeline_compiler.compiled.assert_called_once_with((a, None), 'compiled a')
+
 
 class Test_add_manual_results(object):
     # test user-specified analysis results, for when fparser fails to parse a valid file.
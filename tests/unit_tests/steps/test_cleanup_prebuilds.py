@@ -11,7 +11,9 @@ from unittest.mock import call
 import pytest
 
 from fab.constants import CURRENT_PREBUILDS
-from fab.steps.cleanup_prebuilds import by_age, by_version_age, cleanup_prebuilds, remove_all_unused
+from fab.parse.analysis_db import AnalysisDB
+from fab.steps.cleanup_prebuilds import by_age, by_version_age, cleanup_prebuilds, remove_all_unused, \
+    remove_unused_analyses
 from fab.util import get_prebuild_file_groups
 
 
@@ -66,6 +68,50 @@ class TestCleanupPrebuilds(object):
         assert result == set()
 
 
+class Test_remove_unused_analyses(object):
+
+    @pytest.fixture
+    def analysis_db(self, tmp_path):
+        # results last used at 100, 200 and 300 seconds
+        analysis_db = AnalysisDB(tmp_path / 'analysis.db')
+        for file_hash in [1, 2, 3]:
+            with mock.patch('fab.parse.analysis_db.time.time', return_value=file_hash * 100):
+                analysis_db.put('foo', file_hash, str(file_hash))
+        return analysis_db
+
+    def test_all_unused(self, analysis_db):
+        # results which weren't used in this build are removed
+        assert remove_unused_analyses(analysis_db, older_than=None, all_unused=True, build_start=250) == 2
+        assert analysis_db.get_many('foo', [1, 2, 3]) == {3: '3'}
+
+    def test_older_than(self, analysis_db):
+        # like the prebuild files, the age is from the most recent use
+        assert remove_unused_analyses(
+            analysis_db, older_than=timedelta(seconds=150), all_unused=False, build_start=1000) == 1
+        assert analysis_db.get_many('foo', [1, 2, 3]) == {2: '2', 3: '3'}
+
+    def test_older_than_current(self, analysis_db):
+        # results used in this build are kept
+        assert remove_unused_analyses(
+            analysis_db, older_than=timedelta(seconds=150), all_unused=False, build_start=50) == 0
+
+    def test_n_versions(self, analysis_db):
+        # results don't have versions
+        assert remove_unused_analyses(analysis_db, older_than=None, all_unused=False, build_start=1000) == 0
+
+    def test_cleanup_prebuilds(self, tmp_path):
+        # the step removes the results which weren't used in this build
+        config = mock.Mock(
+            prebuild_folder=tmp_path, analysis_db=AnalysisDB(tmp_path / 'analysis.db'),
+            _start_time=datetime.fromtimestamp(250), _artefact_store={CURRENT_PREBUILDS: {tmp_path / 'analysis.db'}})
+        with mock.patch('fab.parse.analysis_db.time.time', return_value=100):
+            config.analysis_db.put('foo', 1, 'old')
+        config.analysis_db.put('foo', 2, 'new')
+
+        cleanup_prebuilds(config, all_unused=True)
+        assert config.analysis_db.get_many('foo', [1, 2]) == {2: 'new'}
+
+
 def test_remove_all_unused():
 
     found_files = [
@@ -18,7 +18,7 @@ def content(tmp_path):
 
     analysed_file = AnalysedC(fpath=Path(f'{config.source_root}/foo.c'), file_hash=0)
     config._artefact_store[BUILD_TREES] = {None: {analysed_file.fpath: analysed_file}}
-    expect_hash = 9120682468
+    expect_hash = 3526056708180856776
     return config, analysed_file, expect_hash
 
 
@@ -83,7 +83,7 @@ class Test_get_obj_combo_hash(object):
         _, analysed_file, expect_hash = content
         analysed_file._file_hash += 1
         result = _get_obj_combo_hash('foo_cc', '1.2.3', analysed_file, flags)
-        assert result == expect_hash + 1
+        assert result != expect_hash
 
     def test_change_flags(self, content, flags):
         _, analysed_file, expect_hash = content
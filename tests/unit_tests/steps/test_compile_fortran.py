@@ -1,3 +1,4 @@
+import json
 import os
 from pathlib import Path
 from typing import Dict
@@ -7,10 +8,11 @@ from unittest.mock import call
 import pytest
 
 from fab.build_config import BuildConfig
-from fab.constants import BUILD_TREES, OBJECT_FILES
+from fab.constants import BUILD_TREES, CURRENT_PREBUILDS, OBJECT_FILES
 from fab.parse.fortran import AnalysedFortran
-from fab.steps.compile_fortran import compile_pass, get_compile_next, get_fortran_compiler, \
-    get_mod_hashes, handle_compiler_args, MpCommonArgs, process_file, store_artefacts
+from fab.steps.compile_fortran import compile_in_dependency_order, get_compile_times, \
+    get_critical_path_priorities, get_fortran_compiler, _get_obj_combo_hash, \
+    get_mod_hashes, handle_compiler_args, MpCommonArgs, PipelineCompiler, process_file, store_artefacts
 from fab.steps.preprocess import get_fortran_preprocessor
 from fab.util import CompiledFile
 
@@ -30,54 +32,252 @@ def artefact_store(analysed_files):
     return artefact_store
 
 
-class Test_compile_pass(object):
+class Test_compile_in_dependency_order(object):
+
+    def mock_process_file(self, arg):
+        analysed_file, mp_common_args = arg
+        self.compile_order.append(analysed_file.fpath)
+        self.compile_stages.append((analysed_file.fpath, mp_common_args.stage))
+        self.mod_hashes_seen[analysed_file.fpath] = mp_common_args.mod_hashes
+        obj_fpath = analysed_file.fpath.with_suffix('.o')
+        return CompiledFile(input_fpath=analysed_file.fpath, output_fpath=obj_fpath), [obj_fpath]
+
+    def run(self, uncompiled, process_file=None, priorities=None, stage=None, **config_kwargs):
+        self.compile_order = []
+        self.compile_stages = []
+        self.mod_hashes_seen = {}
+        mod_hashes: Dict[str, int] = {}
+
+        config = BuildConfig('proj', multiprocessing=False, **config_kwargs)
+        mp_common_args = MpCommonArgs(
+            config=config, flags=None, compiler='foo_cc', compiler_version='1.2.3',
+            mod_hashes=mod_hashes, two_stage_flag=None, stage=stage)
+
+        with mock.patch('fab.steps.compile_fortran.process_file', side_effect=process_file or self.mock_process_file):
+            with mock.patch('fab.steps.compile_fortran.get_mod_hashes', side_effect=lambda afs, _: {
+                    mod_def: 123 for af in afs for mod_def in af.module_defs}):
+                compiled = compile_in_dependency_order(
+                    config=config, uncompiled=uncompiled, mp_common_args=mp_common_args, mod_hashes=mod_hashes,
+                    priorities=priorities)
+
+        return compiled, mod_hashes, config
 
     def test_vanilla(self, analysed_files):
-        # make sure it compiles b only
+        # files must be compiled after their dependencies
         a, b, c = analysed_files
-        uncompiled = {a, b}
-        compiled = {c.fpath: mock.Mock(input_fpath=c.fpath)}
-
-        run_mp_results = [
-            (
-                mock.Mock(spec=CompiledFile, input_fpath=Path('b.f90')),
-                [Path('/prebuild/b.123.o')]
-            )
+        compiled, _, config = self.run({a, b, c})
+
+        assert self.compile_order == [c.fpath, b.fpath, a.fpath]
+        assert set(compiled) == {a.fpath, b.fpath, c.fpath}
+        assert config._artefact_store[CURRENT_PREBUILDS] == {Path('a.o'), Path('b.o'), Path('c.o')}
+
+    def test_two_stage(self, analysed_files):
+        # each file's object compile follows its mod compile, but waits for the mod compiles which are ready
+        a, b, c = analysed_files
+        compiled, _, config = self.run({a, b, c}, stage=1)
+
+        assert self.compile_stages == [
+            (c.fpath, 1), (b.fpath, 1), (a.fpath, 1),
+            (c.fpath, 2), (b.fpath, 2), (a.fpath, 2),
         ]
+        assert set(compiled) == {a.fpath, b.fpath, c.fpath}
 
-        # this gets filled in
-        mod_hashes: Dict[str, int] = {}
+    def test_mod_hashes(self, analysed_files):
+        # each file is given the hashes of the modules it depends on
+        a, b, c = analysed_files
+        c.add_module_def('c_mod')
+        b.add_module_dep('c_mod')
+
+        _, mod_hashes, _ = self.run({a, b, c})
 
-        config = BuildConfig('proj')
-        with mock.patch('fab.steps.compile_fortran.run_mp', return_value=run_mp_results):
-            with mock.patch('fab.steps.compile_fortran.get_mod_hashes'):
-                uncompiled_result = compile_pass(config=config, compiled=compiled, uncompiled=uncompiled,
-                                                 mod_hashes=mod_hashes, mp_common_args=None)
+        assert mod_hashes == {'c_mod': 123}
+        assert self.mod_hashes_seen == {c.fpath: {}, b.fpath: {'c_mod': 123}, a.fpath: {}}
 
-        assert Path('a.f90') not in compiled
-        assert Path('b.f90') in compiled
-        assert list(uncompiled_result)[0].fpath == Path('a.f90')
+    def test_error(self, analysed_files):
+        # a compilation error stops anything further being compiled, and is reported
+        a, b, c = analysed_files
+
+        def process_file(arg):
+            if arg[0].fpath == b.fpath:
+                return Exception('compile error'), None
+            return self.mock_process_file(arg)
 
+        with pytest.raises(RuntimeError, match='compile error'):
+            self.run({a, b, c}, process_file=process_file)
 
-class Test_get_compile_next(object):
+        assert self.compile_order == [c.fpath]
+
+    @pytest.mark.parametrize('fail_fast, expect_compiled', [(False, ['d.f90']), (True, [])])
+    def test_fail_fast(self, analysed_files, fail_fast, expect_compiled):
+        # fail fast stops the work which is already waiting to be processed
+        a, b, c = analysed_files
+        d = AnalysedFortran(fpath=Path('d.f90'), file_hash=0)
+
+        def process_file(arg):
+            if arg[0].fpath == c.fpath:
+                return Exception('compile error'), None
+            return self.mock_process_file(arg)
+
+        priorities = {a.fpath: 0, b.fpath: 0, c.fpath: 2, d.fpath: 1}
+        with pytest.raises(RuntimeError, match='compile error'):
+            self.run({a, b, c, d}, process_file=process_file, priorities=priorities, fail_fast=fail_fast)
+
+        assert self.compile_order == list(map(Path, expect_compiled))
+
+    def test_keep_going(self, analysed_files):
+        # everything which doesn't depend on the failure is compiled
+        a, b, c = analysed_files
+        d = AnalysedFortran(fpath=Path('d.f90'), file_deps={c.fpath}, file_hash=0)
+
+        def process_file(arg):
+            if arg[0].fpath == b.fpath:
+                return Exception('compile error'), None
+            return self.mock_process_file(arg)
+
+        priorities = {a.fpath: 0, b.fpath: 2, c.fpath: 3, d.fpath: 1}
+        with pytest.raises(RuntimeError, match='compile error'):
+            self.run({a, b, c, d}, process_file=process_file, priorities=priorities, keep_going=True)
+
+        assert self.compile_order == [c.fpath, d.fpath]
+
+    def test_unfulfilled(self, analysed_files):
+        # c is not being compiled, so nothing else can be
+        a, b, c = analysed_files
+
+        with pytest.raises(ValueError, match='unfulfilled dependencies'):
+            self.run({a, b})
+
+        assert self.compile_order == []
+
+
+class Test_get_critical_path_priorities(object):
 
     def test_vanilla(self, analysed_files):
+        # a depends on b depends on c, so c is at the head of the longest chain
         a, b, c = analysed_files
-        uncompiled = {a, b}
-        compiled = {c.fpath: mock.Mock(input_fpath=c.fpath)}
+        compile_times = {a.fpath: 1.0, b.fpath: 2.0, c.fpath: 4.0}
 
-        compile_next = get_compile_next(compiled, uncompiled)
+        priorities = get_critical_path_priorities({a, b, c}, compile_times)
 
-        assert compile_next == {b, }
+        assert priorities == {a.fpath: 1.0, b.fpath: 3.0, c.fpath: 7.0}
 
-    def test_unable_to_compile_anything(self, analysed_files):
-        # like vanilla, except c hasn't been compiled
+    def test_no_times(self, analysed_files):
+        # without previous compile times, we count the files in the chain
         a, b, c = analysed_files
-        to_compile = {a, b}
-        already_compiled_files = {}
+        d = AnalysedFortran(fpath=Path('d.f90'), file_hash=0)
 
-        with pytest.raises(ValueError):
-            get_compile_next(already_compiled_files, to_compile)
+        priorities = get_critical_path_priorities({a, b, c, d}, {})
+
+        assert priorities == {a.fpath: 1, b.fpath: 2, c.fpath: 3, d.fpath: 1}
+
+    def test_ordering(self, analysed_files):
+        # d is slow but nothing depends on it, so the chain a-b-c starts first
+        a, b, c = analysed_files
+        d = AnalysedFortran(fpath=Path('d.f90'), file_hash=0)
+        compile_times = {a.fpath: 1.0, b.fpath: 1.0, c.fpath: 1.0, d.fpath: 2.0}
+
+        runner = Test_compile_in_dependency_order()
+        priorities = get_critical_path_priorities({a, b, c, d}, compile_times)
+        runner.run({a, b, c, d}, priorities=priorities)
+
+        assert runner.compile_order == [c.fpath, d.fpath, b.fpath, a.fpath]
+
+
+class Test_get_compile_times(object):
+
+    def test_vanilla(self, analysed_files, tmp_path):
+        # times from the last run override older times, which are passed forward
+        a, b, c = analysed_files
+        config = BuildConfig('proj', fab_workspace=tmp_path)
+        config.metrics_folder.mkdir(parents=True)
+        with open(config.metrics_folder / 'metrics.json', 'wt') as outfile:
+            json.dump({
+                'compile_fortran': {'a.f90': {'time_taken': 1.0, 'start': 0}},
+                'compile_fortran time_taken history': {'a.f90': 5.0, 'b.f90': 2.0, 'x.f90': 3.0},
+            }, outfile)
+
+        with mock.patch('fab.metrics.send_metric') as mock_send_metric:
+            compile_times = get_compile_times(config, 'compile_fortran', [a, b, c])
+
+        assert compile_times == {a.fpath: 1.0, b.fpath: 2.0}
+        mock_send_metric.assert_has_calls([
+            call('compile_fortran time_taken history', 'a.f90', 1.0),
+            call('compile_fortran time_taken history', 'b.f90', 2.0),
+        ])
+
+    def test_no_metrics(self, analysed_files, tmp_path):
+        config = BuildConfig('proj', fab_workspace=tmp_path)
+        assert get_compile_times(config, 'compile_fortran', analysed_files) == {}
+
+
+def fortran(fpath, defs=None, deps=None):
+    # a file defining and using the given modules
+    return AnalysedFortran(
+        fpath=Path(fpath), module_defs=defs, symbol_defs=defs, module_deps=deps, symbol_deps=deps, file_hash=0)
+
+
+class Test_PipelineCompiler(object):
+
+    @pytest.fixture
+    def pipeline(self):
+        with mock.patch('fab.steps.compile_fortran.handle_compiler_args',
+                        return_value=('foo_cc', '1.2.3', mock.Mock())):
+            pipeline = PipelineCompiler(config=mock.Mock())
+        return pipeline
+
+    def compiled(self, pipeline, arg, mod_hashes):
+        af, _ = arg
+        with mock.patch('fab.steps.compile_fortran.get_mod_hashes', return_value=mod_hashes):
+            return pipeline.compiled(arg, (CompiledFile(af.fpath, af.fpath.with_suffix('.o')), []))
+
+    def test_vanilla(self, pipeline):
+        # each file is compiled when the modules it uses have been compiled, in any order of analysis
+        user = fortran('user.f90', deps={'mod_a', 'mod_b'})
+        a = fortran('a.f90', defs={'mod_a'})
+        b = fortran('b.f90', defs={'mod_b'}, deps={'mod_a'})
+
+        assert pipeline.analysed(user) == []
+        assert pipeline.analysed(b) == []
+        [a_arg] = pipeline.analysed(a)
+        assert a_arg[0] == a
+
+        [b_arg] = self.compiled(pipeline, a_arg, {'mod_a': 123})
+        assert b_arg[0] == b
+        assert b_arg[1].mod_hashes == {'mod_a': 123}
+
+        [user_arg] = self.compiled(pipeline, b_arg, {'mod_b': 456})
+        assert user_arg[1].mod_hashes == {'mod_a': 123, 'mod_b': 456}
+        assert pipeline.num_compiled == 2
+
+    def test_already_compiled(self, pipeline):
+        # analysing a file whose modules have already been compiled
+        [a_arg] = pipeline.analysed(fortran('a.f90', defs={'mod_a'}))
+        self.compiled(pipeline, a_arg, {'mod_a': 123})
+
+        user = fortran('user.f90', deps={'mod_a'})
+        assert pipeline.analysed(user) == [(user, mock.ANY)]
+
+    def test_external_module(self, pipeline):
+        # files using modules we never see are left for compile_fortran
+        assert pipeline.analysed(fortran('a.f90', deps={'netcdf'})) == []
+
+    def test_duplicate_module(self, pipeline):
+        # we only compile the first definition of a module
+        a = fortran('a.f90', defs={'mod_a'})
+        a2 = fortran('a2.f90', defs={'mod_a'})
+        assert len(pipeline.analysed(a)) == 1
+        assert pipeline.analysed(a2) == []
+
+    def test_error(self, pipeline):
+        # a failure doesn't release the files waiting for it
+        [a_arg] = pipeline.analysed(fortran('a.f90', defs={'mod_a'}))
+        pipeline.analysed(fortran('user.f90', deps={'mod_a'}))
+
+        assert pipeline.compiled(a_arg, (Exception('oops'), None)) == []
+        assert pipeline.num_compiled == 0
+
+    def test_not_fortran(self, pipeline):
+        assert pipeline.analysed(Exception('parse error')) == []
 
 
 class Test_store_artefacts(object):
@@ -131,8 +331,8 @@ class Test_process_file(object):
         analysed_file.add_module_def('mod_def_1')
         analysed_file.add_module_def('mod_def_2')
 
-        obj_combo_hash = '1eb0c2d19'
-        mods_combo_hash = '1747a9a0f'
+        obj_combo_hash = '2084b4c845bbd76f'
+        mods_combo_hash = '93cb024cfe071fa'
 
         mp_common_args = MpCommonArgs(
             config=BuildConfig('proj', fab_workspace=Path('/fab')),
@@ -228,13 +428,11 @@ class Test_process_file(object):
 
     def test_file_hash(self):
         # Changing the source hash must change the combo hash for the mods and obj.
-        # Note: This test adds 1 to the analysed files hash. We're using checksums so
-        #       the resulting object file and mod file combo hashes can be expected to increase by 1 too.
         mp_common_args, flags, analysed_file, obj_combo_hash, mods_combo_hash = self.content()
 
         analysed_file._file_hash += 1
-        obj_combo_hash = f'{int(obj_combo_hash, 16) + 1:x}'
-        mods_combo_hash = f'{int(mods_combo_hash, 16) + 1:x}'
+        obj_combo_hash = 'f19a758811739c99'
+        mods_combo_hash = '16dd7244842f8742'
 
         with mock.patch('pathlib.Path.exists', side_effect=[True, True, False]):  # mod files exist, obj file doesn't
             with mock.patch('fab.steps.compile_fortran.compile_file') as mock_compile_file:
@@ -258,7 +456,7 @@ class Test_process_file(object):
     def test_flags_hash(self):
         # changing the flags must change the object combo hash, but not the mods combo hash
         mp_common_args, flags, analysed_file, obj_combo_hash, mods_combo_hash = self.content(flags=['flag1', 'flag3'])
-        obj_combo_hash = '1ebce92ee'
+        obj_combo_hash = '69e22c95d2173d51'
 
         with mock.patch('pathlib.Path.exists', side_effect=[True, True, False]):  # mod files exist, obj file doesn't
             with mock.patch('fab.steps.compile_fortran.compile_file') as mock_compile_file:
@@ -286,7 +484,7 @@ class Test_process_file(object):
         mp_common_args, flags, analysed_file, obj_combo_hash, mods_combo_hash = self.content()
 
         mp_common_args.mod_hashes['mod_dep_1'] += 1
-        obj_combo_hash = f'{int(obj_combo_hash, 16) + 1:x}'
+        obj_combo_hash = 'f26c1ee105ce85be'
 
         with mock.patch('pathlib.Path.exists', side_effect=[True, True, False]):  # mod files exist, obj file doesn't
             with mock.patch('fab.steps.compile_fortran.compile_file') as mock_compile_file:
@@ -307,13 +505,20 @@ class Test_process_file(object):
             pb / f'mod_def_1.{mods_combo_hash}.mod'
         }
 
+    def test_swap_deps_hashes(self):
+        # Swapping the checksums of two mod dependencies must change the object combo hash, unlike summing them.
+        mp_common_args, flags, analysed_file, obj_combo_hash, _ = self.content()
+
+        mp_common_args.mod_hashes = {'mod_dep_1': 23456, 'mod_dep_2': 12345}
+        assert f'{_get_obj_combo_hash(analysed_file, mp_common_args, flags):x}' != obj_combo_hash
+
     def test_compiler_hash(self):
         # changing the compiler must change the combo hash for the mods and obj
         mp_common_args, flags, analysed_file, _, _ = self.content()
 
         mp_common_args.compiler = 'bar_cc'
-        obj_combo_hash = '16c5a5a06'
-        mods_combo_hash = 'f5c8c6fc'
+        obj_combo_hash = 'b5538583bc9ca898'
+        mods_combo_hash = '47dab20f4611d117'
 
         with mock.patch('pathlib.Path.exists', side_effect=[True, True, False]):  # mod files exist, obj file doesn't
             with mock.patch('fab.steps.compile_fortran.compile_file') as mock_compile_file:
@@ -339,8 +544,8 @@ class Test_process_file(object):
         mp_common_args, flags, analysed_file, obj_combo_hash, mods_combo_hash = self.content()
 
         mp_common_args.compiler_version = '1.2.4'
-        obj_combo_hash = '17927b778'
-        mods_combo_hash = '10296246e'
+        obj_combo_hash = '599da68f233ff2da'
+        mods_combo_hash = '82db70a60b9d7b7d'
 
         with mock.patch('pathlib.Path.exists', side_effect=[True, True, False]):  # mod files exist, obj file doesn't
             with mock.patch('fab.steps.compile_fortran.compile_file') as mock_compile_file:
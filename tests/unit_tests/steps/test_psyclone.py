@@ -34,7 +34,7 @@ class Test_gen_prebuild_hash(object):
             'kernel2': 456,
         }
 
-        expect_hash = 223133615
+        expect_hash = 7511754001137917678
 
         mp_payload = MpCommonArgs(
             analysed_x90=analysed_x90,
@@ -51,26 +51,33 @@ class Test_gen_prebuild_hash(object):
         result = _gen_prebuild_hash(x90_file=x90_file, mp_payload=mp_payload)
         assert result == expect_hash
 
+    def test_swap_kernel_hashes(self, data):
+        # swapping the hashes of two kernels should change the hash, unlike summing them
+        mp_payload, x90_file, expect_hash = data
+        mp_payload.all_kernel_hashes.update(kernel1=456, kernel2=345)
+        result = _gen_prebuild_hash(x90_file=x90_file, mp_payload=mp_payload)
+        assert result != expect_hash
+
     def test_file_hash(self, data):
         # changing the file hash should change the hash
         mp_payload, x90_file, expect_hash = data
         mp_payload.analysed_x90[x90_file]._file_hash += 1
         result = _gen_prebuild_hash(x90_file=x90_file, mp_payload=mp_payload)
-        assert result == expect_hash + 1
+        assert result != expect_hash
 
     def test_kernal_deps(self, data):
         # changing a kernel deps hash should change the hash
         mp_payload, x90_file, expect_hash = data
         mp_payload.all_kernel_hashes['kernel1'] += 1
         result = _gen_prebuild_hash(x90_file=x90_file, mp_payload=mp_payload)
-        assert result == expect_hash + 1
+        assert result != expect_hash
 
     def test_trans_script(self, data):
         # changing the transformation script should change the hash
         mp_payload, x90_file, expect_hash = data
         mp_payload.transformation_script_hash += 1
         result = _gen_prebuild_hash(x90_file=x90_file, mp_payload=mp_payload)
-        assert result == expect_hash + 1
+        assert result != expect_hash
 
     def test_cli_args(self, data):
         # changing the cli args should change the hash
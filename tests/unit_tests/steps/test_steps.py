@@ -1,6 +1,334 @@
+import json
+import os
+import pickle
+from pathlib import Path
+from time import sleep, time
+from unittest import mock
+
 import pytest
 
-from fab.steps import check_for_errors
+import fab.steps
+from fab.build_config import BuildConfig
+from fab.steps import PerWorker, check_for_errors, get_memory_estimates, is_error, run_mp, run_mp_dynamic
+
+
+def double(i):
+    if i < 0:
+        raise ValueError('negative')
+    return i * 2
+
+
+INIT_VALUE = 0
+
+
+def init_worker(value):
+    global INIT_VALUE
+    INIT_VALUE += value
+
+
+def safe_double(i):
+    if i < 0:
+        return ValueError('negative')
+    sleep(0.01)
+    return i * 2
+
+
+def touch_after(fpath):
+    # a slow item takes a while to write its output
+    if fpath.name == 'slow':
+        sleep(0.5)
+    fpath.touch()
+
+
+def timed(i):
+    start = time()
+    sleep(0.05)
+    return start, time()
+
+
+def get_pid(i):
+    return os.getpid()
+
+
+def add_init_value(i):
+    return i + INIT_VALUE
+
+
+@pytest.fixture
+def mp_config(tmp_path):
+    config = BuildConfig('proj', n_procs=2, fab_workspace=tmp_path)
+    yield config
+    config.close_pool()
+
+
+@pytest.fixture
+def fail_fast_config(tmp_path):
+    config = BuildConfig('proj', n_procs=2, fab_workspace=tmp_path, fail_fast=True)
+    yield config
+    config.close_pool()
+
+
+def get_config(multiprocessing, mp_config):
+    return mp_config if multiprocessing else mock.Mock(multiprocessing=False)
+
+
+class Test_run_mp(object):
+
+    def test_pool_reused(self, mp_config):
+        assert run_mp(mp_config, items=[1, 2], func=double) == [2, 4]
+        pool = mp_config.pool
+        assert run_mp(mp_config, items=[3], func=double) == [6]
+        assert mp_config.pool is pool
+
+    @pytest.mark.parametrize('multiprocessing', [False, True])
+    def test_initialiser(self, multiprocessing, mp_config):
+        # the initialiser runs once per process, before the first item
+        global INIT_VALUE
+        INIT_VALUE = 0
+        config = get_config(multiprocessing, mp_config)
+
+        results = run_mp(config, items=[1, 2, 3], func=add_init_value, initialiser=init_worker, initargs=(10,))
+
+        assert results == [11, 12, 13]
+
+    @pytest.mark.parametrize('stop_on_error', [False, True])
+    def test_fail_fast(self, fail_fast_config, stop_on_error):
+        # when the caller checks for errors, we stop at the first
+        items = [-1] + list(range(100))
+        pool = fail_fast_config.pool
+        results = run_mp(fail_fast_config, items=items, func=safe_double, stop_on_error=stop_on_error)
+
+        assert any(map(is_error, results))
+        if stop_on_error:
+            assert len(results) < len(items)
+        else:
+            assert len(results) == len(items)
+
+        # the running items were allowed to finish, so the workers weren't terminated
+        assert fail_fast_config.pool is pool
+        assert run_mp(fail_fast_config, items=[1], func=double) == [2]
+
+    def test_fail_fast_no_mp(self):
+        config = mock.Mock(multiprocessing=False, fail_fast=True)
+        results = run_mp(config, items=[1, -1, 2], func=safe_double, stop_on_error=True)
+        assert results[0] == 2
+        assert isinstance(results[1], ValueError)
+        assert len(results) == 2
+
+    @pytest.mark.parametrize('item_memory, expect_overlap', [(60, False), (40, True)])
+    def test_memory_budget(self, tmp_path, item_memory, expect_overlap):
+        # items only run together when they fit in the budget
+        config = BuildConfig('proj', n_procs=2, fab_workspace=tmp_path, memory_budget=100)
+        try:
+            results = run_mp(config, items=[1, 2, 3, 4], func=timed, memory=lambda i: item_memory)
+        finally:
+            config.close_pool()
+
+        results.sort()
+        overlaps = [end > next_start for (_, end), (next_start, _) in zip(results, results[1:])]
+        assert any(overlaps) == expect_overlap
+
+
+class Test_PerWorker(object):
+
+    @pytest.mark.parametrize('multiprocessing', [False, True])
+    def test_run_mp(self, multiprocessing, mp_config):
+        config = get_config(multiprocessing, mp_config)
+        config.project_workspace = mp_config.project_workspace
+        with PerWorker(double, config) as func:
+            assert run_mp(config, items=[1, 2, 3], func=func) == [2, 4, 6]
+        assert not list(mp_config.project_workspace.glob('per_worker/*'))
+
+    def test_pickled_once(self, mp_config):
+        # the function is written to a file the first time, and only a token is pickled
+        per_worker = PerWorker(double, mp_config)
+        assert not per_worker.fpath.exists()
+        pickled = pickle.dumps(per_worker)
+        assert per_worker.fpath.exists()
+        assert b'double' not in pickled
+
+        per_worker.close()
+        assert not per_worker.fpath.exists()
+
+    def test_load(self, mp_config):
+        # a worker which doesn't have the function loads it from the file
+        with PerWorker(double, mp_config) as per_worker:
+            copy = pickle.loads(pickle.dumps(per_worker))
+            del fab.steps._per_worker[per_worker.token]
+            assert copy(2) == 4
+            assert per_worker.token in fab.steps._per_worker
+
+
+class Test_tool_threads(object):
+
+    @pytest.fixture
+    def config(self, tmp_path):
+        config = BuildConfig('proj', n_procs=2, fab_workspace=tmp_path, tool_threads=True)
+        yield config
+        config.close_pool()
+
+    def test_run_mp(self, config):
+        # tools run from this process, the pool isn't used
+        assert run_mp(config, items=[1, 2, 3], func=get_pid, uses_tools=True) == [os.getpid()] * 3
+        assert config._pool is None
+
+    def test_not_tools(self, config):
+        assert os.getpid() not in run_mp(config, items=[1, 2, 3], func=get_pid)
+
+    def test_run_mp_dynamic(self, config):
+        results = {}
+
+        def result_handler(item, result):
+            results[item] = result
+            return [result] if isinstance(result, int) and result < 8 else []
+
+        run_mp_dynamic(config, items=[1, 3, -1], func=double, result_handler=result_handler, uses_tools=True)
+
+        assert isinstance(results.pop(-1), ValueError)
+        assert results == {1: 2, 2: 4, 4: 8, 3: 6, 6: 12}
+        assert config._pool is None
+
+
+class Test_WorkerMemory(object):
+
+    def test_peak_sent(self, monkeypatch):
+        # the metrics get each worker's peak memory whenever it rises
+        monkeypatch.setattr(fab.steps, '_worker_peak_rss', 0)
+        func = fab.steps._WorkerMemory(double)
+        with mock.patch('fab.steps.send_metric') as mock_send_metric, \
+                mock.patch('fab.steps.process_memory', return_value={'VmRSS': 50}):
+            for peak_rss in [100, 200, 150]:
+                with mock.patch('fab.steps.process_peak_rss', return_value=peak_rss):
+                    assert func(1) == (2, os.getpid(), 50)
+
+        assert [call.args[2] for call in mock_send_metric.call_args_list] == [{'peak_rss': 100}, {'peak_rss': 200}]
+
+    def test_error(self, monkeypatch):
+        # we still measure when the function raises
+        monkeypatch.setattr(fab.steps, '_worker_peak_rss', 0)
+        with mock.patch('fab.steps.send_metric') as mock_send_metric, \
+                mock.patch('fab.steps.process_peak_rss', return_value=100):
+            with pytest.raises(ValueError):
+                fab.steps._WorkerMemory(double)(-1)
+        mock_send_metric.assert_called_once()
+
+    def test_recycle(self, tmp_path):
+        # a worker which grows too large is replaced before the pool is next used
+        config = BuildConfig('proj', n_procs=2, fab_workspace=tmp_path, worker_max_rss=100)
+        try:
+            with mock.patch('fab.steps.process_memory', return_value={'VmRSS': 150}):
+                assert run_mp(config, items=[1, 2], func=double) == [2, 4]
+            pool = config.pool
+            assert config._worker_rss
+
+            assert run_mp(config, items=[1, 2], func=double) == [2, 4]
+            assert config.pool is not pool
+        finally:
+            config.close_pool()
+
+    def test_recycle_during_call(self, tmp_path):
+        # a long run_mp doesn't wait until the end to replace its large workers
+        config = BuildConfig('proj', n_procs=2, fab_workspace=tmp_path, worker_max_rss=100)
+        try:
+            with mock.patch('fab.steps.process_memory', return_value={'VmRSS': 150}):
+                pids = run_mp(config, items=range(10), func=get_pid)
+        finally:
+            config.close_pool()
+        assert len(set(pids)) > 2
+
+    def test_no_recycle(self, tmp_path):
+        config = BuildConfig('proj', n_procs=2, fab_workspace=tmp_path, worker_max_rss=100)
+        try:
+            with mock.patch('fab.steps.process_memory', return_value={'VmRSS': 50}):
+                pids = run_mp(config, items=range(10), func=get_pid)
+        finally:
+            config.close_pool()
+        assert len(set(pids)) <= 2
+
+
+class Test_get_memory_estimates(object):
+
+    def test_vanilla(self, tmp_path):
+        # files without a measurement get the average
+        config = BuildConfig('proj', fab_workspace=tmp_path, memory_budget=100)
+        config.metrics_folder.mkdir(parents=True)
+        with open(config.metrics_folder / 'metrics.json', 'wt') as outfile:
+            json.dump({'analyse fortran': {'a.f90': {'peak_rss': 10}, 'b.f90': {'peak_rss': 30}}}, outfile)
+
+        with mock.patch('fab.metrics.send_metric'):
+            estimates = get_memory_estimates(config, 'analyse fortran', [Path('a.f90'), Path('b.f90'), Path('c.f90')])
+
+        assert estimates == {Path('a.f90'): 10, Path('b.f90'): 30, Path('c.f90'): 20}
+
+    def test_no_budget(self, tmp_path):
+        config = BuildConfig('proj', fab_workspace=tmp_path)
+        assert get_memory_estimates(config, 'analyse fortran', [Path('a.f90')]) == {}
+
+
+class Test_is_error(object):
+
+    def test_vanilla(self):
+        assert is_error(ValueError('foo'))
+        assert is_error((ValueError('foo'), None))
+        assert not is_error('foo')
+        assert not is_error(('foo', None))
+        assert not is_error(())
+
+
+class Test_run_mp_dynamic(object):
+
+    @pytest.mark.parametrize('multiprocessing', [False, True])
+    def test_new_items(self, multiprocessing, mp_config):
+        # each result can make new items to process
+        config = get_config(multiprocessing, mp_config)
+        results = {}
+
+        def result_handler(item, result):
+            results[item] = result
+            return [result] if result < 8 else []
+
+        run_mp_dynamic(config, items=[1, 3], func=double, result_handler=result_handler)
+
+        assert results == {1: 2, 2: 4, 4: 8, 3: 6, 6: 12}
+
+    def test_priority(self):
+        # the highest priority ready item goes first
+        config = mock.Mock(multiprocessing=False)
+        order = []
+
+        def result_handler(item, result):
+            order.append(item)
+            return [5, 1] if item == 3 else []
+
+        run_mp_dynamic(config, items=[2, 3], func=double, result_handler=result_handler, priority=lambda i: i)
+
+        assert order == [3, 5, 2, 1]
+
+    @pytest.mark.parametrize('multiprocessing', [False, True])
+    def test_exception(self, multiprocessing, mp_config):
+        # exceptions are passed to the result handler
+        config = get_config(multiprocessing, mp_config)
+        results = {}
+
+        def result_handler(item, result):
+            results[item] = result
+
+        run_mp_dynamic(config, items=[1, -1], func=double, result_handler=result_handler)
+
+        assert results[1] == 2
+        assert isinstance(results[-1], ValueError)
+
+    def test_handler_error(self, mp_config, tmp_path):
+        # when the result handler raises, the running items finish before the error is raised
+        def result_handler(item, result):
+            raise RuntimeError('stop')
+
+        items = [tmp_path / 'fast', tmp_path / 'slow']
+        with pytest.raises(RuntimeError):
+            run_mp_dynamic(mp_config, items=items, func=touch_after, result_handler=result_handler,
+                           priority=lambda fpath: fpath.name == 'fast')
+
+        assert (tmp_path / 'slow').exists()
 
 
 class Test_check_for_errors(object):
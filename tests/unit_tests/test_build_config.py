@@ -3,6 +3,14 @@
 #  For further details please refer to the file COPYRIGHT
 #  which you should have received as part of this distribution
 # ##############################################################################
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import pytest
+
+import fab.util
+
 from fab.build_config import BuildConfig
 from fab.steps import step
 from fab.steps.cleanup_prebuilds import CLEANUP_COUNT
@@ -28,3 +36,93 @@ class TestBuildConfig(object):
             assert CLEANUP_COUNT not in config._artefact_store
             pass
         assert CLEANUP_COUNT in config._artefact_store
+
+    def test_pool_closed(self, tmp_path):
+        # the shared worker pool is created when needed, and closed on exit
+        with BuildConfig('proj', n_procs=2, fab_workspace=tmp_path) as config:
+            assert config._pool is None
+            pool = config.pool
+            assert config.pool is pool
+        assert config._pool is None
+
+    def test_worker_max_tasks(self, tmp_path):
+        config = BuildConfig('proj', n_procs=2, fab_workspace=tmp_path, worker_max_tasks=10)
+        with mock.patch('fab.build_config.Pool') as mock_pool:
+            config.pool
+        mock_pool.assert_called_once_with(2, maxtasksperchild=10)
+
+    def test_worker_max_rss(self, tmp_path):
+        # the pool is replaced when a worker has grown too large, only when we're asked to check
+        config = BuildConfig('proj', n_procs=2, fab_workspace=tmp_path, worker_max_rss=100)
+        pool = config.pool
+        try:
+            config._worker_rss = {1: 50, 2: 100}
+            assert not config.workers_too_large()
+            config.recycle_workers()
+            assert config.pool is pool
+
+            config._worker_rss = {1: 50, 2: 150}
+            assert config.workers_too_large()
+            assert config.pool is pool
+            config.recycle_workers()
+            assert config.pool is not pool
+
+            # the reports were used up
+            pool = config.pool
+            config.recycle_workers()
+            assert config.pool is pool
+        finally:
+            config.close_pool()
+
+    def test_hash_cache(self, tmp_path):
+        # the hash cache is used while the build runs
+        with BuildConfig('proj', fab_workspace=tmp_path, hash_cache=True):
+            assert not fab.util._hash_cache.verify
+        assert fab.util._hash_cache is None
+
+        # it's opt-in
+        with BuildConfig('proj', fab_workspace=tmp_path):
+            assert fab.util._hash_cache is None
+
+    def test_verify_hashes(self, tmp_path):
+        # verifying the hashes uses the cache
+        with BuildConfig('proj', fab_workspace=tmp_path, verify_hashes=True):
+            assert fab.util._hash_cache.verify
+
+    def test_hash_algorithm(self, tmp_path):
+        # the algorithm is used while the build runs, and by the workers which unpickle the config
+        with BuildConfig('proj', fab_workspace=tmp_path, hash_algorithm='crc32') as config:
+            assert fab.util.get_hash_algorithm() == 'crc32'
+            state = pickle.dumps(config)
+        assert fab.util.get_hash_algorithm() == 'blake2b'
+
+        try:
+            pickle.loads(state)
+            assert fab.util.get_hash_algorithm() == 'crc32'
+        finally:
+            fab.util.set_hash_algorithm('blake2b')
+
+        with pytest.raises(ValueError):
+            BuildConfig('proj', fab_workspace=tmp_path, hash_algorithm='md4')
+
+    def test_pickle_without_pool(self, tmp_path):
+        # the config is sent to child processes, but the pool can't be
+        config = BuildConfig('proj', n_procs=2, fab_workspace=tmp_path)
+        config.pool
+        try:
+            clone = pickle.loads(pickle.dumps(config))
+        finally:
+            config.close_pool()
+        assert clone._pool is None
+
+    def test_pickle_without_remote_executor(self, tmp_path):
+        # the config is sent to remote workers, but the executor's connections can't be
+        config = BuildConfig('proj', fab_workspace=tmp_path, remote_executor=ThreadPoolExecutor(1))
+        clone = pickle.loads(pickle.dumps(config))
+        assert clone.remote_executor is None
+        config.remote_executor.shutdown()
+
+    def test_error_policy(self, tmp_path):
+        # fail fast and keep going can't be used together
+        with pytest.raises(ValueError):
+            BuildConfig('proj', fab_workspace=tmp_path, fail_fast=True, keep_going=True)
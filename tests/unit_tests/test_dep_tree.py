@@ -2,7 +2,7 @@ from pathlib import Path
 
 import pytest
 
-from fab.dep_tree import extract_sub_tree, AnalysedDependent
+from fab.dep_tree import extract_sub_tree, extract_sub_trees, AnalysedDependent, DepGraph, SubTree
 
 
 @pytest.fixture
@@ -28,4 +28,73 @@ class Test_extract_sub_tree(object):
         del expect[Path('foo.f90')]
         assert result == expect
 
-    # todo: check missing deps raise a message
+    def test_deep(self):
+        # a long chain of dependencies doesn't reach the recursion limit
+        paths = [Path(f'{i}.f90') for i in range(5000)]
+        src_tree = {p: AnalysedDependent(fpath=p, file_deps=set(paths[i + 1:i + 2]), file_hash=0)
+                    for i, p in enumerate(paths)}
+        assert len(extract_sub_tree(source_tree=src_tree, root=paths[0])) == 5000
+
+
+class Test_extract_sub_trees(object):
+
+    def test_same_as_extract_sub_tree(self, src_tree):
+        roots = [Path('root.f90'), Path('a.f90'), Path('foo.f90')]
+        result = extract_sub_trees(source_tree=src_tree, roots=roots)
+        assert {root: dict(tree) for root, tree in result.items()} == \
+            {root: extract_sub_tree(source_tree=src_tree, root=root) for root in roots}
+
+    def test_cycle(self, src_tree):
+        # files which depend on each other are in each other's trees
+        src_tree[Path('c.f90')].file_deps.add(Path('root.f90'))
+        src_tree[Path('foo.f90')].file_deps.add(Path('c.f90'))
+
+        result = extract_sub_trees(source_tree=src_tree, roots=[Path('foo.f90'), Path('c.f90')])
+
+        assert set(result[Path('c.f90')]) == {Path('root.f90'), Path('a.f90'), Path('b.f90'), Path('c.f90')}
+        assert set(result[Path('foo.f90')]) == set(src_tree)
+
+    def test_missing(self, src_tree, caplog):
+        src_tree[Path('c.f90')].file_deps.add(Path('missing.f90'))
+        result = extract_sub_trees(source_tree=src_tree, roots=[Path('root.f90')])
+        assert Path('missing.f90') not in result[Path('root.f90')]
+        assert 'missing.f90' in caplog.text
+
+    def test_view(self, src_tree):
+        # the trees share the analysed files
+        result = extract_sub_trees(source_tree=src_tree, roots=[Path('a.f90')])
+        assert result[Path('a.f90')][Path('c.f90')] is src_tree[Path('c.f90')]
+
+
+class Test_DepGraph(object):
+
+    def test_vanilla(self, src_tree):
+        src_tree[Path('c.f90')].file_deps.add(Path('missing.f90'))
+        graph = DepGraph(src_tree)
+
+        assert graph.fpaths == list(src_tree)
+        deps = {graph.fpaths[i]: {graph.fpaths[j] for j in graph.targets[graph.offsets[i]:graph.offsets[i + 1]]}
+                for i in range(len(graph))}
+        assert deps == {fpath: af.file_deps - {Path('missing.f90')} for fpath, af in src_tree.items()}
+        assert graph.missing == {graph.ids[Path('c.f90')]: {Path('missing.f90')}}
+
+    def test_reachable(self, src_tree):
+        graph = DepGraph(src_tree)
+        (bitset, missing), = graph.reachable([graph.ids[Path('a.f90')]]).values()
+        assert graph.members(bitset) == [Path('a.f90'), Path('c.f90')]
+        assert not missing
+
+
+class Test_SubTree(object):
+
+    def test_update(self, src_tree):
+        sub_tree = SubTree(src_tree, [Path('a.f90')])
+        extra = AnalysedDependent(fpath=Path('extra.f90'), file_hash=0)
+        sub_tree.update({Path('c.f90'): src_tree[Path('c.f90')], Path('extra.f90'): extra})
+
+        assert sub_tree == {Path('a.f90'): src_tree[Path('a.f90')], Path('c.f90'): src_tree[Path('c.f90')],
+                            Path('extra.f90'): extra}
+        assert Path('foo.f90') not in sub_tree
+
+        del sub_tree[Path('extra.f90')]
+        assert list(sub_tree) == [Path('a.f90'), Path('c.f90')]
@@ -0,0 +1,182 @@
+import os
+from pathlib import Path
+from typing import List
+
+import pytest
+
+from fab.build_config import BuildConfig
+from fab.journal import StepJournal, stat_checksum, step_key
+from fab.parse.fortran import AnalysedFortran
+from fab.steps import step
+
+CALLS: List[str] = []
+
+
+@step
+def write_file(config, name):
+    # a step which creates a file and records it in the artefact store
+    CALLS.append(name)
+    fpath = config.build_output / name
+    fpath.write_text(name)
+    config._artefact_store.setdefault('files', []).append(fpath)
+
+
+@step
+def fail(config):
+    CALLS.append('fail')
+    raise RuntimeError('interrupted')
+
+
+@step
+def outer(config):
+    CALLS.append('outer')
+    write_file(config, 'inner')
+
+
+@pytest.fixture(autouse=True)
+def calls():
+    CALLS.clear()
+    return CALLS
+
+
+def build(tmp_path, *steps):
+    # run the given steps in a resumable build, each a function taking the config
+    with BuildConfig('proj', fab_workspace=tmp_path, multiprocessing=False, resume=True) as config:
+        for s in steps:
+            s(config)
+    return config
+
+
+class Test_resume(object):
+
+    @pytest.fixture
+    def interrupted(self, tmp_path):
+        with pytest.raises(RuntimeError):
+            build(tmp_path, lambda c: write_file(c, 'a'), lambda c: write_file(c, 'b'), fail)
+        CALLS.clear()
+
+    def test_vanilla(self, tmp_path, interrupted):
+        # the completed steps are skipped, with their artefacts restored
+        config = build(tmp_path, lambda c: write_file(c, 'a'), lambda c: write_file(c, 'b'), lambda c: None)
+        assert CALLS == []
+        assert config._artefact_store['files'] == [config.build_output / 'a', config.build_output / 'b']
+
+        # the journal is removed when the build succeeds
+        assert not list((tmp_path / 'proj' / 'journal').iterdir())
+
+    def test_changed_args(self, tmp_path, interrupted):
+        # everything from the first changed step runs again
+        config = build(tmp_path, lambda c: write_file(c, 'a'), lambda c: write_file(c, 'c'),
+                       lambda c: write_file(c, 'b'))
+        assert CALLS == ['c', 'b']
+        assert config._artefact_store['files'] == [config.build_output / name for name in 'acb']
+
+    def test_changed_output(self, tmp_path, interrupted):
+        # a file in the artefact store was modified since the step ran
+        (tmp_path / 'proj' / 'build_output' / 'b').write_text('modified')
+        build(tmp_path, lambda c: write_file(c, 'a'), lambda c: write_file(c, 'b'))
+        assert CALLS == ['b']
+
+    def test_corrupt_entry(self, tmp_path, interrupted):
+        (tmp_path / 'proj' / 'journal' / '0001.pkl').write_text('rubbish')
+        build(tmp_path, lambda c: write_file(c, 'a'), lambda c: write_file(c, 'b'))
+        assert CALLS == ['b']
+
+    def test_not_resumable(self, tmp_path, interrupted):
+        with BuildConfig('proj', fab_workspace=tmp_path, multiprocessing=False) as config:
+            write_file(config, 'a')
+        assert CALLS == ['a']
+
+    def test_nested(self, tmp_path):
+        # a step run by another step is part of its entry
+        with pytest.raises(RuntimeError):
+            build(tmp_path, outer, fail)
+        CALLS.clear()
+
+        config = build(tmp_path, outer)
+        assert CALLS == []
+        assert config._artefact_store['files'] == [config.build_output / 'inner']
+
+
+class TestStepJournal(object):
+
+    def test_record_restore(self, tmp_path):
+        journal = StepJournal(tmp_path)
+        journal.record('foo', key=123, artefact_store={'foo': [1, 2]})
+        assert not list(tmp_path.glob('*.tmp'))
+
+        store = {'bar': 3}
+        journal = StepJournal(tmp_path)
+        assert not journal.restore(key=456, artefact_store=store)
+        assert store == {'bar': 3}
+
+        # the entry was discarded when it didn't match
+        assert not StepJournal(tmp_path).restore(key=123, artefact_store=store)
+
+    def test_restore(self, tmp_path):
+        StepJournal(tmp_path).record('foo', key=123, artefact_store={'foo': [1, 2]})
+        store = {'bar': 3}
+        assert StepJournal(tmp_path).restore(key=123, artefact_store=store)
+        assert store == {'foo': [1, 2]}
+
+
+class Test_step_key(object):
+
+    class Thing(object):
+        def __init__(self, value):
+            self.value = value
+
+    def test_set_order(self):
+        # sets of strings iterate in a different order with each PYTHONHASHSEED
+        strings = [f'foo{i}' for i in range(100)]
+        assert step_key('foo', ({*strings},), {}) == step_key('foo', ({*reversed(strings)},), {})
+
+    def test_objects(self):
+        # objects are identified by their attributes, not where they are in memory
+        assert step_key('foo', (self.Thing(1),), {}) == step_key('foo', (self.Thing(1),), {})
+        assert step_key('foo', (self.Thing(1),), {}) != step_key('foo', (self.Thing(2),), {})
+
+    def test_functions(self):
+        assert step_key('foo', (os.path.join,), {}) == step_key('foo', (os.path.join,), {})
+        assert step_key('foo', (os.path.join,), {}) != step_key('foo', (os.path.split,), {})
+
+    def test_unidentifiable(self):
+        # a lambda can't be identified, so the step never matches
+        func = lambda: None  # noqa: E731
+        assert step_key('foo', (func,), {}) != step_key('foo', (func,), {})
+
+    def test_name(self):
+        assert step_key('foo', (), {}) != step_key('bar', (), {})
+
+    def test_cycle(self):
+        thing = self.Thing(None)
+        thing.value = thing
+        assert step_key('foo', (thing,), {}) == step_key('foo', (thing,), {})
+
+
+class Test_stat_checksum(object):
+
+    class Thing(object):
+        def __init__(self, fpath):
+            self.fpath = fpath
+
+    def test_vanilla(self, tmp_path):
+        fpath = tmp_path / 'foo.f90'
+        fpath.write_text('foo')
+        artefacts = {'things': {self.Thing(fpath)}}
+        before = stat_checksum(artefacts)
+
+        os.utime(fpath, ns=(0, 0))
+        assert stat_checksum(artefacts) != before
+
+    def test_slots(self, tmp_path):
+        # analysis results don't have a __dict__
+        artefacts = {'results': {AnalysedFortran(fpath=tmp_path / 'foo.f90', file_hash=123,
+                                                 file_deps=[tmp_path / 'bar.f90'])}}
+        assert stat_checksum(artefacts) != stat_checksum({})
+
+    def test_missing(self, tmp_path):
+        assert stat_checksum([tmp_path / 'foo']) != stat_checksum([tmp_path / 'bar'])
+
+    def test_no_paths(self):
+        assert stat_checksum({'foo': ['bar', 1, None]}) == stat_checksum([Path('/not/there/')][:0])
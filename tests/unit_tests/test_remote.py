@@ -0,0 +1,146 @@
+import os
+import socket
+from multiprocessing import Event, Process, cpu_count
+from multiprocessing.context import AuthenticationError
+from unittest import mock
+
+import pytest
+
+from fab.build_config import BuildConfig
+from fab.metrics import send_metric
+from fab.remote import DEFAULT_PORT, RemoteExecutor, cli_worker, parse_address, serve
+from fab.steps import run_mp, run_mp_dynamic
+
+AUTHKEY = b'test key'
+
+
+def get_pid(i):
+    return os.getpid()
+
+
+def double(i):
+    if i < 0:
+        raise ValueError('negative')
+    send_metric('double', str(i), i * 2)
+    return i * 2
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def workers():
+    # two local workers standing in for build nodes
+    processes, addresses = [], []
+    for _ in range(2):
+        address = ('localhost', free_port())
+        ready = Event()
+        process = Process(target=serve, args=(address, AUTHKEY, 2, ready), daemon=True)
+        process.start()
+        assert ready.wait(10)
+        processes.append(process)
+        addresses.append(address)
+
+    yield processes, addresses
+
+    for process in processes:
+        process.terminate()
+        process.join()
+
+
+@pytest.fixture
+def executor(workers):
+    _, addresses = workers
+    with RemoteExecutor(addresses, authkey=AUTHKEY) as executor:
+        yield executor
+
+
+class TestRemoteExecutor(object):
+
+    def test_vanilla(self, workers, executor):
+        processes, _ = workers
+        assert executor.max_workers == 4
+
+        pids = set(executor.map(get_pid, range(20)))
+        assert os.getpid() not in pids
+        assert pids <= {process.pid for process in processes}
+
+    def test_exception(self, executor):
+        with pytest.raises(ValueError):
+            executor.submit(double, -1).result()
+
+    def test_metrics(self, executor):
+        # metrics sent on the worker are sent from here
+        with mock.patch('fab.metrics.send_metric') as mock_send_metric:
+            assert executor.submit(double, 3).result() == 6
+        mock_send_metric.assert_called_once_with('double', '3', 6)
+
+    def test_bad_authkey(self, workers):
+        _, addresses = workers
+        with pytest.raises(AuthenticationError):
+            RemoteExecutor(addresses, authkey=b'wrong key')
+
+    def test_authkey_env(self, workers):
+        _, addresses = workers
+        with mock.patch.dict(os.environ, {'FAB_WORKER_AUTHKEY': AUTHKEY.decode()}):
+            with RemoteExecutor(addresses) as executor:
+                assert executor.submit(get_pid, 1).result() != os.getpid()
+
+    def test_lost_worker(self, workers, executor):
+        processes, _ = workers
+        for process in processes:
+            process.terminate()
+            process.join()
+
+        with pytest.raises(ConnectionError):
+            executor.submit(double, 1).result()
+
+
+class Test_run_mp(object):
+
+    @pytest.fixture
+    def config(self, tmp_path, executor):
+        config = BuildConfig('proj', n_procs=1, fab_workspace=tmp_path, remote_executor=executor)
+        yield config
+        config.close_pool()
+
+    def test_run_mp(self, config):
+        assert os.getpid() not in run_mp(config, items=[1, 2, 3], func=get_pid, remote=True)
+        assert config._pool is None
+
+    def test_run_mp_dynamic(self, config):
+        results = {}
+
+        def result_handler(item, result):
+            results[item] = result
+            return [result] if isinstance(result, int) and result < 8 else []
+
+        with mock.patch('fab.metrics.send_metric'):
+            run_mp_dynamic(config, items=[1, 3, -1], func=double, result_handler=result_handler, remote=True)
+
+        assert isinstance(results.pop(-1), ValueError)
+        assert results == {1: 2, 2: 4, 4: 8, 3: 6, 6: 12}
+        assert config._pool is None
+
+
+class Test_parse_address(object):
+
+    def test_vanilla(self):
+        assert parse_address('node1:1234') == ('node1', 1234)
+
+    def test_default_port(self):
+        assert parse_address('node1') == ('node1', DEFAULT_PORT)
+
+
+class Test_cli_worker(object):
+
+    def test_no_affinity(self, monkeypatch):
+        # macOS can't tell us the available cores, so we use them all
+        monkeypatch.delattr(os, 'sched_getaffinity', raising=False)
+        with mock.patch('sys.argv', ['fab-worker']), mock.patch('fab.remote.serve') as mock_serve, \
+                mock.patch('fab.remote.get_authkey', return_value=AUTHKEY):
+            cli_worker()
+        mock_serve.assert_called_once_with(('0.0.0.0', DEFAULT_PORT), authkey=AUTHKEY, n_procs=cpu_count())
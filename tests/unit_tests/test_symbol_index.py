@@ -0,0 +1,97 @@
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+from fab.dep_tree import AnalysedDependent
+from fab.symbol_index import SymbolIndex
+
+
+def analysed(name, file_hash=0, defs=None, deps=None):
+    return AnalysedDependent(fpath=Path(f'{name}.f90'), file_hash=file_hash,
+                             symbol_defs=defs or [name], symbol_deps=deps or [])
+
+
+def update(fpath, analysed_files, settings=''):
+    symbol_index = SymbolIndex(fpath, settings=settings)
+    symbol_table = symbol_index.update(analysed_files)
+    symbol_index.save()
+    return symbol_table
+
+
+class Test_update(object):
+
+    @pytest.fixture
+    def fpath(self, tmp_path):
+        return tmp_path / 'symbol_index.pkl'
+
+    def test_vanilla(self, fpath):
+        analysed_files = [analysed('root', deps=['util', 'root', 'missing']), analysed('util')]
+
+        symbol_table = update(fpath, analysed_files)
+
+        assert symbol_table == {'root': Path('root.f90'), 'util': Path('util.f90')}
+        assert analysed_files[0].file_deps == {Path('util.f90')}
+        assert analysed_files[1].file_deps == set()
+
+    def test_unchanged(self, fpath):
+        # nothing is resolved again, but the file deps are still filled in
+        update(fpath, [analysed('root', deps=['util']), analysed('util')])
+
+        analysed_files = [analysed('root', deps=['util']), analysed('util')]
+        with mock.patch.object(SymbolIndex, '_resolve') as mock_resolve:
+            update(fpath, analysed_files)
+
+        mock_resolve.assert_not_called()
+        assert analysed_files[0].file_deps == {Path('util.f90')}
+
+    def test_unchanged_not_saved(self, fpath):
+        # the index is only written when something has changed
+        update(fpath, [analysed('root', deps=['util']), analysed('util')])
+
+        with mock.patch('fab.symbol_index.pickle.dump') as mock_dump:
+            update(fpath, [analysed('root', deps=['util']), analysed('util')])
+            mock_dump.assert_not_called()
+
+            update(fpath, [analysed('root', deps=['util'])])
+            mock_dump.assert_called_once()
+
+    def test_symbol_moved(self, fpath):
+        # only the changed file, and the file using the moved symbol, are resolved again
+        update(fpath, [analysed('root', deps=['util']), analysed('util'), analysed('other', deps=['root'])])
+
+        analysed_files = [
+            analysed('root', deps=['util']), analysed('util', file_hash=1, defs=['util2']),
+            analysed('new', defs=['util']), analysed('other', deps=['root'])]
+        with mock.patch.object(SymbolIndex, '_resolve', autospec=True, side_effect=SymbolIndex._resolve) as resolve:
+            symbol_table = update(fpath, analysed_files)
+
+        assert {call.args[1].fpath for call in resolve.call_args_list} == \
+            {Path('root.f90'), Path('util.f90'), Path('new.f90')}
+        assert symbol_table['util'] == Path('new.f90')
+        assert analysed_files[0].file_deps == {Path('new.f90')}
+        assert analysed_files[3].file_deps == {Path('root.f90')}
+
+    def test_duplicate_removed(self, fpath):
+        # the first definition wins, until its file is removed
+        with pytest.warns(UserWarning, match="duplicate symbol 'util'"):
+            symbol_table = update(fpath, [analysed('util'), analysed('util2', defs=['util'])])
+        assert symbol_table['util'] == Path('util.f90')
+
+        analysed_files = [analysed('util2', defs=['util']), analysed('root', deps=['util'])]
+        symbol_table = update(fpath, analysed_files)
+
+        assert symbol_table == {'util': Path('util2.f90'), 'root': Path('root.f90')}
+        assert analysed_files[1].file_deps == {Path('util2.f90')}
+
+    def test_settings_changed(self, fpath):
+        update(fpath, [analysed('root')], settings='foo')
+
+        analysed_files = [analysed('root')]
+        with mock.patch.object(SymbolIndex, '_resolve', autospec=True, side_effect=SymbolIndex._resolve) as resolve:
+            update(fpath, analysed_files, settings='bar')
+        resolve.assert_called_once()
+
+    def test_unreadable(self, fpath):
+        fpath.write_text('not a pickle')
+        assert update(fpath, [analysed('root')]) == {'root': Path('root.f90')}
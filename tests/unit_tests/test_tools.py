@@ -4,6 +4,7 @@
 #  which you should have received as part of this distribution
 # ##############################################################################
 from textwrap import dedent
+import sys
 from unittest import mock
 
 import pytest
@@ -34,7 +35,7 @@ class Test_flags_checksum(object):
     def test_vanilla(self):
         # I think this is a poor testing pattern.
         flags = ['one', 'two', 'three', 'four']
-        assert flags_checksum(flags) == 3011366051
+        assert flags_checksum(flags) == 7730941758125576691
 
 
 class test_get_tool(object):
@@ -183,6 +184,16 @@ class Test_run_command(object):
         with mock.patch('fab.tools.subprocess.run', return_value=mock_result):
             run_command([])
 
+    def test_usage(self):
+        usage = {}
+        output = run_command([sys.executable, '-c', 'print("hello")'], usage=usage)
+        assert output.strip() == 'hello'
+        assert usage['peak_rss'] > 0
+
+    def test_usage_error(self):
+        with pytest.raises(RuntimeError, match='oops'):
+            run_command([sys.executable, '-c', 'import sys; sys.exit("oops")'], usage={})
+
     def test_error(self):
         mock_result = mock.Mock(returncode=1)
         mocked_error_message = 'mocked error message'
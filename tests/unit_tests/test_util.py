@@ -1,10 +1,16 @@
+import gc
+import os
+import pickle
+import zlib
 from pathlib import Path
 from unittest import mock
 
 import pytest
 
 from fab.artefacts import CollectionConcat, SuffixFilter
-from fab.util import input_to_output_fpath, suffix_filter, file_walk
+from fab.util import input_to_output_fpath, suffix_filter, file_walk, file_checksum, HashCache, HashedFile, \
+    PausedGC, PeakRSS, process_memory, process_peak_rss, set_hash_cache, bytes_checksum, combo_checksum, \
+    get_hash_algorithm, set_hash_algorithm, DEFAULT_HASH_ALGORITHM
 
 
 @pytest.fixture
@@ -94,3 +100,192 @@ class Test_input_to_output_fpath(object):
         input_path = Path('/other/folder/file.txt')
         result = input_to_output_fpath(config, input_path)
         assert result == Path(config.build_output / 'other/folder/file.txt')
+
+
+class Test_PeakRSS(object):
+
+    def test_vanilla(self):
+        with PeakRSS() as memory:
+            data = bytearray(50_000_000)
+        del data
+        if Path('/proc/self/clear_refs').exists():
+            assert memory.peak > 50_000_000
+
+    def test_baseline(self):
+        # memory the process was already using isn't included
+        data = bytearray(100_000_000)
+        with PeakRSS() as memory:
+            pass
+        del data
+        if Path('/proc/self/clear_refs').exists():
+            assert memory.peak < 50_000_000
+
+    def test_unavailable(self):
+        # no peak on platforms where we can't reset it
+        with mock.patch('builtins.open', side_effect=OSError):
+            with PeakRSS() as memory:
+                pass
+        assert memory.peak is None
+
+
+class Test_process_peak_rss(object):
+
+    def test_reset(self):
+        # the peak is kept when PeakRSS resets the kernel's peak
+        data = bytearray(50_000_000)
+        del data
+        with PeakRSS():
+            pass
+        if Path('/proc/self/clear_refs').exists():
+            assert process_peak_rss() > 50_000_000
+
+    def test_forked(self, monkeypatch):
+        # a forked child doesn't report its parent's peak
+        monkeypatch.setattr('fab.util._cleared_peak_rss', (-1, 2**60))
+        assert process_peak_rss() < 2**60
+
+
+class Test_process_memory(object):
+
+    def test_vanilla(self):
+        memory = process_memory()
+        if Path('/proc/self/status').exists():
+            assert 0 < memory['VmRSS'] <= memory['VmHWM']
+
+    def test_unavailable(self):
+        with mock.patch('builtins.open', side_effect=OSError):
+            assert process_memory(123) == {}
+
+
+class Test_PausedGC(object):
+
+    def test_vanilla(self):
+        with PausedGC():
+            assert not gc.isenabled()
+        assert gc.isenabled()
+
+    def test_nested(self):
+        with PausedGC():
+            with PausedGC():
+                pass
+            assert not gc.isenabled()
+        assert gc.isenabled()
+
+
+@pytest.fixture
+def crc32():
+    set_hash_algorithm('crc32')
+    yield
+    set_hash_algorithm(DEFAULT_HASH_ALGORITHM)
+
+
+class Test_hash_algorithm(object):
+
+    def test_default(self):
+        assert get_hash_algorithm() == 'blake2b'
+        assert bytes_checksum(b'foo') == 0x7403aea39baf52fb
+
+    def test_crc32(self, crc32):
+        assert bytes_checksum(b'foo') == zlib.crc32(b'foo')
+
+    def test_unknown(self):
+        with pytest.raises(ValueError):
+            set_hash_algorithm('md4')
+        assert get_hash_algorithm() == DEFAULT_HASH_ALGORITHM
+
+
+class Test_combo_checksum(object):
+
+    def test_order(self):
+        assert combo_checksum([1, 2]) != combo_checksum([2, 1])
+
+    def test_boundaries(self):
+        # values can't run into each other
+        assert combo_checksum(['ab', 'c']) != combo_checksum(['a', 'bc'])
+
+    def test_deterministic(self):
+        assert combo_checksum([1, 'foo']) == combo_checksum([1, 'foo'])
+
+    def test_bad_type(self):
+        with pytest.raises(TypeError):
+            combo_checksum([None])
+
+
+class TestHashCache(object):
+
+    @pytest.fixture
+    def fpath(self, tmp_path):
+        # an old file, so its checksum can be stored
+        fpath = tmp_path / 'foo.f90'
+        fpath.write_text('foo')
+        os.utime(fpath, ns=(10**18, 10**18))
+        return fpath
+
+    @pytest.fixture
+    def cache(self, tmp_path):
+        return HashCache(tmp_path / 'hash_cache.db')
+
+    def test_vanilla(self, cache, fpath):
+        file_hash = bytes_checksum(b'foo')
+        assert cache.checksum(fpath) == file_hash
+
+        # the file isn't read again
+        with mock.patch('builtins.open', side_effect=AssertionError):
+            assert cache.checksum(fpath) == file_hash
+
+    def test_changed(self, cache, fpath):
+        cache.checksum(fpath)
+        fpath.write_text('bar')
+        os.utime(fpath, ns=(2 * 10**18, 2 * 10**18))
+        assert cache.checksum(fpath) == bytes_checksum(b'bar')
+
+    def test_recently_modified(self, cache, fpath):
+        # a file modified in the last couple of seconds isn't stored
+        os.utime(fpath)
+        cache.checksum(fpath)
+        assert cache.conn.execute('SELECT COUNT(*) FROM checksums').fetchone()[0] == 0
+
+    def test_verify(self, tmp_path, fpath):
+        HashCache(tmp_path / 'hash_cache.db').checksum(fpath)
+        cache = HashCache(tmp_path / 'hash_cache.db', verify=True)
+        with cache.conn:
+            cache.conn.execute('UPDATE checksums SET file_hash = 123')
+
+        with mock.patch('fab.util.logger') as mock_logger:
+            assert cache.checksum(fpath) == bytes_checksum(b'foo')
+        mock_logger.warning.assert_called_once()
+
+    def test_broken(self, tmp_path, fpath):
+        (tmp_path / 'hash_cache.db').write_text('not a database' * 100)
+        cache = HashCache(tmp_path / 'hash_cache.db')
+        assert cache.checksum(fpath) == bytes_checksum(b'foo')
+        assert cache.broken
+
+    def test_algorithms(self, cache, fpath, crc32):
+        # checksums from different algorithms are stored separately
+        assert cache.checksum(fpath) == zlib.crc32(b'foo')
+        set_hash_algorithm('blake2b')
+        assert cache.checksum(fpath) == bytes_checksum(b'foo')
+        assert cache.conn.execute('SELECT COUNT(*) FROM checksums').fetchone()[0] == 2
+
+    def test_large_checksum(self, cache, fpath):
+        # unsigned 64 bit checksums don't fit in an sqlite integer as they are
+        with mock.patch('fab.util._read_checksum', return_value=2**64 - 1):
+            cache.checksum(fpath)
+        with mock.patch('builtins.open', side_effect=AssertionError):
+            assert cache.checksum(fpath) == 2**64 - 1
+
+    def test_pickle(self, cache, fpath):
+        cache.checksum(fpath)
+        clone = pickle.loads(pickle.dumps(cache))
+        with mock.patch('builtins.open', side_effect=AssertionError):
+            assert clone.checksum(fpath) == bytes_checksum(b'foo')
+
+    def test_file_checksum(self, cache, fpath):
+        set_hash_cache(cache)
+        try:
+            file_checksum(fpath)
+            with mock.patch('builtins.open', side_effect=AssertionError):
+                assert file_checksum(fpath) == HashedFile(fpath, bytes_checksum(b'foo'))
+        finally:
+            set_hash_cache(None)